@@ -5,90 +5,125 @@ import mimetypes
 import logging
 import os
 import click
-import hashlib
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
 from datetime import datetime
 from time import sleep
+from urllib import urlencode
 from xattr import listxattr, getxattr
-from certidude import authority, mailer
+from certidude import authority, changelog, errors, leases, mailer, sweeper
 from certidude.auth import login_required, authorize_admin
 from certidude.user import User
-from certidude.decorators import serialize, csrf_protection
+from certidude.decorators import serialize, conditional, csrf_protection, stat_validator
 from certidude import const, config
 
 logger = logging.getLogger(__name__)
 
 
 class CertificateAuthorityResource(object):
+    @conditional(lambda req: stat_validator(config.AUTHORITY_CERTIFICATE_PATH))
     def on_get(self, req, resp):
         logger.info(u"Served CA certificate to %s", req.context.get("remote_addr"))
-        resp.stream = open(config.AUTHORITY_CERTIFICATE_PATH, "rb")
+        resp.body = authority.certificate_buf
         resp.append_header("Content-Type", "application/x-x509-ca-cert")
         resp.append_header("Content-Disposition", "attachment; filename=%s.crt" %
             const.HOSTNAME.encode("ascii"))
 
 
+def serialize_request(entry):
+    common_name, path, buf, obj, server = entry
+    return dict(
+        common_name = common_name,
+        server = server,
+        address = getxattr(path, "user.request.address"), # TODO: move to authority.py
+        **authority.get_fingerprints(path, buf))
+
+def serialize_certificate(entry):
+    common_name, serial_number, signed, expires, server, path, sha256sum = entry
+    # Extract certificate tags from filesystem
+    try:
+        tags = []
+        for tag in getxattr(path, "user.xdg.tags").split(","):
+            if "=" in tag:
+                k, v = tag.split("=", 1)
+            else:
+                k, v = "other", tag
+            tags.append(dict(id=tag, key=k, value=v))
+    except IOError: # No such attribute(s)
+        tags = None
+
+    attributes = {}
+    for key in listxattr(path):
+        if key.startswith("user.machine."):
+            attributes[key[13:]] = getxattr(path, key)
+
+    # Leases are tracked by common name, revoked certificates don't have one
+    lease = leases.get(common_name)
+    current = authority.signed_inventory.get(common_name)
+    if lease and current and current.serial_number == serial_number:
+        lease = dict(
+            inner_address = lease.inner_address,
+            outer_address = lease.outer_address,
+            last_seen = lease.last_seen,
+            age = datetime.utcnow() - lease.last_seen,
+            state = sweeper.get(common_name)
+        )
+    else:
+        lease = None
+
+    return dict(
+        serial_number = "%x" % serial_number,
+        common_name = common_name,
+        server = server,
+        # TODO: key type, key length, key exponent, key modulo
+        signed = signed,
+        expires = expires,
+        sha256sum = sha256sum,
+        lease = lease,
+        tags = tags,
+        attributes = attributes or None,
+    )
+
+def serialize_change(common_name, generation):
+    try:
+        path, buf, csr = authority.get_request(common_name)
+    except errors.RequestDoesNotExist:
+        request = None
+    else:
+        request = serialize_request((common_name, path, buf, csr, authority.server_flags(common_name)))
+    certificate = authority.signed_inventory.get(common_name)
+    return dict(
+        common_name = common_name,
+        generation = generation,
+        request = request,
+        certificate = serialize_certificate(certificate) if certificate else None)
+
+def last_seen():
+    """
+    Sort key of certificates by last seen lease, leases are looked up once
+    """
+    seen = leases.snapshot()
+    def key(entry):
+        lease = seen.get(entry.common_name)
+        return lease.last_seen.isoformat() if lease else ""
+    return key
+
+
+def session_validator(req):
+    """
+    Session changes along with the change log and client counters
+    """
+    return u"%s;%d;%s" % (req.context.get("user").name, changelog.current(),
+        ";".join(["%s=%d" % j for j in sorted(sweeper.counts().items())])), None
+
+
 class SessionResource(object):
     @csrf_protection
-    @serialize
     @login_required
+    @conditional(session_validator)
+    @serialize
     def on_get(self, req, resp):
-
-        def serialize_requests(g):
-            for common_name, path, buf, obj, server in g():
-                yield dict(
-                    common_name = common_name,
-                    server = server,
-                    address = getxattr(path, "user.request.address"), # TODO: move to authority.py
-                    md5sum = hashlib.md5(buf).hexdigest(),
-                    sha1sum = hashlib.sha1(buf).hexdigest(),
-                    sha256sum = hashlib.sha256(buf).hexdigest(),
-                    sha512sum = hashlib.sha512(buf).hexdigest()
-                )
-
-        def serialize_certificates(g):
-            for common_name, path, buf, obj, server in g():
-                # Extract certificate tags from filesystem
-                try:
-                    tags = []
-                    for tag in getxattr(path, "user.xdg.tags").split(","):
-                        if "=" in tag:
-                            k, v = tag.split("=", 1)
-                        else:
-                            k, v = "other", tag
-                        tags.append(dict(id=tag, key=k, value=v))
-                except IOError: # No such attribute(s)
-                    tags = None
-
-                attributes = {}
-                for key in listxattr(path):
-                    if key.startswith("user.machine."):
-                        attributes[key[13:]] = getxattr(path, key)
-
-                # Extract lease information from filesystem
-                try:
-                    last_seen = datetime.strptime(getxattr(path, "user.lease.last_seen"), "%Y-%m-%dT%H:%M:%S.%fZ")
-                    lease = dict(
-                        inner_address = getxattr(path, "user.lease.inner_address"),
-                        outer_address = getxattr(path, "user.lease.outer_address"),
-                        last_seen = last_seen,
-                        age = datetime.utcnow() - last_seen
-                    )
-                except IOError: # No such attribute(s)
-                    lease = None
-
-                yield dict(
-                    serial_number = "%x" % obj.serial_number,
-                    common_name = common_name,
-                    server = server,
-                    # TODO: key type, key length, key exponent, key modulo
-                    signed = obj["tbs_certificate"]["validity"]["not_before"].native,
-                    expires = obj["tbs_certificate"]["validity"]["not_after"].native,
-                    sha256sum = hashlib.sha256(buf).hexdigest(),
-                    lease = lease,
-                    tags = tags,
-                    attributes = attributes or None,
-                )
-
         if req.context.get("user").is_admin():
             logger.info(u"Logged in authority administrator %s from %s" % (req.context.get("user"), req.context.get("remote_addr")))
         else:
@@ -104,8 +139,9 @@ class SessionResource(object):
             authority = dict(
                 tagging = [dict(name=t[0], type=t[1], title=t[2]) for t in config.TAG_TYPES],
                 lease = dict(
-                    offline = 600, # Seconds from last seen activity to consider lease offline, OpenVPN reneg-sec option
-                    dead = 604800 # Seconds from last activity to consider lease dead, X509 chain broken or machine discarded
+                    offline = config.LEASE_OFFLINE_TIMEOUT, # Seconds from last seen activity to consider lease offline, OpenVPN reneg-sec option
+                    dead = config.LEASE_DEAD_TIMEOUT, # Seconds from last activity to consider lease dead, X509 chain broken or machine discarded
+                    clients = sweeper.counts() # Amount of clients online, offline and dead
                 ),
                 common_name = authority.certificate.subject.native["common_name"],
                 mailer = dict(
@@ -116,9 +152,13 @@ class SessionResource(object):
                 user_enrollment_allowed=config.USER_ENROLLMENT_ALLOWED,
                 user_multiple_certificates=config.USER_MULTIPLE_CERTIFICATES,
                 events = config.EVENT_SOURCE_SUBSCRIBE % config.EVENT_SOURCE_TOKEN,
-                requests=serialize_requests(authority.list_requests),
-                signed=serialize_certificates(authority.list_signed),
-                revoked=serialize_certificates(authority.list_revoked),
+                generation = changelog.current(),
+                collections = dict(
+                    requests = "/api/session/request/",
+                    signed = "/api/session/signed/",
+                    revoked = "/api/session/revoked/",
+                    changes = "/api/session/changes/"
+                ),
                 admin_users = User.objects.filter_admins(),
                 user_subnets = config.USER_SUBNETS,
                 autosign_subnets = config.AUTOSIGN_SUBNETS,
@@ -136,6 +176,120 @@ class SessionResource(object):
                 logging=config.LOGGING_BACKEND))
 
 
+class CollectionResource(object):
+    """
+    Paginated listing of signing requests, signed or revoked certificates
+    for the web interface. Entries can be filtered by common name substring
+    and server flag, sorted by any of the sort keys and paged with the
+    cursor returned in the previous page. Filename breaks ties as
+    revoked certificates may share the common name. Sort keys map to
+    functions returning the key function for the request
+    """
+    def __init__(self, lister, serializer, sort_keys, filename):
+        self.lister = lister
+        self.serializer = serializer
+        self.sort_keys = sort_keys
+        self.filename = filename
+
+    def sortable(self, sort):
+        return sort in self.sort_keys
+
+    def page(self, sort, position, reverse, limit, accept):
+        """
+        Sort all the listed entries, return ones following the position
+        """
+        key = self.sort_keys[sort]()
+        entries = sorted([((key(entry), os.path.basename(self.filename(entry))), entry)
+            for entry in self.lister() if accept(entry)], reverse=reverse)
+        if position:
+            entries = [j for j in entries if (j[0] < position if reverse else j[0] > position)]
+        return entries[:limit]
+
+    @csrf_protection
+    @serialize
+    @login_required
+    @authorize_admin
+    def on_get(self, req, resp):
+        sort = req.get_param("sort") or "common_name"
+        reverse = sort.startswith("-")
+        if not self.sortable(sort.lstrip("-")):
+            raise falcon.HTTPBadRequest("Bad request", "Unsupported sort key %s" % repr(sort))
+        limit = min(req.get_param_as_int("limit") or 100, 1000)
+        query = req.get_param("q")
+        server = req.get_param_as_bool("server")
+
+        cursor = req.get_param("cursor")
+        position = None
+        if cursor:
+            try:
+                position = tuple(json.loads(urlsafe_b64decode(cursor.encode("ascii"))))
+            except (TypeError, ValueError):
+                raise falcon.HTTPBadRequest("Bad request", "Malformed cursor")
+
+        # First item is the common name and fifth the server flag for all entries
+        entries = self.page(sort.lstrip("-"), position, reverse, limit + 1,
+            lambda entry:(not query or query in entry[0]) and (server is None or entry[4] == server))
+
+        following = None
+        if len(entries) > limit:
+            entries = entries[:limit]
+            params = dict(sort=sort, limit=limit,
+                cursor=urlsafe_b64encode(json.dumps(entries[-1][0])))
+            if query:
+                params["q"] = query.encode("utf-8")
+            if server is not None:
+                params["server"] = int(server)
+            following = "%s?%s" % (req.path, urlencode(params))
+
+        return dict(
+            items = [self.serializer(entry) for _, entry in entries],
+            next = following)
+
+
+class InventoryCollectionResource(CollectionResource):
+    """
+    Paginated listing of certificates seeking the position in sorted index
+    of the inventory, sort keys not indexed there fall back to sorting
+    """
+    def __init__(self, inventory, sort_keys={}):
+        CollectionResource.__init__(self, lambda:iter(inventory), serialize_certificate,
+            sort_keys, lambda entry:entry.path)
+        self.inventory = inventory
+
+    def sortable(self, sort):
+        return sort in self.inventory.SORT_KEYS or sort in self.sort_keys
+
+    def page(self, sort, position, reverse, limit, accept):
+        if sort in self.inventory.SORT_KEYS:
+            return self.inventory.page(sort, position, reverse, limit, accept)
+        return CollectionResource.page(self, sort, position, reverse, limit, accept)
+
+
+class ChangeFeedResource(object):
+    """
+    Current state of signing requests and certificates changed since
+    given generation, reset is signalled if the generation is not known
+    anymore and the client has to reload the session instead
+    """
+    @csrf_protection
+    @serialize
+    @login_required
+    @authorize_admin
+    def on_get(self, req, resp):
+        generation = req.get_param_as_int("since", required=True)
+        records = changelog.since(generation)
+        if records is None:
+            return dict(generation=changelog.current(), reset=True, changes=())
+        changed = OrderedDict()
+        for generation, event_type, common_name in records:
+            changed.pop(common_name, None)
+            changed[common_name] = generation
+        return dict(
+            generation = generation,
+            reset = False,
+            changes = [serialize_change(*j) for j in changed.items()])
+
+
 class StaticResource(object):
     def __init__(self, root):
         self.root = os.path.realpath(root)
@@ -176,9 +330,10 @@ def certidude_app(log_handlers=[]):
     from certidude import config
     from .signed import SignedCertificateDetailResource
     from .request import RequestListResource, RequestDetailResource
-    from .lease import LeaseResource, LeaseDetailResource
+    from .lease import LeaseResource, LeaseDetailResource, BulkLeaseResource, \
+        LeaseTimelineResource, LeaseHistoryResource, LeaseStateResource
     from .script import ScriptResource
-    from .tag import TagResource, TagDetailResource
+    from .tag import TagResource, TagDetailResource, TagQueryResource, BulkTagResource
     from .attrib import AttributeResource
     from .bootstrap import BootstrapResource
     from .token import TokenResource
@@ -193,6 +348,15 @@ def certidude_app(log_handlers=[]):
     app.add_route("/api/request/{cn}/", RequestDetailResource())
     app.add_route("/api/request/", RequestListResource())
     app.add_route("/api/", SessionResource())
+    app.add_route("/api/session/request/", CollectionResource(
+        authority.list_requests, serialize_request,
+        dict(common_name=lambda:lambda entry:entry[0]),
+        lambda entry:entry[1]))
+    app.add_route("/api/session/signed/", InventoryCollectionResource(
+        authority.signed_inventory, dict(last_seen=last_seen)))
+    app.add_route("/api/session/changes/", ChangeFeedResource())
+    app.add_route("/api/session/revoked/", InventoryCollectionResource(
+        authority.revoked_inventory))
 
     if config.BUNDLE_FORMAT and config.USER_ENROLLMENT_ALLOWED:
         app.add_route("/api/token/", TokenResource())
@@ -204,20 +368,30 @@ def certidude_app(log_handlers=[]):
     # API calls used by pushed events on the JS end
     app.add_route("/api/signed/{cn}/tag/", TagResource())
     app.add_route("/api/signed/{cn}/lease/", LeaseDetailResource())
+    app.add_route("/api/signed/{cn}/history/", LeaseTimelineResource())
 
     # API call used to delete existing tags
     app.add_route("/api/signed/{cn}/tag/{tag}/", TagDetailResource())
 
+    # Look up certificates by tag for bulk operations
+    app.add_route("/api/tag/", TagQueryResource())
+    app.add_route("/api/tag/bulk/", BulkTagResource())
+
     # Gateways can submit leases via this API call
     app.add_route("/api/lease/", LeaseResource())
+    app.add_route("/api/lease/bulk/", BulkLeaseResource())
+    app.add_route("/api/lease/history/", LeaseHistoryResource())
+    app.add_route("/api/lease/state/", LeaseStateResource())
 
     # Bootstrap resource
     app.add_route("/api/bootstrap/", BootstrapResource())
 
     # Add CRL handler if we have any whitelisted subnets
     if config.CRL_SUBNETS:
-        from .revoked import RevocationListResource
+        from .revoked import RevocationListResource, DeltaRevocationListResource
         app.add_route("/api/revoked/", RevocationListResource())
+        if config.AUTHORITY_DELTA_CRL_URL:
+            app.add_route("/api/revoked/delta/", DeltaRevocationListResource())
 
     # Add SCEP handler if we have any whitelisted subnets
     if config.SCEP_SUBNETS:
@@ -4,7 +4,7 @@ import logging
 import re
 from xattr import setxattr, listxattr, removexattr
 from datetime import datetime
-from certidude import config, authority, push
+from certidude import config, authority, changelog, push
 from certidude.decorators import serialize, csrf_protection
 from certidude.firewall import whitelist_subject
 from certidude.auth import login_required, login_optional, authorize_admin
@@ -54,5 +54,6 @@ class AttributeResource(object):
                     continue
                 if key not in valid:
                     removexattr(path, key)
-            push.publish("attribute-update", cn)
+            push.publish("attribute-update", cn,
+                generation=changelog.bump("attribute-update", cn))
 
@@ -1,12 +1,21 @@
 import logging
-from certidude.decorators import serialize
+from certidude.decorators import serialize, conditional, stat_validator
 from certidude.config import cp
-from certidude import authority, config, const
+from certidude import authority, changelog, config, const
 from jinja2 import Template
 
 logger = logging.getLogger(__name__)
 
+def bootstrap_validator(req):
+    """
+    Server names change only along with the change log
+    """
+    version, last_modified = stat_validator(config.BOOTSTRAP_TEMPLATE)
+    return "%s;%d" % (version, changelog.current()), None
+
+
 class BootstrapResource(object):
+    @conditional(bootstrap_validator)
     def on_get(self, req, resp):
         resp.body = Template(open(config.BOOTSTRAP_TEMPLATE).read()).render(
             authority = const.FQDN,
@@ -1,12 +1,15 @@
 
 import click
 import falcon
+import json
 import logging
-import xattr
 from datetime import datetime
-from certidude import config, authority, push
+from ipaddress import ip_address
+from certidude import config, authority, history, leases, push, sweeper
+from certidude.leases import Lease
 from certidude.auth import login_required, authorize_admin
 from certidude.decorators import serialize
+from certidude.firewall import whitelist_subnets
 
 logger = logging.getLogger(__name__)
 
@@ -17,15 +20,57 @@ class LeaseDetailResource(object):
     @login_required
     @authorize_admin
     def on_get(self, req, resp, cn):
-        try:
-            path, buf, cert = authority.get_signed(cn)
-            return dict(
-                last_seen =     xattr.getxattr(path, "user.lease.last_seen"),
-                inner_address = xattr.getxattr(path, "user.lease.inner_address").decode("ascii"),
-                outer_address = xattr.getxattr(path, "user.lease.outer_address").decode("ascii")
-            )
-        except EnvironmentError: # Certificate or attribute not found
+        lease = leases.get(cn)
+        if not lease or not authority.signed_inventory.get(cn): # Certificate or lease not found
+            raise falcon.HTTPNotFound()
+        return dict(
+            last_seen = lease.last_seen,
+            inner_address = lease.inner_address,
+            outer_address = lease.outer_address,
+            state = sweeper.get(cn)
+        )
+
+
+class LeaseStateResource(object):
+    """
+    Amount of clients online, offline and dead for monitoring
+    """
+    @serialize
+    @login_required
+    @authorize_admin
+    def on_get(self, req, resp):
+        return sweeper.counts()
+
+
+class LeaseTimelineResource(object):
+    @serialize
+    @login_required
+    @authorize_admin
+    def on_get(self, req, resp, cn):
+        if not authority.signed_inventory.get(cn):
             raise falcon.HTTPNotFound()
+        return history.timeline(cn,
+            req.get_param_as_int("since"),
+            req.get_param_as_int("until"))
+
+
+class LeaseHistoryResource(object):
+    """
+    Concurrent clients per gateway, since and until are given in seconds
+    since epoch and they apply to the beginning of the period
+    """
+    @serialize
+    @login_required
+    @authorize_admin
+    def on_get(self, req, resp):
+        resolution = req.get_param("resolution") or "hour"
+        if resolution not in dict(history.RESOLUTIONS):
+            raise falcon.HTTPBadRequest("Bad request", "Resolution must be one of: %s" %
+                ", ".join([j for j, _ in history.RESOLUTIONS]))
+        return history.concurrency(resolution,
+            req.get_param_as_int("since"),
+            req.get_param_as_int("until"),
+            req.get_param("gateway"))
 
 
 class LeaseResource(object):
@@ -36,12 +81,78 @@ class LeaseResource(object):
         if req.get_param("serial") and cert.serial_number != req.get_param_as_int("serial"): # OCSP-ish solution for OpenVPN, not exposed for StrongSwan
             raise falcon.HTTPForbidden("Forbidden", "Invalid serial number supplied")
 
-        xattr.setxattr(path, "user.lease.outer_address", req.get_param("outer_address", required=True).encode("ascii"))
-        xattr.setxattr(path, "user.lease.inner_address", req.get_param("inner_address", required=True).encode("ascii"))
-        xattr.setxattr(path, "user.lease.last_seen", datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z")
-        push.publish("lease-update", common_name)
+        try:
+            inner_address = unicode(ip_address(unicode(req.get_param("inner_address", required=True))))
+            outer_address = unicode(ip_address(unicode(req.get_param("outer_address", required=True))))
+        except ValueError:
+            raise falcon.HTTPBadRequest("Bad request", "Malformed inner or outer address")
+
+        leases.update([Lease(common_name, inner_address, outer_address,
+            datetime.utcnow(), unicode(req.context.get("remote_addr")))])
+        push.publish("lease-update", common_name) # Leases are kept out of the change log
 
         # client-disconnect is pretty much unusable:
         # - Android Connect Client results "IP packet with unknown IP version=2" on gateway
         # - NetworkManager just kills OpenVPN client, disconnect is never reported
         # - Disconnect is also not reported when uplink connection dies or laptop goes to sleep
+
+
+class BulkLeaseResource(object):
+    """
+    Leases of all the clients connected to a gateway submitted at once,
+    either as JSON list of objects or as form arrays of equal length
+    """
+    def parse(self, req):
+        if req.content_type and req.content_type.startswith("application/json"):
+            try:
+                records = json.loads(req.stream.read(req.content_length or 0))
+            except ValueError:
+                raise falcon.HTTPBadRequest("Bad request", "Malformed JSON")
+            if isinstance(records, dict):
+                records = records.get("leases")
+            if not isinstance(records, list) or not all(isinstance(j, dict) for j in records):
+                raise falcon.HTTPBadRequest("Bad request", "Expected list of leases")
+            return records
+
+        keys = "client", "inner_address", "outer_address"
+        columns = [req.get_param_as_list(key, required=True) for key in keys]
+        serials = req.get_param_as_list("serial")
+        if serials:
+            keys += "serial",
+            columns.append(serials)
+        if len(set([len(j) for j in columns])) != 1:
+            raise falcon.HTTPBadRequest("Bad request", "Lease attribute arrays differ in length")
+        return [dict(zip(keys, values)) for values in zip(*columns)]
+
+    @serialize
+    @whitelist_subnets(config.LEASE_SUBNETS)
+    def on_post(self, req, resp):
+        last_seen = datetime.utcnow()
+        results, updated = [], []
+        for record in self.parse(req):
+            common_name = record.get("client")
+            entry = authority.signed_inventory.get(common_name) if isinstance(common_name, basestring) else None
+            try:
+                inner_address = unicode(ip_address(unicode(record.get("inner_address"))))
+                outer_address = unicode(ip_address(unicode(record.get("outer_address"))))
+                serial = int(record["serial"]) if record.get("serial") not in (None, "") else None
+            except (TypeError, ValueError):
+                status = "malformed"
+            else:
+                if not entry:
+                    status = "not found"
+                elif serial is not None and serial != entry.serial_number:
+                    status = "invalid serial"
+                else:
+                    updated.append(Lease(entry.common_name, inner_address, outer_address,
+                        last_seen, unicode(req.context.get("remote_addr"))))
+                    status = "updated"
+            results.append(dict(client=common_name, status=status))
+
+        if updated:
+            leases.update(updated)
+            common_names = [lease.common_name for lease in updated]
+            push.publish("lease-update", common_names)
+        logger.debug(u"Updated %d of %d leases submitted by %s",
+            len(updated), len(results), req.context.get("remote_addr"))
+        return results
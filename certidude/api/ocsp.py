@@ -1,15 +1,12 @@
-import click
+import falcon
 import hashlib
-import os
 from asn1crypto.util import timezone
-from asn1crypto import cms, algos, x509, ocsp
-from base64 import b64decode, b64encode
-from certbuilder import pem_armor_certificate
-from certidude import authority, push, config
+from asn1crypto import ocsp
+from base64 import b64decode
+from certidude import authority, config
 from certidude.firewall import whitelist_subnets
-from datetime import datetime, timedelta
-from oscrypto import keys, asymmetric, symmetric
-from oscrypto.errors import SignatureError
+from datetime import datetime
+from falcon.util import dt_to_http
 
 class OCSPResource(object):
     @whitelist_subnets(config.OCSP_SUBNETS)
@@ -22,12 +19,7 @@ class OCSPResource(object):
         else:
             raise falcon.HTTPMethodNotAllowed()
 
-        fh = open(config.AUTHORITY_CERTIFICATE_PATH)
-        server_certificate = asymmetric.load_certificate(fh.read())
-        fh.close()
-
         ocsp_req = ocsp.OCSPRequest.load(body)
-        now = datetime.now(timezone.utc)
         response_extensions = []
 
         try:
@@ -43,65 +35,29 @@ class OCSPResource(object):
         except ValueError: # https://github.com/wbond/asn1crypto/issues/56
             pass
 
-        responses = []
-        for item in ocsp_req["tbs_request"]["request_list"]:
-            serial = item["req_cert"]["serial_number"].native
+        serials = [item["req_cert"]["serial_number"].native
+            for item in ocsp_req["tbs_request"]["request_list"]]
 
-            try:
-                link_target = os.readlink(os.path.join(config.SIGNED_BY_SERIAL_DIR, "%x.pem" % serial))
-                assert link_target.startswith("../")
-                assert link_target.endswith(".pem")
-                path, buf, cert = authority.get_signed(link_target[3:-4])
-                if serial != cert.serial_number:
-                    raise EnvironmentError("integrity check failed")
-                status = ocsp.CertStatus(name='good', value=None)
-            except EnvironmentError:
-                try:
-                    path, buf, cert, revoked = authority.get_revoked(serial)
-                    status = ocsp.CertStatus(
-                        name='revoked',
-                        value={
-                            'revocation_time': revoked,
-                            'revocation_reason': u"key_compromise",
-                        })
-                except EnvironmentError:
-                    status = ocsp.CertStatus(name="unknown", value=None)
+        resp.set_header("Content-Type", "application/ocsp-response")
+        if len(serials) != 1 or response_extensions:
+            resp.body = authority.sign_ocsp_response(serials,
+                datetime.now(timezone.utc), response_extensions)
+            return
 
-            responses.append({
-                'cert_id': {
-                    'hash_algorithm': {
-                        'algorithm': u"sha1"
-                    },
-                    'issuer_name_hash': server_certificate.asn1.subject.sha1,
-                    'issuer_key_hash': server_certificate.public_key.asn1.sha1,
-                    'serial_number': serial,
-                },
-                'cert_status': status,
-                'this_update': now,
-                'single_extensions': []
-            })
+        # Requests without nonce can be answered with pre-signed response
+        resp.body, this_update, next_update = authority.ocsp_responses.get(serials[0])
 
-        response_data = ocsp.ResponseData({
-            'responder_id': ocsp.ResponderId(name='by_key', value=server_certificate.public_key.asn1.sha1),
-            'produced_at': now,
-            'responses': responses,
-            'response_extensions': response_extensions
-        })
+        if req.method != "GET":
+            return
 
-        resp.body = ocsp.OCSPResponse({
-            'response_status': u"successful",
-            'response_bytes': {
-                'response_type': u"basic_ocsp_response",
-                'response': {
-                    'tbs_response_data': response_data,
-                    'certs': [server_certificate.asn1],
-                    'signature_algorithm': {'algorithm': u"sha1_rsa"},
-                    'signature': asymmetric.rsa_pkcs1v15_sign(
-                        authority.private_key,
-                        response_data.dump(),
-                        "sha1"
-                    )
-                }
-            }
-        }).dump()
+        # Pre-signed responses to GET requests are cacheable as per RFC5019
+        max_age = int((next_update - datetime.now(timezone.utc)).total_seconds())
+        etag = "\"%s\"" % hashlib.sha1(resp.body).hexdigest()
+        resp.set_header("Cache-Control", "max-age=%d, public, no-transform, must-revalidate" % max(max_age, 0))
+        resp.set_header("Last-Modified", dt_to_http(this_update))
+        resp.set_header("Expires", dt_to_http(next_update))
+        resp.set_header("ETag", etag)
 
+        if req.get_header("If-None-Match") == etag:
+            resp.status = falcon.HTTP_304
+            resp.body = None
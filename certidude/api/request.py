@@ -9,9 +9,9 @@ import hashlib
 from asn1crypto import pem
 from asn1crypto.csr import CertificationRequest
 from base64 import b64decode
-from certidude import config, authority, push, errors
+from certidude import config, authority, errors
 from certidude.auth import login_required, login_optional, authorize_admin
-from certidude.decorators import serialize, csrf_protection
+from certidude.decorators import serialize, conditional, csrf_protection, stat_validator
 from certidude.firewall import whitelist_subnets, whitelist_content_types
 from datetime import datetime
 from oscrypto import asymmetric
@@ -148,8 +148,6 @@ class RequestListResource(object):
             raise falcon.HTTPConflict(
                 "CSR with such CN already exists",
                 "Will not overwrite existing certificate signing request, explicitly delete CSR and try again")
-        else:
-            push.publish("request-submitted", common_name)
 
         # Wait the certificate to be signed if waiting is requested
         logger.info(u"Stored signing request %s from %s", common_name, req.context.get("remote_addr"))
@@ -167,6 +165,7 @@ class RequestListResource(object):
 
 
 class RequestDetailResource(object):
+    @conditional(lambda req, cn: stat_validator(os.path.join(config.REQUESTS_DIR, cn + ".pem")))
     def on_get(self, req, resp, cn):
         """
         Fetch certificate signing request as PEM
@@ -198,10 +197,7 @@ class RequestDetailResource(object):
                 common_name = cn,
                 server = authority.server_flags(cn),
                 address = getxattr(path, "user.request.address"), # TODO: move to authority.py
-                md5sum = hashlib.md5(buf).hexdigest(),
-                sha1sum = hashlib.sha1(buf).hexdigest(),
-                sha256sum = hashlib.sha256(buf).hexdigest(),
-                sha512sum = hashlib.sha512(buf).hexdigest()))
+                **authority.get_fingerprints(path, buf)))
         else:
             raise falcon.HTTPUnsupportedMediaType(
                 "Client did not accept application/json or application/x-pem-file")
@@ -3,14 +3,26 @@ import click
 import falcon
 import json
 import logging
-from certidude import const, config
-from certidude.authority import export_crl, list_revoked
+from certidude import authority, const, config
+from certidude.authority import export_crl, export_delta_crl, list_revoked
+from certidude.decorators import conditional
 from certidude.firewall import whitelist_subnets
 
 logger = logging.getLogger(__name__)
 
+def revocation_list_validator(revocation_list):
+    """
+    Revocation list is identified by it's number
+    """
+    def validator(req):
+        revocation_list.export() # Make sure it's current
+        return "%d" % revocation_list.number, None
+    return validator
+
+
 class RevocationListResource(object):
     @whitelist_subnets(config.CRL_SUBNETS)
+    @conditional(revocation_list_validator(authority.revocation_list))
     def on_get(self, req, resp):
         # Primarily offer DER encoded CRL as per RFC5280
         # This is also what StrongSwan expects
@@ -40,3 +52,27 @@ class RevocationListResource(object):
             logger.debug(u"Client %s asked revocation list in unsupported format" % req.context.get("remote_addr"))
             raise falcon.HTTPUnsupportedMediaType(
                 "Client did not accept application/x-pkcs7-crl or application/x-pem-file")
+
+
+class DeltaRevocationListResource(object):
+    @whitelist_subnets(config.CRL_SUBNETS)
+    @conditional(revocation_list_validator(authority.delta_revocation_list))
+    def on_get(self, req, resp):
+        if req.client_accepts("application/x-pkcs7-crl"):
+            resp.set_header("Content-Type", "application/x-pkcs7-crl")
+            resp.append_header(
+                "Content-Disposition",
+                ("attachment; filename=%s-delta.crl" % const.HOSTNAME).encode("ascii"))
+            logger.debug(u"Serving delta revocation list (DER) to %s", req.context.get("remote_addr"))
+            resp.body = export_delta_crl(pem=False)
+        elif req.client_accepts("application/x-pem-file"):
+            resp.set_header("Content-Type", "application/x-pem-file")
+            resp.append_header(
+                "Content-Disposition",
+                ("attachment; filename=%s-delta-crl.pem" % const.HOSTNAME).encode("ascii"))
+            logger.debug(u"Serving delta revocation list (PEM) to %s", req.context.get("remote_addr"))
+            resp.body = export_delta_crl()
+        else:
+            logger.debug(u"Client %s asked delta revocation list in unsupported format" % req.context.get("remote_addr"))
+            raise falcon.HTTPUnsupportedMediaType(
+                "Client did not accept application/x-pkcs7-crl or application/x-pem-file")
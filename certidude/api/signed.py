@@ -2,14 +2,15 @@
 import falcon
 import logging
 import json
-import hashlib
-from certidude import authority
+import os
+from certidude import authority, config
 from certidude.auth import login_required, authorize_admin
-from certidude.decorators import csrf_protection
+from certidude.decorators import conditional, csrf_protection, stat_validator
 
 logger = logging.getLogger(__name__)
 
 class SignedCertificateDetailResource(object):
+    @conditional(lambda req, cn: stat_validator(os.path.join(config.SIGNED_DIR, cn + ".pem")))
     def on_get(self, req, resp, cn):
 
         preferred_type = req.client_prefers(("application/json", "application/x-pem-file"))
@@ -34,7 +35,7 @@ class SignedCertificateDetailResource(object):
                 serial_number = "%x" % cert.serial_number,
                 signed = cert["tbs_certificate"]["validity"]["not_before"].native.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
                 expires = cert["tbs_certificate"]["validity"]["not_after"].native.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
-                sha256sum = hashlib.sha256(buf).hexdigest()))
+                sha256sum = authority.get_fingerprints(path, buf)["sha256sum"]))
             logger.debug(u"Served certificate %s to %s as application/json",
                 cn, req.context.get("remote_addr"))
         else:
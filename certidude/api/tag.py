@@ -1,7 +1,10 @@
 import falcon
+import json
 import logging
-from xattr import getxattr, removexattr, setxattr
-from certidude import authority, push
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from urllib import urlencode
+from xattr import getxattr
+from certidude import authority, tags as tagging
 from certidude.auth import login_required, authorize_admin
 from certidude.decorators import serialize, csrf_protection
 
@@ -32,17 +35,8 @@ class TagResource(object):
     def on_post(self, req, resp, cn):
         path, buf, cert = authority.get_signed(cn)
         key, value = req.get_param("key", required=True), req.get_param("value", required=True)
-        try:
-            tags = set(getxattr(path, "user.xdg.tags").decode("utf-8").split(","))
-        except IOError:
-            tags = set()
-        if key == "other":
-            tags.add(value)
-        else:
-            tags.add("%s=%s" % (key,value))
-        setxattr(path, "user.xdg.tags", ",".join(tags).encode("utf-8"))
+        tagging.update([cn], add=[value if key == "other" else "%s=%s" % (key, value)])
         logger.debug(u"Tag %s=%s set for %s" % (key, value, cn))
-        push.publish("tag-update", cn)
 
 
 class TagDetailResource(object):
@@ -52,32 +46,107 @@ class TagDetailResource(object):
     def on_put(self, req, resp, cn, tag):
         path, buf, cert = authority.get_signed(cn)
         value = req.get_param("value", required=True)
-        try:
-            tags = set(getxattr(path, "user.xdg.tags").decode("utf-8").split(","))
-        except IOError:
-            tags = set()
-        try:
-            tags.remove(tag)
-        except KeyError:
-            pass
-        if "=" in tag:
-            tags.add("%s=%s" % (tag.split("=")[0], value))
-        else:
-            tags.add(value)
-        setxattr(path, "user.xdg.tags", ",".join(tags).encode("utf-8"))
+        tagging.update([cn], rename={tag:
+            "%s=%s" % (tag.split("=")[0], value) if "=" in tag else value})
         logger.debug(u"Tag %s set to %s for %s" % (tag, value, cn))
-        push.publish("tag-update", cn)
 
     @csrf_protection
     @login_required
     @authorize_admin
     def on_delete(self, req, resp, cn, tag):
         path, buf, cert = authority.get_signed(cn)
-        tags = set(getxattr(path, "user.xdg.tags").split(","))
-        tags.remove(tag)
-        if not tags:
-            removexattr(path, "user.xdg.tags")
-        else:
-            setxattr(path, "user.xdg.tags", ",".join(tags))
+        tagging.update([cn], remove=[tag])
         logger.debug(u"Tag %s removed for %s" % (tag, cn))
-        push.publish("tag-update", cn)
+
+
+class TagQueryResource(object):
+    """
+    Signed certificates having all of the tags given as all parameter and
+    at least one of the tags given as any parameter, eg. all=location=tallinn.
+    Value * matches any value of the key, results are sorted by common name
+    and paged with the cursor returned in the previous page
+    """
+    @serialize
+    @login_required
+    @authorize_admin
+    def on_get(self, req, resp):
+        all_of = req.get_param_as_list("all") or ()
+        any_of = req.get_param_as_list("any") or ()
+        limit = min(req.get_param_as_int("limit") or 100, 1000)
+        matches = tagging.query(all_of, any_of)
+
+        cursor = req.get_param("cursor")
+        if cursor:
+            try:
+                position = json.loads(urlsafe_b64decode(cursor.encode("ascii")))
+            except (TypeError, ValueError):
+                raise falcon.HTTPBadRequest("Bad request", "Malformed cursor")
+            matches = [j for j in matches if j[0] > position]
+
+        following = None
+        if len(matches) > limit:
+            matches = matches[:limit]
+            params = dict(limit=limit, cursor=urlsafe_b64encode(json.dumps(matches[-1][0])))
+            if all_of:
+                params["all"] = ",".join(all_of).encode("utf-8")
+            if any_of:
+                params["any"] = ",".join(any_of).encode("utf-8")
+            following = "%s?%s" % (req.path, urlencode(params))
+
+        return dict(
+            items = [dict(common_name=common_name, tags=tags) for common_name, tags in matches],
+            next = following)
+
+
+class BulkTagResource(object):
+    """
+    Add, replace and remove tags and set attributes of several certificates
+    at once. Certificates are given as list of common names and/or selected
+    by tags and common name substring like in tag search. Request is either
+    JSON object or form with the same keys, attributes are JSON only
+    """
+    def parse(self, req):
+        if req.content_type and req.content_type.startswith("application/json"):
+            try:
+                params = json.loads(req.stream.read(req.content_length or 0))
+            except ValueError:
+                raise falcon.HTTPBadRequest("Bad request", "Malformed JSON")
+            if not isinstance(params, dict):
+                raise falcon.HTTPBadRequest("Bad request", "Expected JSON object")
+        else:
+            params = dict([(key, req.get_param_as_list(key)) for key in
+                ("common_names", "all", "any", "add", "remove", "replace")])
+            params["q"] = req.get_param("q")
+
+        for key in "common_names", "all", "any", "add", "remove", "replace":
+            if not isinstance(params.get(key) or [], list) or \
+                    not all(isinstance(j, basestring) for j in params.get(key) or []):
+                raise falcon.HTTPBadRequest("Bad request", "Expected list of strings as %s" % key)
+        attributes = params.get("attributes") or {}
+        if not isinstance(attributes, dict) or \
+                not all(isinstance(j, basestring) or j is None for j in attributes.values()):
+            raise falcon.HTTPBadRequest("Bad request", "Expected object of strings as attributes")
+        return params, attributes
+
+    @csrf_protection
+    @serialize
+    @login_required
+    @authorize_admin
+    def on_post(self, req, resp):
+        params, attributes = self.parse(req)
+        common_names = tagging.select(params.get("common_names") or (),
+            params.get("all") or (), params.get("any") or (), params.get("q"))
+        results = dict()
+        try:
+            if params.get("add") or params.get("remove") or params.get("replace"):
+                results["tags"] = [dict(common_name=common_name, status=status)
+                    for common_name, status in tagging.update(common_names,
+                        params.get("add") or (), params.get("remove") or (), params.get("replace") or ())]
+            if attributes:
+                results["attributes"] = [dict(common_name=common_name, status=status)
+                    for common_name, status in authority.update_attributes(common_names, attributes)]
+        except ValueError as e:
+            raise falcon.HTTPBadRequest("Bad request", str(e))
+        logger.info(u"Bulk update of %d certificates by %s from %s", len(common_names),
+            req.context.get("user"), req.context.get("remote_addr"))
+        return results
@@ -1,18 +1,108 @@
 
 import click
+import copy
 import gssapi
 import falcon
+import hashlib
+import hmac
 import logging
 import os
 import re
 import socket
-from base64 import b64decode
+from base64 import b64decode, b64encode
+from threading import Lock
+from time import time
 from certidude.user import User
 from certidude.firewall import whitelist_subnets
 from certidude import config, const
 
 logger = logging.getLogger("api")
 
+class AcceptorCredentials(object):
+    """
+    Kerberos acceptor credentials for HTTP service principal, loaded again
+    when the keytab file is replaced or rewritten, including change time
+    as tools may preserve modification time, or when accepting fails
+    """
+    def __init__(self):
+        self.signature = None
+        self.creds = None
+        self.lock = Lock()
+
+    def get(self):
+        path = config.KERBEROS_KEYTAB
+        if path.startswith("FILE:"):
+            path = path[5:]
+        with self.lock:
+            try:
+                s = os.stat(path)
+            except OSError:
+                if self.creds and self.signature[0] == os.getpid():
+                    return self.creds # Keytab is being replaced
+                raise
+            signature = os.getpid(), s.st_ino, s.st_mtime, s.st_ctime, s.st_size
+            if signature != self.signature:
+                os.environ["KRB5_KTNAME"] = config.KERBEROS_KEYTAB
+                self.creds = gssapi.creds.Credentials(
+                    usage='accept',
+                    name=gssapi.names.Name('HTTP/%s'% const.FQDN))
+                self.signature = signature
+                logger.debug(u"Loaded Kerberos acceptor credentials from %s", path)
+            return self.creds
+
+    def invalidate(self):
+        with self.lock:
+            self.signature = None
+            self.creds = None
+
+acceptor_credentials = AcceptorCredentials()
+
+def sign_session(payload):
+    return hmac.new(config.SESSION_SECRET.encode("utf-8"), payload, hashlib.sha256).hexdigest()
+
+def issue_session(req, resp):
+    """
+    Set signed cookie carrying username, admin flag and expiration time
+    """
+    user = req.context.get("user")
+    if not user:
+        return
+    payload = b64encode("%s:%d:%d" % (user.name.encode("utf-8"),
+        user.is_admin(), time() + config.SESSION_LIFETIME))
+    # Cookie module doesn't know SameSite attribute, hence set header directly
+    resp.append_header("Set-Cookie", "certidude_session=%s.%s; Max-Age=%d; Path=/api/; "
+        "Secure; HttpOnly; SameSite=Strict" % (payload, sign_session(payload), config.SESSION_LIFETIME))
+
+def resume_session(req):
+    """
+    Restore user from signed session cookie, return False if
+    the cookie is missing, expired, tampered with or the user is gone
+    """
+    cookie = req.cookies.get("certidude_session")
+    if not cookie or "." not in cookie:
+        return False
+    try:
+        payload, signature = [str(j) for j in cookie.rsplit(".", 1)]
+    except UnicodeEncodeError:
+        return False
+    if not hmac.compare_digest(sign_session(payload), signature):
+        logger.info(u"Invalid session cookie signature from %s", req.context.get("remote_addr"))
+        return False
+    try:
+        username, admin, expires = b64decode(payload).rsplit(":", 2)
+    except (TypeError, ValueError):
+        return False
+    if int(expires) < time():
+        return False
+    try:
+        user = User.objects.get(username.decode("utf-8"))
+    except (KeyError, User.DoesNotExist):
+        return False
+    user = copy.copy(user) # Don't touch the cached one
+    user._is_admin = admin == "1"
+    req.context["user"] = user
+    return True
+
 def authenticate(optional=False):
     import falcon
     def wrapper(func):
@@ -29,25 +119,26 @@ def authenticate(optional=False):
                     "No Kerberos ticket offered, are you sure you've logged in with domain user account?",
                     ["Negotiate"])
 
-            os.environ["KRB5_KTNAME"] = config.KERBEROS_KEYTAB
-
-            server_creds = gssapi.creds.Credentials(
-                usage='accept',
-                name=gssapi.names.Name('HTTP/%s'% const.FQDN))
-
-            context = gssapi.sec_contexts.SecurityContext(creds=server_creds)
+            context = gssapi.sec_contexts.SecurityContext(creds=acceptor_credentials.get())
 
             if not req.auth.startswith("Negotiate "):
                 raise falcon.HTTPBadRequest("Bad request", "Bad header: %s" % req.auth)
 
             token = ''.join(req.auth.split()[1:])
 
+            started = time()
             try:
                 context.step(b64decode(token))
             except TypeError: # base64 errors
                 raise falcon.HTTPBadRequest("Bad request", "Malformed token")
             except gssapi.raw.exceptions.BadMechanismError:
                 raise falcon.HTTPBadRequest("Bad request", "Unsupported authentication mechanism (NTLM?) was offered. Please make sure you've logged into the computer with domain user account. The web interface should not prompt for username or password.")
+            except gssapi.exceptions.GSSError:
+                acceptor_credentials.invalidate() # Keytab may have been rotated meanwhile
+                raise
+            finally:
+                logger.debug(u"Kerberos security context step took %.1fms for %s",
+                    (time() - started) * 1000, req.context.get("remote_addr"))
 
             username, domain = str(context.initiator_name).split("@")
 
@@ -112,11 +203,10 @@ def authenticate(optional=False):
                     "Please authenticate with %s domain account username" % const.DOMAIN,
                     ("Basic",))
 
-            req.context["ldap_conn"] = conn
-            req.context["user"] = User.objects.get(user)
-            retval = func(resource, req, resp, *args, **kwargs)
+            # Credentials verified, user details are looked up via connection pool
             conn.unbind_s()
-            return retval
+            req.context["user"] = User.objects.get(user)
+            return func(resource, req, resp, *args, **kwargs)
 
 
         def pam_authenticate(resource, req, resp, *args, **kwargs):
@@ -146,7 +236,7 @@ def authenticate(optional=False):
             req.context["user"] = User.objects.get(user)
             return func(resource, req, resp, *args, **kwargs)
 
-        def wrapped(resource, req, resp, *args, **kwargs):
+        def authenticate_backend(resource, req, resp, *args, **kwargs):
             # If LDAP enabled and device is not Kerberos capable fall
             # back to LDAP bind authentication
             if "ldap" in config.AUTHENTICATION_BACKENDS:
@@ -160,6 +250,15 @@ def authenticate(optional=False):
                 return ldap_authenticate(resource, req, resp, *args, **kwargs)
             else:
                 raise NotImplementedError("Authentication backend %s not supported" % config.AUTHENTICATION_BACKENDS)
+
+        def wrapped(resource, req, resp, *args, **kwargs):
+            if not config.SESSION_LIFETIME:
+                return authenticate_backend(resource, req, resp, *args, **kwargs)
+            if resume_session(req):
+                return func(resource, req, resp, *args, **kwargs)
+            retval = authenticate_backend(resource, req, resp, *args, **kwargs)
+            issue_session(req, resp) # Response is not sent before responder returns
+            return retval
         return wrapped
     return wrapper
 
@@ -1,23 +1,31 @@
 from __future__ import division, absolute_import, print_function
 import click
+import fcntl
+import logging
 import os
 import re
-import requests
 import hashlib
 import socket
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import namedtuple, OrderedDict
 from oscrypto import asymmetric
-from asn1crypto import pem, x509
+from asn1crypto import ocsp, pem, x509
+from asn1crypto.util import timezone
 from asn1crypto.csr import CertificationRequest
+from base64 import b64encode
 from certbuilder import CertificateBuilder
-from certidude import config, push, mailer, const
+from certidude import changelog, config, push, mailer, outbox, const
 from certidude import errors
 from crlbuilder import CertificateListBuilder, pem_armor_crl
 from csrbuilder import CSRBuilder, pem_armor_csr
 from datetime import datetime, timedelta
 from jinja2 import Template
 from random import SystemRandom
-from xattr import getxattr, listxattr, setxattr
+from time import sleep
+from xattr import getxattr, listxattr, removexattr, setxattr
 
+logger = logging.getLogger(__name__)
 random = SystemRandom()
 
 RE_HOSTNAME =  "^(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])(@(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9]))?$"
@@ -38,34 +46,118 @@ with open(config.AUTHORITY_PRIVATE_KEY_PATH) as fh:
     header, _, key_der_bytes = pem.unarmor(key_buf)
     private_key = asymmetric.load_private_key(key_der_bytes)
 
+class ParsedCache(object):
+    """
+    Bounded LRU cache of parsed PEM files keyed by path,
+    entries are validated against inode, modification time and size
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path, loader):
+        try:
+            s = os.stat(path)
+        except OSError as e: # Callers expect IOError as raised by open()
+            raise IOError(e.errno, e.strerror, path)
+        signature = s.st_ino, s.st_mtime, s.st_size
+        with self.lock:
+            try:
+                cached_signature, buf, obj = self.entries.pop(path)
+            except KeyError:
+                pass
+            else:
+                if cached_signature == signature:
+                    self.hits += 1
+                    self.entries[path] = signature, buf, obj
+                    return buf, obj, s
+            self.misses += 1
+
+        with open(path) as fh:
+            buf = fh.read()
+            header, _, der_bytes = pem.unarmor(buf)
+            obj = loader(der_bytes)
+        with self.lock:
+            self.entries[path] = signature, buf, obj
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return buf, obj, s
+
+    def stats(self):
+        return dict(size=len(self.entries), hits=self.hits, misses=self.misses)
+
+parsed_cache = ParsedCache()
+
+mutation = threading.local()
+
+def serialized(func):
+    """
+    Serialize authority mutations between threads and processes by
+    locking the authority directory, flock() on file descriptors opened
+    separately conflicts within the same process as well.
+    Nested calls from the same thread don't lock again
+    """
+    def wrapped(*args, **kwargs):
+        if getattr(mutation, "depth", 0):
+            mutation.depth += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                mutation.depth -= 1
+        fd = os.open(os.path.dirname(config.AUTHORITY_CERTIFICATE_PATH), os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            mutation.depth = 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                mutation.depth = 0
+        finally:
+            os.close(fd)
+    return wrapped
+
 def get_request(common_name):
     if not re.match(RE_HOSTNAME, common_name):
         raise ValueError("Invalid common name %s" % repr(common_name))
     path = os.path.join(config.REQUESTS_DIR, common_name + ".pem")
     try:
-        with open(path) as fh:
-            buf = fh.read()
-            header, _, der_bytes = pem.unarmor(buf)
-            return path, buf, CertificationRequest.load(der_bytes)
+        buf, csr, s = parsed_cache.load(path, CertificationRequest.load)
     except EnvironmentError:
         raise errors.RequestDoesNotExist("Certificate signing request file %s does not exist" % path)
+    return path, buf, csr
 
 def get_signed(common_name):
     if not re.match(RE_HOSTNAME, common_name):
         raise ValueError("Invalid common name %s" % repr(common_name))
     path = os.path.join(config.SIGNED_DIR, common_name + ".pem")
-    with open(path) as fh:
-        buf = fh.read()
-        header, _, der_bytes = pem.unarmor(buf)
-        return path, buf, x509.Certificate.load(der_bytes)
+    buf, cert, s = parsed_cache.load(path, x509.Certificate.load)
+    return path, buf, cert
 
 def get_revoked(serial):
     path = os.path.join(config.REVOKED_DIR, "%x.pem" % serial)
-    with open(path) as fh:
-        buf = fh.read()
-        header, _, der_bytes = pem.unarmor(buf)
-        return path, buf, x509.Certificate.load(der_bytes), \
-            datetime.utcfromtimestamp(os.stat(path).st_ctime)
+    buf, cert, s = parsed_cache.load(path, x509.Certificate.load)
+    return path, buf, cert, get_revocation_time(path, s)
+
+def store_revocation_time(path, when=None):
+    """
+    Record revocation time explicitly as extended attribute,
+    inode change time is bumped by any attribute written later on
+    """
+    setxattr(path, "user.revocation.time",
+        (when or datetime.utcnow()).strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
+
+def get_revocation_time(path, s):
+    """
+    Return recorded revocation time, certificates revoked by earlier
+    versions fall back to inode change time
+    """
+    try:
+        return datetime.strptime(getxattr(path, "user.revocation.time"), "%Y-%m-%dT%H:%M:%S.%fZ")
+    except IOError: # No such attribute
+        return datetime.utcfromtimestamp(s.st_ctime)
 
 
 def get_attributes(cn, namespace=None):
@@ -88,6 +180,47 @@ def get_attributes(cn, namespace=None):
     return path, buf, cert, attribs
 
 
+@serialized
+def update_attributes(common_names, attributes, namespace="machine"):
+    """
+    Set attributes of the certificates, attributes with empty value
+    are removed. One event is published for all of the changed certificates,
+    returns status per certificate
+    """
+    for key in attributes:
+        if not re.match("[a-z0-9_\.]+$", key):
+            raise ValueError("Invalid attribute %s" % repr(key))
+
+    results, changed = [], []
+    for common_name in common_names:
+        try:
+            path, buf, cert = get_signed(common_name)
+        except (EnvironmentError, ValueError): # Not signed or invalid common name
+            results.append((common_name, "not found"))
+            continue
+        present = set(listxattr(path))
+        updated = False
+        for key, value in attributes.items():
+            identifier = ("user.%s.%s" % (namespace, key)).encode("ascii")
+            if value:
+                if identifier in present and getxattr(path, identifier) == value.encode("utf-8"):
+                    continue
+                setxattr(path, identifier, value.encode("utf-8"))
+                updated = True
+            elif identifier in present:
+                removexattr(path, identifier)
+                updated = True
+        results.append((common_name, "updated" if updated else "unchanged"))
+        if updated:
+            changed.append(common_name)
+
+    if changed:
+        push.publish("attribute-update", changed[0] if len(changed) == 1 else changed,
+            generation=changelog.bump_many("attribute-update", changed))
+    return results
+
+
+@serialized
 def store_request(buf, overwrite=False, address="", user=""):
     """
     Store CSR for later processing
@@ -120,6 +253,7 @@ def store_request(buf, overwrite=False, address="", user=""):
     else:
         with open(request_path + ".part", "w") as fh:
             fh.write(buf)
+        store_fingerprints(request_path + ".part", buf)
         os.rename(request_path + ".part", request_path)
 
     attach_csr = buf, "application/x-pem-file", common_name + ".csr"
@@ -128,9 +262,12 @@ def store_request(buf, overwrite=False, address="", user=""):
         common_name=common_name)
     setxattr(request_path, "user.request.address", address)
     setxattr(request_path, "user.request.user", user)
+    push.publish("request-submitted", common_name,
+        generation=changelog.bump("request-submitted", common_name))
     return request_path, csr, common_name
 
 
+@serialized
 def revoke(common_name):
     """
     Revoke valid certificate
@@ -138,14 +275,20 @@ def revoke(common_name):
     signed_path, buf, cert = get_signed(common_name)
     revoked_path = os.path.join(config.REVOKED_DIR, "%x.pem" % cert.serial_number)
     os.rename(signed_path, revoked_path)
+    store_revocation_time(revoked_path)
     os.unlink(os.path.join(config.SIGNED_BY_SERIAL_DIR, "%x.pem" % cert.serial_number))
+    signed_inventory.discard(signed_path)
+    revoked_inventory.add(revoked_path, buf, cert)
+    ocsp_responses.invalidate(cert.serial_number)
+    publish_static((cert.serial_number,))
 
-    push.publish("certificate-revoked", common_name)
+    push.publish("certificate-revoked", common_name,
+        generation=changelog.bump("certificate-revoked", common_name))
 
     # Publish CRL for long polls
     url = config.LONG_POLL_PUBLISH % "crl"
     click.echo("Publishing CRL at %s ..." % url)
-    requests.post(url, data=export_crl(),
+    outbox.request("POST", url, export_crl(),
         headers={"User-Agent": "Certidude API", "Content-Type": "application/x-pem-file"})
 
     attach_cert = buf, "application/x-pem-file", common_name + ".crt"
@@ -168,6 +311,216 @@ def server_flags(cn):
     return False
 
 
+FINGERPRINT_ALGORITHMS = "md5", "sha1", "sha256", "sha512"
+
+def fingerprint(buf):
+    return dict((algorithm + "sum", hashlib.new(algorithm, buf).hexdigest())
+        for algorithm in FINGERPRINT_ALGORITHMS)
+
+def store_fingerprints(path, buf):
+    """
+    Hash the file once as it's written and keep fingerprints in
+    extended attributes, rename() carries them over along with the inode
+    """
+    fingerprints = fingerprint(buf)
+    for algorithm in FINGERPRINT_ALGORITHMS:
+        setxattr(path, "user.fingerprint.%s" % algorithm, fingerprints[algorithm + "sum"])
+    return fingerprints
+
+def get_fingerprints(path, buf):
+    """
+    Return stored fingerprints, files written by earlier versions are
+    hashed in memory until certidude verify --fix stores fingerprints for them
+    """
+    try:
+        return dict((algorithm + "sum", getxattr(path, "user.fingerprint.%s" % algorithm))
+            for algorithm in FINGERPRINT_ALGORITHMS)
+    except IOError: # No such attribute(s)
+        return fingerprint(buf)
+
+@serialized
+def verify_fingerprints(fix=False):
+    """
+    Recompute fingerprints of signing requests, signed and revoked
+    certificates, return path, algorithm, stored and computed fingerprint
+    of the ones that are missing or differ
+    """
+    mismatches = []
+    for directory in config.REQUESTS_DIR, config.SIGNED_DIR, config.REVOKED_DIR:
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith(".pem"):
+                continue
+            path = os.path.join(directory, filename)
+            with open(path) as fh:
+                buf = fh.read()
+            if fix and directory == config.REVOKED_DIR:
+                # Preserve revocation time of certificates revoked by earlier versions
+                s = os.stat(path)
+                store_revocation_time(path, get_revocation_time(path, s))
+            computed = fingerprint(buf)
+            for algorithm in FINGERPRINT_ALGORITHMS:
+                try:
+                    stored = getxattr(path, "user.fingerprint.%s" % algorithm)
+                except IOError: # No such attribute
+                    stored = None
+                if stored != computed[algorithm + "sum"]:
+                    mismatches.append((path, algorithm, stored, computed[algorithm + "sum"]))
+                    if fix:
+                        setxattr(path, "user.fingerprint.%s" % algorithm, computed[algorithm + "sum"])
+    return mismatches
+
+CertificateSummary = namedtuple("CertificateSummary", (
+    "common_name", "serial_number", "signed", "expires", "server", "path", "sha256sum"))
+
+def summarize(path, buf, cert):
+    """
+    Extract compact summary record from parsed certificate
+    """
+    server = False
+    for extension in cert["tbs_certificate"]["extensions"]:
+        if extension["extn_id"].native == u"extended_key_usage":
+            if u"server_auth" in extension["extn_value"].native:
+                server = True
+    return CertificateSummary(
+        cert["tbs_certificate"]["subject"].native["common_name"],
+        cert.serial_number,
+        cert["tbs_certificate"]["validity"]["not_before"].native.replace(tzinfo=None),
+        cert["tbs_certificate"]["validity"]["not_after"].native.replace(tzinfo=None),
+        server,
+        path,
+        get_fingerprints(path, buf)["sha256sum"])
+
+
+class Inventory(object):
+    """
+    Process-wide index of certificates stored in a directory.
+    Entries are kept up to date by the functions below, changes made by
+    other processes (certidude sign, certidude cron) are picked up
+    when directory modification time changes. Entries are also kept
+    sorted by each of the sort keys for paging through them
+    """
+    SORT_KEYS = dict(
+        common_name = lambda entry:entry.common_name,
+        expires = lambda entry:entry.expires.isoformat())
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.mtime = None
+        self.by_filename = {}
+        self.by_serial = {}
+        self.stats = {}
+        self.changes = {}
+        self.sorted = dict([(key, []) for key in self.SORT_KEYS]) # key -> sorted (value, filename) tuples
+        self.generation = 0 # Bumped whenever an entry is added or removed
+        self.lock = threading.RLock()
+
+    def add(self, path, buf, cert):
+        entry = summarize(path, buf, cert)
+        filename = os.path.basename(path)
+        with self.lock:
+            self.discard(path)
+            self.stats[filename] = os.stat(path)
+            self.changes[filename] = get_revocation_time(path, self.stats[filename])
+            self.by_filename[filename] = entry
+            self.by_serial[entry.serial_number] = entry
+            for key, func in self.SORT_KEYS.items():
+                insort(self.sorted[key], (func(entry), filename))
+            self.generation += 1
+        return entry
+
+    def discard(self, path):
+        filename = os.path.basename(path)
+        with self.lock:
+            self.stats.pop(filename, None)
+            self.changes.pop(filename, None)
+            entry = self.by_filename.pop(filename, None)
+            if entry:
+                self.by_serial.pop(entry.serial_number, None)
+                for key, func in self.SORT_KEYS.items():
+                    index = self.sorted[key]
+                    del index[bisect_left(index, (func(entry), filename))]
+                self.generation += 1
+        return entry
+
+    def refresh(self):
+        mtime = os.stat(self.directory).st_mtime
+        if mtime == self.mtime:
+            return
+
+        with self.lock:
+            if mtime == self.mtime: # Another thread already rescanned
+                return
+            self.mtime = mtime # Anything renamed during the scan triggers another one
+
+            present = set()
+            for filename in os.listdir(self.directory):
+                if not filename.endswith(".pem"):
+                    continue
+                path = os.path.join(self.directory, filename)
+                try:
+                    s = os.stat(path)
+                except OSError: # Renamed in the meanwhile
+                    continue
+                present.add(filename)
+                prev = self.stats.get(filename)
+                if prev and (prev.st_ino, prev.st_mtime, prev.st_size) == (s.st_ino, s.st_mtime, s.st_size):
+                    continue
+                with open(path) as fh:
+                    buf = fh.read()
+                    header, _, der_bytes = pem.unarmor(buf)
+                    self.add(path, buf, x509.Certificate.load(der_bytes))
+
+            for filename in set(self.by_filename) - present:
+                self.discard(filename)
+
+    def changed(self, entry):
+        """
+        Return recorded revocation time of the entry
+        or inode change time if it's missing
+        """
+        return self.changes[os.path.basename(entry.path)]
+
+    def get(self, common_name):
+        self.refresh()
+        return self.by_filename.get(common_name + ".pem")
+
+    def page(self, key, position=None, reverse=False, limit=100, accept=lambda entry:True):
+        """
+        Return up to limit accepted entries following the (value, filename)
+        position in the order of the sort key along with their positions
+        """
+        self.refresh()
+        with self.lock:
+            index = self.sorted[key]
+            if reverse:
+                offsets = xrange((bisect_left(index, position) if position else len(index)) - 1, -1, -1)
+            else:
+                offsets = xrange(bisect_right(index, position) if position else 0, len(index))
+            entries = []
+            for offset in offsets:
+                if len(entries) >= limit:
+                    break
+                entry = self.by_filename[index[offset][1]]
+                if accept(entry):
+                    entries.append((index[offset], entry))
+            return entries
+
+    def find(self, serial):
+        self.refresh()
+        return self.by_serial.get(serial)
+
+    def __iter__(self):
+        self.refresh()
+        return iter(self.by_filename.values())
+
+    def __len__(self):
+        self.refresh()
+        return len(self.by_filename)
+
+signed_inventory = Inventory(config.SIGNED_DIR)
+revoked_inventory = Inventory(config.REVOKED_DIR)
+
+
 def list_requests(directory=config.REQUESTS_DIR):
     for filename in os.listdir(directory):
         if filename.endswith(".pem"):
@@ -175,57 +528,388 @@ def list_requests(directory=config.REQUESTS_DIR):
             path, buf, req = get_request(common_name)
             yield common_name, path, buf, req, server_flags(common_name),
 
-def _list_certificates(directory):
-    for filename in os.listdir(directory):
-        if filename.endswith(".pem"):
-            common_name = filename[:-4]
-            path = os.path.join(directory, filename)
-            with open(path) as fh:
-                buf = fh.read()
-                header, _, der_bytes = pem.unarmor(buf)
-                cert = x509.Certificate.load(der_bytes)
-                server = False
-                for extension in cert["tbs_certificate"]["extensions"]:
-                    if extension["extn_id"].native == u"extended_key_usage":
-                        if u"server_auth" in extension["extn_value"].native:
-                            server = True
-                yield common_name, path, buf, cert, server
-
 def list_signed():
-    return _list_certificates(config.SIGNED_DIR)
+    return iter(signed_inventory)
 
 def list_revoked():
-    return _list_certificates(config.REVOKED_DIR)
+    return iter(revoked_inventory)
 
 def list_server_names():
-    return [cn for cn, path, buf, cert, server in list_signed() if server]
+    return [entry.common_name for entry in signed_inventory if entry.server]
+
+class RevocationList(object):
+    """
+    Signed certificate revocation list kept in memory and in the meta
+    directory, it's signed again once half of the revocation list lifetime
+    has passed. If delta CRL-s are enabled newly revoked certificates are
+    published via delta CRL until there are threshold worth of them,
+    otherwise the list is signed again whenever a certificate is revoked
+    """
+    def __init__(self, directory, prefix="crl", lifetime=config.REVOCATION_LIST_LIFETIME):
+        self.der_path = os.path.join(directory, prefix + ".der")
+        self.pem_path = os.path.join(directory, prefix + ".pem")
+        self.number_path = os.path.join(directory, "crl_number") # Shared by complete and delta CRL-s
+        self.lifetime = lifetime
+        self.der = None
+        self.pem = None
+        self.number = None
+        self.delta_of = None
+        self.next_update = None
+        self.serials = None
+        self.generation = None
+        self.expires = None
+        self.lock = threading.Lock()
+
+    def revoked(self, now):
+        for entry in revoked_inventory:
+            if entry.expires < now:
+                continue # Expired certificates may be omitted as per RFC5280
+            yield entry.serial_number, revoked_inventory.changed(entry)
+
+    def fresh(self, now):
+        return self.der and \
+            now < self.next_update - timedelta(seconds=self.lifetime / 2)
+
+    def earliest_expiry(self):
+        """
+        Return expiration time of the first listed certificate to expire
+        """
+        return min([entry.expires for entry in revoked_inventory
+            if entry.serial_number in self.serials] or [None])
+
+    def load(self, now):
+        """
+        Adopt CRL previously written to disk if it's still current
+        """
+        from asn1crypto.crl import CertificateList
+        try:
+            with open(self.der_path, "rb") as fh:
+                certificate_list = CertificateList.load(fh.read())
+        except EnvironmentError:
+            return
+        tbs = certificate_list["tbs_cert_list"]
+        if tbs["issuer"].dump() != certificate.subject.dump():
+            return # Authority certificate has been replaced
+        self.serials = set([j["user_certificate"] for j in tbs["revoked_certificates"].native or ()])
+        self.der, self.pem = certificate_list.dump(), pem_armor_crl(certificate_list)
+        self.number = certificate_list.crl_number_value.native
+        self.delta_of = certificate_list.delta_crl_indicator_value.native \
+            if certificate_list.delta_crl_indicator_value else None
+        self.next_update = tbs["next_update"].native.replace(tzinfo=None)
+        self.expires = self.earliest_expiry()
+        if self.serials == set([serial for serial, revoked_at in self.revoked(now)]):
+            self.generation = revoked_inventory.generation
+
+    def increment(self):
+        """
+        Bump CRL number persisted on disk, shared with other processes
+        """
+        directory = os.path.dirname(self.number_path)
+        try:
+            os.makedirs(directory)
+        except OSError: # Already exists
+            pass
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                with open(self.number_path) as fh:
+                    number = int(fh.read()) + 1
+            except EnvironmentError:
+                number = 2 # Prior releases always used 1
+            with open(self.number_path + ".part", "w") as fh:
+                fh.write("%d\n" % number)
+            os.rename(self.number_path + ".part", self.number_path)
+        finally:
+            os.close(fd)
+        return number
+
+    def write(self, path, buf):
+        with open(path + ".part", "wb") as fh:
+            fh.write(buf)
+        os.rename(path + ".part", path)
+
+    def prepare(self, builder):
+        if config.AUTHORITY_DELTA_CRL_URL:
+            builder.delta_crl_url = config.AUTHORITY_DELTA_CRL_URL
+
+    def build(self, now):
+        self.number = self.increment()
+        builder = CertificateListBuilder(
+            config.AUTHORITY_CRL_URL,
+            certificate,
+            self.number)
+        builder.this_update = now
+        builder.next_update = now + timedelta(seconds=self.lifetime)
+        self.prepare(builder)
+        serials = set()
+        for serial_number, revoked_at in self.revoked(now):
+            builder.add_certificate(serial_number, revoked_at, u"key_compromise")
+            serials.add(serial_number)
+        generation = revoked_inventory.generation
+
+        certificate_list = builder.build(private_key)
+        self.der, self.pem = certificate_list.dump(), pem_armor_crl(certificate_list)
+        self.delta_of = builder.delta_of
+        self.next_update = builder.next_update
+        self.serials = serials
+        self.generation = generation
+        self.expires = self.earliest_expiry()
+        self.write(self.der_path, self.der)
+        self.write(self.pem_path, self.pem)
+        click.echo("Generated revocation list #%d" % self.number)
+
+    def export(self, pem=True):
+        with self.lock:
+            now = datetime.utcnow()
+            if self.der is None:
+                self.load(now)
+            revoked_inventory.refresh()
+            if not self.fresh(now):
+                self.build(now)
+            elif self.generation != revoked_inventory.generation:
+                pending = set([serial for serial, revoked_at in self.revoked(now)]) - self.serials
+                if not config.AUTHORITY_DELTA_CRL_URL or \
+                        len(pending) >= config.DELTA_REVOCATION_LIST_THRESHOLD:
+                    self.build(now)
+                else: # Delta CRL covers pending revocations
+                    self.generation = revoked_inventory.generation
+            return self.pem if pem else self.der
+
+
+class DeltaRevocationList(RevocationList):
+    """
+    Delta CRL listing only certificates revoked since the complete CRL
+    was signed, certificates drop off once they expire
+    """
+    def __init__(self, directory, base):
+        RevocationList.__init__(self, directory, "delta_crl", config.DELTA_REVOCATION_LIST_LIFETIME)
+        self.base = base
+
+    def revoked(self, now):
+        for serial_number, revoked_at in RevocationList.revoked(self, now):
+            if serial_number not in self.base.serials:
+                yield serial_number, revoked_at
+
+    def prepare(self, builder):
+        builder.delta_of = self.base.number
+
+    def export(self, pem=True):
+        self.base.export() # Make sure base is current
+        with self.lock:
+            now = datetime.utcnow()
+            if self.der is None:
+                self.load(now)
+            revoked_inventory.refresh()
+            if not self.fresh(now) or self.delta_of != self.base.number or \
+                    self.generation != revoked_inventory.generation or \
+                    (self.expires and self.expires < now):
+                self.build(now)
+            return self.pem if pem else self.der
+
+revocation_list = RevocationList(config.META_DIR)
+delta_revocation_list = DeltaRevocationList(config.META_DIR, revocation_list)
 
 def export_crl(pem=True):
-    builder = CertificateListBuilder(
-        config.AUTHORITY_CRL_URL,
-        certificate,
-        1 # TODO: monotonically increasing
-    )
-
-    for filename in os.listdir(config.REVOKED_DIR):
-        if not filename.endswith(".pem"):
-            continue
-        serial_number = filename[:-4]
-        # TODO: Assert serial against regex
-        revoked_path = os.path.join(config.REVOKED_DIR, filename)
-        # TODO: Skip expired certificates
-        s = os.stat(revoked_path)
-        builder.add_certificate(
-            int(filename[:-4], 16),
-            datetime.utcfromtimestamp(s.st_ctime),
-            u"key_compromise")
-
-    certificate_list = builder.build(private_key)
-    if pem:
-        return pem_armor_crl(certificate_list)
-    return certificate_list.dump()
+    return revocation_list.export(pem)
 
+def export_delta_crl(pem=True):
+    return delta_revocation_list.export(pem)
 
+
+def write_atomic(path, buf):
+    """
+    Write file via temporary file so readers never see partial content
+    """
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(path + ".part", "wb") as fh:
+        fh.write(buf)
+    os.rename(path + ".part", path)
+
+def ocsp_status(serial):
+    """
+    Resolve certificate status by serial number for OCSP responder
+    """
+    if signed_inventory.find(serial):
+        return ocsp.CertStatus(name="good", value=None)
+    entry = revoked_inventory.find(serial)
+    if entry:
+        return ocsp.CertStatus(
+            name="revoked",
+            value={
+                "revocation_time": revoked_inventory.changed(entry),
+                "revocation_reason": u"key_compromise",
+            })
+    return ocsp.CertStatus(name="unknown", value=None)
+
+def sign_ocsp_response(serials, now, response_extensions=()):
+    responses = []
+    for serial in serials:
+        responses.append({
+            "cert_id": {
+                "hash_algorithm": {
+                    "algorithm": u"sha1"
+                },
+                "issuer_name_hash": certificate.subject.sha1,
+                "issuer_key_hash": certificate.public_key.sha1,
+                "serial_number": serial,
+            },
+            "cert_status": ocsp_status(serial),
+            "this_update": now,
+            "next_update": now + timedelta(seconds=config.OCSP_RESPONSE_LIFETIME),
+            "single_extensions": []
+        })
+
+    response_data = ocsp.ResponseData({
+        "responder_id": ocsp.ResponderId(name="by_key", value=certificate.public_key.sha1),
+        "produced_at": now,
+        "responses": responses,
+        "response_extensions": list(response_extensions)
+    })
+
+    return ocsp.OCSPResponse({
+        "response_status": u"successful",
+        "response_bytes": {
+            "response_type": u"basic_ocsp_response",
+            "response": {
+                "tbs_response_data": response_data,
+                "certs": [certificate],
+                "signature_algorithm": {"algorithm": u"sha1_rsa"},
+                "signature": asymmetric.rsa_pkcs1v15_sign(
+                    private_key,
+                    response_data.dump(),
+                    "sha1"
+                )
+            }
+        }
+    }).dump()
+
+
+class OCSPResponseStore(object):
+    """
+    Pre-signed OCSP responses for requests without nonce as per RFC5019,
+    responses are signed again once half of their lifetime has passed
+    or the status of the certificate changes. Signed responses are also
+    written to the export directory under the request path computed for
+    the serial so nginx could serve them
+    """
+    def __init__(self, lifetime, export_dir=""):
+        self.lifetime = lifetime
+        self.export_dir = export_dir
+        self.responses = {}
+
+    def fresh(self, now, next_update):
+        return now < next_update - timedelta(seconds=self.lifetime / 2)
+
+    def sign(self, serial, now):
+        status = ocsp_status(serial)
+        der = sign_ocsp_response((serial,), now)
+        next_update = now + timedelta(seconds=self.lifetime)
+        if status.name != "unknown": # Don't let random serials fill up memory
+            self.responses[serial] = status.name, now, next_update, der
+            self.export(serial)
+        return der, now, next_update
+
+    def export(self, serial):
+        """
+        Write pre-signed response to the export directory, base64 encoded
+        request path may contain slashes hence subdirectories are created
+        """
+        if self.export_dir and serial in self.responses:
+            write_atomic(os.path.join(self.export_dir, ocsp_request_path(serial)),
+                self.responses[serial][-1])
+
+    def get(self, serial):
+        now = datetime.now(timezone.utc)
+        try:
+            status, this_update, next_update, der = self.responses[serial]
+        except KeyError:
+            pass
+        else:
+            if self.fresh(now, next_update) and status == ocsp_status(serial).name:
+                return der, this_update, next_update
+        return self.sign(serial, now)
+
+    def invalidate(self, serial):
+        self.responses.pop(serial, None)
+        if self.export_dir:
+            try:
+                os.unlink(os.path.join(self.export_dir, ocsp_request_path(serial)))
+            except OSError:
+                pass
+
+    def refresh(self):
+        """
+        Sign responses for server certificates and the ones about to expire
+        """
+        now = datetime.now(timezone.utc)
+        serials = set([entry.serial_number for entry in signed_inventory if entry.server])
+        for serial, (status, this_update, next_update, der) in self.responses.items():
+            if not self.fresh(now, next_update) or status != ocsp_status(serial).name:
+                serials.add(serial)
+            else:
+                serials.discard(serial)
+        for serial in serials:
+            self.sign(serial, now)
+
+    def run(self):
+        """
+        Refresh responses periodically, to be run in a background thread
+        """
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception(u"Failed to refresh pre-signed OCSP responses")
+            sleep(self.lifetime / 4)
+
+ocsp_responses = OCSPResponseStore(config.OCSP_RESPONSE_LIFETIME, config.OCSP_EXPORT_DIR)
+
+def ocsp_request_path(serial):
+    """
+    Return base64 encoded OCSP request for the serial as submitted
+    via GET by clients without nonce, eg. openssl ocsp -no_nonce
+    """
+    return b64encode(ocsp.OCSPRequest({
+        "tbs_request": {
+            "request_list": [{
+                "req_cert": {
+                    "hash_algorithm": {
+                        "algorithm": u"sha1"
+                    },
+                    "issuer_name_hash": certificate.subject.sha1,
+                    "issuer_key_hash": certificate.public_key.sha1,
+                    "serial_number": serial
+                }
+            }]
+        }
+    }).dump())
+
+def publish_static(serials=None):
+    """
+    Write CA certificate, revocation lists and pre-signed OCSP responses
+    to the static export directory so nginx could serve them directly,
+    if no serials are specified responses for all certificates are exported
+    """
+    if not config.STATIC_EXPORT_DIR:
+        return
+    write_atomic(os.path.join(config.STATIC_EXPORT_DIR, "ca_crt.pem"), certificate_buf)
+    write_atomic(os.path.join(config.STATIC_EXPORT_DIR, "crl.der"), export_crl(pem=False))
+    write_atomic(os.path.join(config.STATIC_EXPORT_DIR, "crl.pem"), export_crl())
+    if config.AUTHORITY_DELTA_CRL_URL:
+        write_atomic(os.path.join(config.STATIC_EXPORT_DIR, "delta_crl.der"), export_delta_crl(pem=False))
+        write_atomic(os.path.join(config.STATIC_EXPORT_DIR, "delta_crl.pem"), export_delta_crl())
+    if serials is None:
+        serials = [entry.serial_number for entry in signed_inventory] + \
+            [serial for serial, revoked in revocation_list.revoked(datetime.utcnow())]
+    for serial in serials:
+        ocsp_responses.get(serial)
+        ocsp_responses.export(serial)
+
+
+@serialized
 def delete_request(common_name):
     # Validate CN
     if not re.match(RE_HOSTNAME, common_name):
@@ -235,24 +919,22 @@ def delete_request(common_name):
     os.unlink(path)
 
     # Publish event at CA channel
-    push.publish("request-deleted", common_name)
+    push.publish("request-deleted", common_name,
+        generation=changelog.bump("request-deleted", common_name))
 
     # Write empty certificate to long-polling URL
-    requests.delete(
+    outbox.request("DELETE",
         config.LONG_POLL_PUBLISH % hashlib.sha256(buf).hexdigest(),
         headers={"User-Agent": "Certidude API"})
 
+@serialized
 def sign(common_name, overwrite=False):
     """
     Sign certificate signing request by it's common name
     """
 
     req_path = os.path.join(config.REQUESTS_DIR, common_name + ".pem")
-    with open(req_path) as fh:
-        csr_buf = fh.read()
-        header, _, der_bytes = pem.unarmor(csr_buf)
-        csr = CertificationRequest.load(der_bytes)
-
+    csr_buf, csr, s = parsed_cache.load(req_path, CertificationRequest.load)
 
     # Sign with function below
     cert, buf = _sign(csr, csr_buf, overwrite)
@@ -260,6 +942,7 @@ def sign(common_name, overwrite=False):
     os.unlink(req_path)
     return cert, buf
 
+@serialized
 def _sign(csr, buf, overwrite=False):
     # TODO: CRLDistributionPoints, OCSP URL, Certificate URL
 
@@ -279,22 +962,23 @@ def _sign(csr, buf, overwrite=False):
 
     # Move existing certificate if necessary
     if os.path.exists(cert_path):
-        with open(cert_path) as fh:
-            prev_buf = fh.read()
-            header, _, der_bytes = pem.unarmor(prev_buf)
-            prev = x509.Certificate.load(der_bytes)
+        prev_buf, prev, s = parsed_cache.load(cert_path, x509.Certificate.load)
 
-            # TODO: assert validity here again?
-            renew = \
-                asymmetric.load_public_key(prev["tbs_certificate"]["subject_public_key_info"]) == \
-                csr_pubkey
-                # BUGBUG: is this enough?
+        # TODO: assert validity here again?
+        renew = \
+            asymmetric.load_public_key(prev["tbs_certificate"]["subject_public_key_info"]) == \
+            csr_pubkey
+            # BUGBUG: is this enough?
 
         if overwrite:
             # TODO: is this the best approach?
             prev_serial_hex = "%x" % prev.serial_number
             revoked_path = os.path.join(config.REVOKED_DIR, "%s.pem" % prev_serial_hex)
             os.rename(cert_path, revoked_path)
+            store_revocation_time(revoked_path)
+            signed_inventory.discard(cert_path)
+            revoked_inventory.add(revoked_path, prev_buf, prev)
+            ocsp_responses.invalidate(prev.serial_number)
             attachments += [(prev_buf, "application/x-pem-file", "deprecated.crt" if renew else "overwritten.crt")]
             overwritten = True
         else:
@@ -326,8 +1010,10 @@ def _sign(csr, buf, overwrite=False):
     end_entity_cert_buf = asymmetric.dump_certificate(end_entity_cert)
     with open(cert_path + ".part", "wb") as fh:
         fh.write(end_entity_cert_buf)
+    store_fingerprints(cert_path + ".part", end_entity_cert_buf)
 
     os.rename(cert_path + ".part", cert_path)
+    signed_inventory.add(cert_path, end_entity_cert_buf, end_entity_cert)
     attachments.append((end_entity_cert_buf, "application/x-pem-file", common_name + ".crt"))
     cert_serial_hex = "%x" % end_entity_cert.serial_number
 
@@ -339,10 +1025,15 @@ def _sign(csr, buf, overwrite=False):
     # Copy filesystem attributes to newly signed certificate
     if revoked_path:
         for key in listxattr(revoked_path):
-            if not key.startswith("user."):
+            if not key.startswith("user.") or key.startswith("user.fingerprint.") or \
+                    key.startswith("user.revocation."):
                 continue
             setxattr(cert_path, key, getxattr(revoked_path, key))
 
+    # Export CRL and OCSP responses for nginx
+    publish_static((prev.serial_number, end_entity_cert.serial_number)
+        if overwritten else (end_entity_cert.serial_number,))
+
     # Send mail
     if renew: # Same keypair
         mailer.send("certificate-renewed.md", **locals())
@@ -351,8 +1042,9 @@ def _sign(csr, buf, overwrite=False):
 
     url = config.LONG_POLL_PUBLISH % hashlib.sha256(buf).hexdigest()
     click.echo("Publishing certificate at %s ..." % url)
-    requests.post(url, data=end_entity_cert_buf,
+    outbox.request("POST", url, end_entity_cert_buf,
         headers={"User-Agent": "Certidude API", "Content-Type": "application/x-x509-user-cert"})
 
-    push.publish("request-signed", common_name)
+    push.publish("request-signed", common_name,
+        generation=changelog.bump("request-signed", common_name))
     return end_entity_cert, end_entity_cert_buf
@@ -0,0 +1,115 @@
+
+import fcntl
+import os
+from certidude import config
+from collections import deque
+from threading import Lock
+
+class ChangeLog(object):
+    """
+    Authority-wide generation counter shared by server workers and command
+    line invocations. Every mutation is appended to a log file in the meta
+    directory along with its generation, processes pick up records of
+    others by reading the file from where they left off
+    """
+    def __init__(self, path, size=10000):
+        self.path = path
+        self.size = size # Records kept in memory and in the log after compaction
+        self.inode = None
+        self.offset = 0
+        self.generation = 0
+        self.records = deque(maxlen=size)
+        self.lock = Lock()
+
+    def open(self, operation):
+        """
+        Open and lock the log, retry if it was compacted meanwhile
+        """
+        while True:
+            fh = open(self.path, "a+")
+            fcntl.flock(fh.fileno(), operation)
+            if os.fstat(fh.fileno()).st_ino == os.stat(self.path).st_ino:
+                return fh
+            fh.close()
+
+    def read(self, fh):
+        s = os.fstat(fh.fileno())
+        if s.st_ino != self.inode: # Compacted by another process
+            self.inode = s.st_ino
+            self.offset = 0
+            self.records.clear()
+        fh.seek(self.offset)
+        buf = fh.read()
+        buf = buf[:buf.rfind("\n") + 1] # Skip incomplete line
+        self.offset += len(buf)
+        for line in buf.splitlines():
+            generation, event_type, common_name = line.split(" ", 2)
+            self.generation = int(generation)
+            self.records.append((self.generation, event_type, common_name.decode("utf-8")))
+
+    def compact(self):
+        with open(self.path + ".part", "w") as fh:
+            for generation, event_type, common_name in self.records:
+                fh.write("%d %s %s\n" % (generation, event_type, common_name.encode("utf-8")))
+        os.rename(self.path + ".part", self.path)
+
+    def refresh(self):
+        try:
+            s = os.stat(self.path)
+        except OSError: # Nothing recorded yet
+            return
+        with self.lock:
+            if (s.st_ino, s.st_size) == (self.inode, self.offset):
+                return
+            with self.open(fcntl.LOCK_SH) as fh:
+                self.read(fh)
+
+    def bump(self, event_type, common_name):
+        """
+        Record mutation of the request or certificate, return its generation
+        """
+        return self.bump_many(event_type, (common_name,))
+
+    def bump_many(self, event_type, common_names):
+        """
+        Record same mutation of several certificates at once,
+        return generation of the last one
+        """
+        with self.lock:
+            with self.open(fcntl.LOCK_EX) as fh:
+                self.read(fh)
+                generation = self.generation
+                lines = []
+                for common_name in common_names:
+                    generation += 1
+                    lines.append("%d %s %s\n" % (generation, event_type, common_name.encode("utf-8")))
+                fh.write("".join(lines))
+                fh.flush()
+                self.read(fh)
+                if self.offset > self.size * 128:
+                    self.compact()
+        return generation
+
+    def current(self):
+        self.refresh()
+        return self.generation
+
+    def since(self, generation):
+        """
+        Return records after given generation or None if some
+        of them are not available anymore
+        """
+        self.refresh()
+        with self.lock:
+            if generation > self.generation:
+                return None # Log was removed
+            if generation < self.generation and generation < self.records[0][0] - 1:
+                return None # Log was compacted
+            return [record for record in self.records if record[0] > generation]
+
+changelog = ChangeLog(os.path.join(config.META_DIR, "changes"))
+
+bump = changelog.bump
+bump_many = changelog.bump_many
+current = changelog.current
+since = changelog.since
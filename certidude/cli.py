@@ -1007,6 +1007,13 @@ def certidude_setup_authority(username, kerberos_keytab, nginx_config, country,
     static_path = os.path.join(os.path.realpath(os.path.dirname(__file__)), "static")
     certidude_path = sys.argv[0]
 
+    # Revocation list subnets are mirrored in nginx configuration
+    crl_subnets = "0.0.0.0/0"
+    if os.path.exists(const.CONFIG_PATH):
+        existing = ConfigParser()
+        existing.read(const.CONFIG_PATH)
+        crl_subnets = existing.get("authorization", "crl subnets", fallback=crl_subnets)
+
     click.echo("Generating: %s" % nginx_config.name)
     nginx_config.write(env.get_template("server/nginx.conf").render(vars()))
     nginx_config.close()
@@ -1039,6 +1046,7 @@ def certidude_setup_authority(username, kerberos_keytab, nginx_config, country,
     else:
         os.umask(0o137)
         push_token = "".join([random.choice(string.ascii_letters + string.digits) for j in range(0,32)])
+        session_secret = "".join([random.SystemRandom().choice(string.ascii_letters + string.digits) for j in range(0,64)])
         with open(const.CONFIG_PATH, "w") as fh:
             fh.write(env.get_template("server/server.conf").render(vars()))
         click.echo("Generated %s" % const.CONFIG_PATH)
@@ -1050,7 +1058,7 @@ def certidude_setup_authority(username, kerberos_keytab, nginx_config, country,
 
     # Create subdirectories with 770 permissions
     os.umask(0o007)
-    for subdir in ("signed", "signed/by-serial", "requests", "revoked", "expired", "meta"):
+    for subdir in ("signed", "signed/by-serial", "requests", "revoked", "expired", "meta", "meta/outbox"):
         path = os.path.join(directory, subdir)
         if not os.path.exists(path):
             click.echo("Creating directory %s" % path)
@@ -1154,10 +1162,10 @@ def certidude_list(verbose, show_key_type, show_extensions, show_path, show_sign
     def dump_common(common_name, path, cert):
         click.echo("certidude revoke %s" % common_name)
         with open(path, "rb") as fh:
-            buf = fh.read()
-            click.echo("md5sum: %s" % hashlib.md5(buf).hexdigest())
-            click.echo("sha1sum: %s" % hashlib.sha1(buf).hexdigest())
-            click.echo("sha256sum: %s" % hashlib.sha256(buf).hexdigest())
+            fingerprints = authority.get_fingerprints(path, fh.read())
+            click.echo("md5sum: %s" % fingerprints["md5sum"])
+            click.echo("sha1sum: %s" % fingerprints["sha1sum"])
+            click.echo("sha256sum: %s" % fingerprints["sha256sum"])
         click.echo()
 
     if not hide_requests:
@@ -1175,9 +1183,7 @@ def certidude_list(verbose, show_key_type, show_extensions, show_path, show_sign
 
 
     if show_signed:
-        for common_name, path, buf, cert, server in authority.list_signed():
-            signed = cert["tbs_certificate"]["validity"]["not_before"].native.replace(tzinfo=None)
-            expires = cert["tbs_certificate"]["validity"]["not_after"].native.replace(tzinfo=None)
+        for common_name, serial_number, signed, expires, server, path, sha256sum in authority.list_signed():
             if not verbose:
                 if signed < NOW and NOW < expires:
                     click.echo("v " + path)
@@ -1187,6 +1193,7 @@ def certidude_list(verbose, show_key_type, show_extensions, show_path, show_sign
                     click.echo("y " + path)
                 continue
             click.echo()
+            path, buf, cert = authority.get_signed(common_name)
             click.echo(click.style(common_name, fg="blue") + " " + click.style("%x" % cert.serial_number, fg="white"))
             click.echo("="*(len(common_name)+60))
 
@@ -1203,17 +1210,16 @@ def certidude_list(verbose, show_key_type, show_extensions, show_path, show_sign
                 print " - %s: %s" % (ext["extn_id"].native, repr(ext["extn_value"].native))
 
     if show_revoked:
-        for common_name, path, buf, cert, server in authority.list_revoked():
+        for common_name, serial_number, signed, expires, server, path, sha256sum in authority.list_revoked():
             if not verbose:
                 click.echo("r " + path)
                 continue
+            path, buf, cert, revoked = authority.get_revoked(serial_number)
             click.echo()
             click.echo(click.style(common_name, fg="blue") + " " + click.style("%x" % cert.serial_number, fg="white"))
             click.echo("="*(len(common_name)+60))
 
-            _, _, _, _, _, _, _, _, mtime, _ = os.stat(path)
-            changed = datetime.fromtimestamp(mtime)
-            click.echo("Status: " + click.style("revoked", fg="red") + " %s%s" % (naturaltime(NOW-changed), click.style(", %s" % changed, fg="white")))
+            click.echo("Status: " + click.style("revoked", fg="red") + " %s%s" % (naturaltime(NOW-revoked), click.style(", %s" % revoked, fg="white")))
             click.echo("openssl x509 -in %s -text -noout" % path)
             dump_common(common_name, path, cert)
             for ext in cert["tbs_certificate"]["extensions"]:
@@ -1237,26 +1243,83 @@ def certidude_revoke(common_name):
     authority.revoke(common_name)
 
 
+@click.command("tag", help="Add, replace or remove tags of signed certificates")
+@click.argument("common_names", nargs=-1)
+@click.option("--all", "-a", "all_of", multiple=True, help="Select certificates having all of these tags")
+@click.option("--any", "-o", "any_of", multiple=True, help="Select certificates having any of these tags")
+@click.option("--query", "-q", help="Select certificates with common name containing this")
+@click.option("--add", multiple=True, help="Add tag, eg. location=Tallinn")
+@click.option("--replace", multiple=True, help="Replace values of the key with this tag")
+@click.option("--remove", multiple=True, help="Remove tag, key=* removes all values of the key")
+def certidude_tag(common_names, all_of, any_of, query, add, replace, remove):
+    from certidude import tags
+    drop_privileges()
+    selected = tags.select(common_names, all_of, any_of, query)
+    if not selected:
+        raise ValueError("No certificates selected, specify common names or tags")
+    if not add and not replace and not remove:
+        for common_name in selected:
+            click.echo("%s: %s" % (common_name, ", ".join(tags.index.get(common_name)) or "-"))
+        return
+    results = tags.update(selected, add, remove, replace)
+    for common_name, status in results:
+        click.echo("%s: %s" % (common_name, status))
+    click.echo("Updated tags of %d certificates" % len([j for j in results if j[1] == "updated"]))
+
+
 @click.command("cron", help="Run from cron to manage Certidude server")
 def certidude_cron():
-    import itertools
+    from certidude import authority, changelog, config
+    drop_privileges()
+    for inventory in authority.signed_inventory, authority.revoked_inventory:
+        for entry in inventory:
+            if entry.expires < NOW:
+                expired_path = os.path.join(config.EXPIRED_DIR, "%x.pem" % entry.serial_number)
+                assert not os.path.exists(expired_path)
+                os.rename(entry.path, expired_path)
+                inventory.discard(entry.path)
+                if inventory is authority.signed_inventory:
+                    changelog.bump("certificate-expired", entry.common_name)
+                click.echo("Moved %s to %s" % (entry.path, expired_path))
+
+
+@click.command("publish-static", help="Export CA certificate, CRL and OCSP responses for nginx")
+def certidude_publish_static():
     from certidude import authority, config
-    for cn, path, buf, cert, server in itertools.chain(authority.list_signed(), authority.list_revoked()):
-        expires = cert["tbs_certificate"]["validity"]["not_after"].native.replace(tzinfo=None)
-        if expires < NOW:
-            expired_path = os.path.join(config.EXPIRED_DIR, "%x.pem" % cert.serial_number)
-            assert not os.path.exists(expired_path)
-            os.rename(path, expired_path)
-            click.echo("Moved %s to %s" % (path, expired_path))
+    if not config.STATIC_EXPORT_DIR:
+        raise ValueError("Static export directory not configured in %s" % const.CONFIG_PATH)
+    drop_privileges()
+    authority.publish_static()
+    click.echo("Exported CA certificate, revocation lists and OCSP responses to %s" % config.STATIC_EXPORT_DIR)
+
+
+@click.command("verify", help="Verify stored fingerprints of requests and certificates")
+@click.option("--fix", "-f", default=False, is_flag=True, help="Store recomputed fingerprints")
+def certidude_verify(fix):
+    from certidude import authority
+    drop_privileges()
+    mismatches = authority.verify_fingerprints(fix)
+    for path, algorithm, stored, computed in mismatches:
+        click.echo("%s: %s %s, computed %s%s" % (path, algorithm,
+            "missing" if stored is None else "stored %s" % stored, computed,
+            " (fixed)" if fix else ""))
+    if mismatches and not fix:
+        raise ValueError("Stored fingerprints of %d files differ, run with --fix to store recomputed ones" %
+            len(set([j[0] for j in mismatches])))
+    click.echo("Verified fingerprints of signing requests, signed and revoked certificates")
 
 
 @click.command("serve", help="Run server")
 @click.option("-p", "--port", default=8080, help="Listen port")
 @click.option("-l", "--listen", default="127.0.1.1", help="Listen address")
 @click.option("-f", "--fork", default=False, is_flag=True, help="Fork to background")
-def certidude_serve(port, listen, fork):
+@click.option("-t", "--threads", default=8, help="Worker threads per process, 8 by default")
+@click.option("-w", "--workers", default=1, help="Pre-forked worker processes, 1 by default")
+@click.option("-b", "--backlog", default=128, help="Listen backlog, 128 by default")
+@click.option("-m", "--max-requests", default=0, help="Requests served by worker process before it's replaced, unlimited by default")
+def certidude_serve(port, listen, fork, threads, workers, backlog, max_requests):
     import pwd
-    from certidude import authority, const, push
+    from certidude import authority, const, history, leases, outbox, push, sweeper, tags
 
     if port == 80:
         click.echo("WARNING: Please run Certidude behind nginx, remote address is assumed to be forwarded by nginx!")
@@ -1268,8 +1331,8 @@ def certidude_serve(port, listen, fork):
     from certidude import config
 
     # Rebuild reverse mapping
-    for cn, path, buf, cert, server in authority.list_signed():
-        by_serial = os.path.join(config.SIGNED_BY_SERIAL_DIR, "%x.pem" % cert.serial_number)
+    for cn, serial_number, signed, expires, server, path, sha256sum in authority.list_signed():
+        by_serial = os.path.join(config.SIGNED_BY_SERIAL_DIR, "%x.pem" % serial_number)
         if not os.path.exists(by_serial):
             click.echo("Linking %s to ../%s.pem" % (by_serial, cn))
             os.symlink("../%s.pem" % cn, by_serial)
@@ -1302,14 +1365,15 @@ def certidude_serve(port, listen, fork):
         level=logging.DEBUG)
 
     click.echo("Serving API at %s:%d" % (listen, port))
-    from wsgiref.simple_server import make_server, WSGIServer
     from certidude.api import certidude_app
+    from certidude.server import ThreadPoolWSGIServer, prefork
 
 
-    click.echo("Listening on %s:%d" % (listen, port))
+    click.echo("Listening on %s:%d with %d worker processes of %d threads" % (listen, port, workers, threads))
 
     app = certidude_app(log_handlers)
-    httpd = make_server(listen, port, app, WSGIServer)
+    httpd = ThreadPoolWSGIServer((listen, port), threads, backlog)
+    httpd.set_app(app)
 
 
     """
@@ -1337,7 +1401,14 @@ def certidude_serve(port, listen, fork):
         with open(const.SERVER_PID_PATH, "w") as pidfile:
             pidfile.write("%d\n" % pid)
 
+        def finalizer():
+            outbox.stop() # Deliver remaining notifications right away
+            push.aggregator.stop()
+            leases.stop()
+            history.stop()
+
         def cleanup_handler(*args):
+            finalizer()
             push.publish("server-stopped")
             logger.debug(u"Shutting down Certidude")
             sys.exit(0) # TODO: use another code, needs test refactor
@@ -1349,8 +1420,49 @@ def certidude_serve(port, listen, fork):
         logger.debug(u"Started Certidude at %s", const.FQDN)
 
         drop_privileges()
+
+        def initializer(index):
+            from threading import Thread
+
+            # Deliver e-mails and notifications in the background,
+            # only first worker process drains the spool directory
+            outbox.start(spool=index == 0)
+            push.aggregator.start()
+            leases.start() # Write leases behind in batches
+            tags.rebuild() # Index certificates by tag
+            if index == 0:
+                history.start() # Persist lease history once a minute
+                sweeper.start() # Publish online, offline and dead transitions
+
+            if config.OCSP_SUBNETS or config.STATIC_EXPORT_DIR:
+                # Keep pre-signed OCSP responses fresh in the background
+                refresher = Thread(target=authority.ocsp_responses.run)
+                refresher.daemon = True
+                refresher.start()
+
+            if config.STATIC_EXPORT_DIR and index == 0:
+                # Export everything at startup, refresh revocation lists periodically
+                def publisher():
+                    serials = None
+                    while True:
+                        try:
+                            authority.publish_static(serials)
+                        except Exception:
+                            logger.exception(u"Failed to export static files")
+                        serials = ()
+                        sleep(60)
+                exporter = Thread(target=publisher)
+                exporter.daemon = True
+                exporter.start()
+
         try:
-            httpd.serve_forever()
+            if workers > 1:
+                # Master process stays single threaded so it could fork safely
+                prefork(httpd, workers, max_requests, initializer, finalizer)
+            else:
+                initializer(0)
+                httpd.serve(max_requests)
+                cleanup_handler() # Served max requests, let service manager restart it
         except KeyboardInterrupt:
             cleanup_handler() # FIXME
 
@@ -1437,9 +1549,12 @@ entry_point.add_command(certidude_serve)
 entry_point.add_command(certidude_request)
 entry_point.add_command(certidude_sign)
 entry_point.add_command(certidude_revoke)
+entry_point.add_command(certidude_tag)
 entry_point.add_command(certidude_list)
 entry_point.add_command(certidude_users)
 entry_point.add_command(certidude_cron)
+entry_point.add_command(certidude_publish_static)
+entry_point.add_command(certidude_verify)
 entry_point.add_command(certidude_test)
 
 if __name__ == "__main__":
@@ -20,9 +20,15 @@ ACCOUNTS_BACKEND = cp.get("accounts", "backend")             # posix, ldap
 
 KERBEROS_KEYTAB = cp.get("authentication", "kerberos keytab")
 LDAP_AUTHENTICATION_URI = cp.get("authentication", "ldap uri")
+SESSION_LIFETIME = cp.getint("authentication", "session lifetime", fallback=0)
+SESSION_SECRET = cp.get("authentication", "session secret", fallback="")
+if SESSION_LIFETIME and not SESSION_SECRET: raise ValueError("No 'session secret' specified for signing session cookies")
 LDAP_GSSAPI_CRED_CACHE = cp.get("accounts", "ldap gssapi credential cache")
 LDAP_ACCOUNTS_URI = cp.get("accounts", "ldap uri")
 LDAP_BASE = cp.get("accounts", "ldap base")
+LDAP_POOL_SIZE = cp.getint("accounts", "ldap pool size", fallback=4)
+ACCOUNTS_CACHE_LIFETIME = cp.getint("accounts", "cache lifetime", fallback=300)
+ACCOUNTS_CACHE_SIZE = cp.getint("accounts", "cache size", fallback=1024)
 
 USER_SUBNETS = set([ipaddress.ip_network(j) for j in
     cp.get("authorization", "user subnets").split(" ") if j])
@@ -38,6 +44,8 @@ OCSP_SUBNETS = set([ipaddress.ip_network(j) for j in
     cp.get("authorization", "ocsp subnets").split(" ") if j])
 CRL_SUBNETS = set([ipaddress.ip_network(j) for j in
     cp.get("authorization", "crl subnets").split(" ") if j])
+LEASE_SUBNETS = set([ipaddress.ip_network(j) for j in
+    cp.get("authorization", "lease subnets", fallback="127.0.0.0/8 10.0.0.0/8 172.16.0.0/12 192.168.0.0/16").split(" ") if j])
 
 AUTHORITY_DIR = "/var/lib/certidude"
 AUTHORITY_PRIVATE_KEY_PATH = cp.get("authority", "private key path")
@@ -47,6 +55,17 @@ SIGNED_DIR = cp.get("authority", "signed dir")
 SIGNED_BY_SERIAL_DIR = os.path.join(SIGNED_DIR, "by-serial")
 REVOKED_DIR = cp.get("authority", "revoked dir")
 EXPIRED_DIR = cp.get("authority", "expired dir")
+META_DIR = cp.get("authority", "meta dir", fallback=os.path.join(
+    os.path.dirname(AUTHORITY_CERTIFICATE_PATH), "meta"))
+OUTBOX_DIR = cp.get("authority", "outbox dir", fallback=os.path.join(META_DIR, "outbox"))
+LEASE_FLUSH_INTERVAL = cp.getfloat("authority", "lease flush interval", fallback=1.0)
+LEASE_OFFLINE_TIMEOUT = cp.getint("authority", "lease offline timeout", fallback=600)
+LEASE_DEAD_TIMEOUT = cp.getint("authority", "lease dead timeout", fallback=604800)
+HISTORY_DIR = cp.get("authority", "history dir", fallback=os.path.join(META_DIR, "history"))
+HISTORY_RETENTION = dict( # Convert days to seconds
+    minute = cp.getint("authority", "history minute retention", fallback=1) * 86400,
+    hour = cp.getint("authority", "history hour retention", fallback=31) * 86400,
+    day = cp.getint("authority", "history day retention", fallback=730) * 86400)
 
 MAILER_NAME = cp.get("mailer", "name")
 MAILER_ADDRESS = cp.get("mailer", "address")
@@ -69,15 +88,23 @@ SERVER_CERTIFICATE_LIFETIME = cp.getint("signature", "server certificate lifetim
 AUTHORITY_CERTIFICATE_URL = cp.get("signature", "authority certificate url")
 AUTHORITY_CRL_URL = cp.get("signature", "revoked url")
 AUTHORITY_OCSP_URL = cp.get("signature", "responder url")
+OCSP_RESPONSE_LIFETIME = cp.getint("signature", "responder lifetime", fallback=60) * 60 # Convert minutes to seconds
+STATIC_EXPORT_DIR = cp.get("signature", "static export dir", fallback="")
+OCSP_EXPORT_DIR = cp.get("signature", "responder export dir",
+    fallback=os.path.join(STATIC_EXPORT_DIR, "ocsp") if STATIC_EXPORT_DIR else "")
 CERTIFICATE_RENEWAL_ALLOWED = cp.getboolean("signature", "renewal allowed")
 
-REVOCATION_LIST_LIFETIME = cp.getint("signature", "revocation list lifetime")
+REVOCATION_LIST_LIFETIME = cp.getint("signature", "revocation list lifetime") # Seconds
+AUTHORITY_DELTA_CRL_URL = cp.get("signature", "delta revoked url", fallback="")
+DELTA_REVOCATION_LIST_LIFETIME = cp.getint("signature", "delta revocation list lifetime", fallback=60) * 60 # Convert minutes to seconds
+DELTA_REVOCATION_LIST_THRESHOLD = cp.getint("signature", "delta revocation list threshold", fallback=1000)
 
 EVENT_SOURCE_TOKEN = cp.get("push", "event source token")
 EVENT_SOURCE_PUBLISH = cp.get("push", "event source publish")
 EVENT_SOURCE_SUBSCRIBE = cp.get("push", "event source subscribe")
 LONG_POLL_PUBLISH = cp.get("push", "long poll publish")
 LONG_POLL_SUBSCRIBE = cp.get("push", "long poll subscribe")
+PUSH_BATCH_WINDOW = cp.getfloat("push", "batch window", fallback=1.0)
 
 LOGGING_BACKEND = cp.get("logging", "backend")
 
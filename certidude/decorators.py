@@ -1,4 +1,5 @@
 import click
+import hashlib
 import ipaddress
 import json
 import logging
@@ -71,9 +72,76 @@ def serialize(func):
             logger.debug(u"Client did not accept application/json")
             raise falcon.HTTPUnsupportedMediaType(
                 "Client did not accept application/json")
-        resp.set_header("Cache-Control", "no-cache, no-store, must-revalidate")
-        resp.set_header("Pragma", "no-cache")
-        resp.set_header("Expires", "0")
+        if not req.context.get("conditional"):
+            resp.set_header("Cache-Control", "no-cache, no-store, must-revalidate")
+            resp.set_header("Pragma", "no-cache")
+            resp.set_header("Expires", "0")
         resp.body = json.dumps(func(instance, req, resp, **kwargs), cls=MyEncoder)
     return wrapped
 
+def stat_validator(path):
+    """
+    Derive version of the resource from inode and modification time of the file
+    """
+    try:
+        st = os.stat(path)
+    except EnvironmentError:
+        return None
+    return "%x-%x" % (st.st_ino, int(st.st_mtime * 1000000)), datetime.utcfromtimestamp(st.st_mtime)
+
+def conditional(validator):
+    """
+    Conditional GET support, validator returns version and modification time
+    of the resource or None if it does not exist. It's derived from
+    inventory, change log or file metadata before the responder is run,
+    so client which already has the representation gets 304 Not Modified
+    without the body being generated. Strong ETag is derived from
+    the version and the negotiated representation
+    """
+    import falcon
+    from falcon.util import dt_to_http, http_date_to_dt
+    def decorator(func):
+        def wrapped(instance, req, resp, *args, **kwargs):
+            validated = validator(req, *args, **kwargs)
+            if not validated:
+                return func(instance, req, resp, *args, **kwargs)
+            version, last_modified = validated
+            etag = "\"%s\"" % hashlib.sha1((u"%s;%s;%s" % (version,
+                req.get_header("Accept") or "", req.query_string)).encode("utf-8")).hexdigest()
+
+            def validators():
+                resp.set_header("ETag", etag)
+                resp.append_header("Vary", "Accept")
+                # Browser may keep the response, but has to revalidate it
+                resp.set_header("Cache-Control", "private, no-cache" if req.context.get("user") else "no-cache")
+                if last_modified:
+                    resp.set_header("Last-Modified", dt_to_http(last_modified))
+
+            # If-None-Match takes precedence as per RFC7232
+            if_none_match = req.get_header("If-None-Match")
+            if if_none_match:
+                tags = [j.strip() for j in if_none_match.split(",")]
+                not_modified = "*" in tags or etag in [j[2:] if j.startswith("W/") else j for j in tags]
+            elif last_modified and req.get_header("If-Modified-Since"):
+                try:
+                    since = http_date_to_dt(req.get_header("If-Modified-Since"))
+                except ValueError:
+                    not_modified = False
+                else:
+                    not_modified = last_modified.replace(microsecond=0) <= since
+            else:
+                not_modified = False
+
+            if not_modified:
+                validators()
+                resp.status = falcon.HTTP_304
+                resp.body = None
+                return
+
+            req.context["conditional"] = True # Caching headers are set here
+            retval = func(instance, req, resp, *args, **kwargs)
+            if resp.status == falcon.HTTP_200:
+                validators()
+            return retval
+        return wrapped
+    return decorator
@@ -42,22 +42,18 @@ def whitelist_content_types(*content_types):
 
 def whitelist_subject(func):
     def wrapped(self, req, resp, cn, *args, **kwargs):
-        from ipaddress import ip_address
-        from certidude import authority
-        from xattr import getxattr
+        from certidude import authority, leases
         try:
             path, buf, cert = authority.get_signed(cn)
         except IOError:
             raise falcon.HTTPNotFound()
         else:
-            try:
-                inner_address = getxattr(path, "user.lease.inner_address").decode("ascii")
-            except IOError:
+            lease = leases.find(req.context.get("remote_addr"))
+            if not lease:
                 raise falcon.HTTPForbidden("Forbidden", "Remote address %s not whitelisted" % req.context.get("remote_addr"))
+            elif lease.common_name != cn:
+                raise falcon.HTTPForbidden("Forbidden", "Remote address %s mismatch" % req.context.get("remote_addr"))
             else:
-                if req.context.get("remote_addr") != ip_address(inner_address):
-                    raise falcon.HTTPForbidden("Forbidden", "Remote address %s mismatch" % req.context.get("remote_addr"))
-                else:
-                   return func(self, req, resp, cn, *args, **kwargs)
+                return func(self, req, resp, cn, *args, **kwargs)
     return wrapped
 
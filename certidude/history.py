@@ -0,0 +1,280 @@
+
+import calendar
+import click
+import os
+from certidude import config, leases
+from collections import defaultdict, deque
+from datetime import datetime
+from threading import Lock, Thread
+from time import sleep, time
+
+RESOLUTIONS = (("minute", 60), ("hour", 3600), ("day", 86400))
+
+class LeaseHistory(object):
+    """
+    Concurrent clients per gateway and per client sessions derived from
+    lease records. Client is considered online for offline timeout seconds
+    after each report, per minute counts are rolled up into per hour and
+    per day buckets carrying peak and mean concurrency. Buckets and sessions
+    older than retention are discarded, so memory, files and queries stay
+    bounded. Every server process keeps history of its own by following
+    the lease log, only one of them writes it to the history directory
+    """
+    def __init__(self, directory, retention, offline):
+        self.directory = directory
+        self.retention = retention
+        self.offline = offline
+        self.watermark = None # Minutes before this one are final
+        self.pending = defaultdict(int) # (minute, gateway) -> clients online
+        self.coverage = {} # common name -> (gateway, first minute not covered, last report)
+        self.buckets = dict([(resolution, deque()) for resolution, _ in RESOLUTIONS])
+        self.unwritten = dict([(resolution, []) for resolution, _ in RESOLUTIONS])
+        self.sessions = {} # common name -> deque of [gateway, start, end]
+        self.written = {} # (common name, start) -> (gateway, end) of persisted sessions
+        self.writer = False
+        self.loaded = False
+        self.lock = Lock()
+
+    def path(self, name):
+        return os.path.join(self.directory, name + ".log")
+
+    def load(self):
+        """
+        Load persisted history and replay current leases,
+        called with lease store lock held
+        """
+        self.loaded = True
+        now = int(time())
+        try:
+            with open(os.path.join(self.directory, "watermark")) as fh:
+                self.watermark = int(fh.read())
+        except (IOError, ValueError): # Not written yet
+            self.watermark = now - now % 60
+        for resolution, _ in RESOLUTIONS:
+            try:
+                with open(self.path(resolution)) as fh:
+                    for line in fh:
+                        start, gateway, peak, mean = line.split()
+                        if int(start) >= now - self.retention[resolution]:
+                            self.buckets[resolution].append((int(start), gateway, int(peak), float(mean)))
+            except IOError: # No history yet
+                pass
+        try:
+            with open(self.path("sessions")) as fh:
+                for line in fh: # Resumed sessions are written again
+                    common_name, gateway, start, end = line.split()
+                    self.written[(common_name.decode("utf-8"), int(start))] = gateway, int(end)
+        except IOError: # No history yet
+            pass
+        for (common_name, start), (gateway, end) in sorted(self.written.items(), key=lambda j:j[0][1]):
+            if end >= now - self.retention["hour"]:
+                self.sessions.setdefault(common_name, deque()).append([gateway, start, end])
+        for lease in leases.store.by_common_name.values():
+            self.apply(lease)
+
+    def record(self, lease):
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            else:
+                self.apply(lease)
+
+    def apply(self, lease):
+        timestamp = calendar.timegm(lease.last_seen.utctimetuple())
+        gateway = lease.gateway or "-"
+        minute = timestamp - timestamp % 60
+        until = minute + self.offline - self.offline % 60
+        prev_gateway, prev_until, prev_timestamp = self.coverage.get(lease.common_name, (None, 0, 0))
+        if until <= self.watermark or timestamp <= prev_timestamp: # Already accounted for
+            return
+
+        # Count client only once per minute
+        if prev_gateway == gateway:
+            start = max(minute, prev_until, self.watermark)
+            until = max(until, prev_until)
+        else:
+            for j in range(max(minute, self.watermark), prev_until, 60): # Moved to another gateway
+                self.pending[(j, prev_gateway)] -= 1
+            start = max(minute, self.watermark)
+        for j in range(start, until, 60):
+            self.pending[(j, gateway)] += 1
+        self.coverage[lease.common_name] = gateway, until, timestamp
+
+        # Extend current session or start a new one
+        sessions = self.sessions.setdefault(lease.common_name, deque())
+        if sessions and sessions[-1][0] == gateway and timestamp <= sessions[-1][2] + self.offline:
+            sessions[-1][2] = timestamp
+        else:
+            sessions.append([gateway, timestamp, timestamp])
+
+    def rollup(self, finer, start, length, finer_length):
+        """
+        Aggregate finer buckets within the period starting at given time,
+        missing buckets count as periods without any clients
+        """
+        peaks, totals = defaultdict(int), defaultdict(float)
+        for bucket_start, gateway, peak, mean in reversed(finer):
+            if bucket_start < start:
+                break
+            if bucket_start < start + length:
+                peaks[gateway] = max(peaks[gateway], peak)
+                totals[gateway] += mean
+        return [(start, gateway, peaks[gateway], totals[gateway] * finer_length / length)
+            for gateway in sorted(peaks)]
+
+    def advance(self, now):
+        """
+        Finalize minutes that have passed, roll them up into hours and
+        days and discard buckets and sessions older than retention
+        """
+        current = now - now % 60
+        added = dict([(resolution, []) for resolution, _ in RESOLUTIONS])
+        if current <= self.watermark:
+            return
+
+        for minute, gateway in sorted(key for key in self.pending if key[0] < current):
+            count = self.pending.pop((minute, gateway))
+            if count > 0:
+                added["minute"].append((minute, gateway, count, float(count)))
+        self.buckets["minute"].extend(added["minute"])
+
+        for index, (resolution, length) in enumerate(RESOLUTIONS[1:], 1):
+            finer, finer_length = RESOLUTIONS[index - 1]
+            start = max(self.watermark, now - self.retention[resolution])
+            start -= start % length
+            while start + length <= current:
+                if start + length > self.watermark: # Period completed by this advance
+                    added[resolution].extend(self.rollup(self.buckets[finer], start, length, finer_length))
+                start += length
+            self.buckets[resolution].extend(added[resolution])
+
+        if self.writer:
+            for resolution, _ in RESOLUTIONS:
+                self.unwritten[resolution].extend(added[resolution])
+
+        for resolution, _ in RESOLUTIONS:
+            buckets = self.buckets[resolution]
+            while buckets and buckets[0][0] < now - self.retention[resolution]:
+                buckets.popleft()
+        for common_name, sessions in self.sessions.items():
+            while sessions and sessions[0][2] < now - self.retention["hour"]:
+                sessions.popleft()
+            if not sessions:
+                del self.sessions[common_name]
+                self.coverage.pop(common_name, None)
+        self.watermark = current
+
+    def write(self, now):
+        """
+        Append new buckets and sessions to history files,
+        files are compacted once a day
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        compact = bool(self.unwritten["day"])
+        for resolution, _ in RESOLUTIONS:
+            with open(self.path(resolution) + (".part" if compact else ""), "w" if compact else "a") as fh:
+                fh.write("".join(["%d %s %d %.3f\n" % bucket for bucket in
+                    (self.buckets[resolution] if compact else self.unwritten[resolution])]))
+            if compact:
+                os.rename(self.path(resolution) + ".part", self.path(resolution))
+            del self.unwritten[resolution][:]
+
+        # Sessions are written once they're over and once more if they were resumed
+        lines = []
+        for common_name, sessions in self.sessions.items():
+            for gateway, start, end in sessions:
+                if end + self.offline > now or self.written.get((common_name, start)) == (gateway, end):
+                    continue
+                self.written[(common_name, start)] = gateway, end
+                lines.append("%s %s %d %d\n" % (common_name.encode("utf-8"), gateway, start, end))
+        if compact:
+            self.written = dict([(key, value) for key, value in self.written.items()
+                if value[1] >= now - self.retention["hour"]])
+            with open(self.path("sessions") + ".part", "w") as fh:
+                fh.write("".join(["%s %s %d %d\n" % (common_name.encode("utf-8"), gateway, start, end)
+                    for (common_name, start), (gateway, end) in sorted(self.written.items(), key=lambda j:j[0][1])]))
+            os.rename(self.path("sessions") + ".part", self.path("sessions"))
+        elif lines:
+            with open(self.path("sessions"), "a") as fh:
+                fh.write("".join(lines))
+
+        with open(os.path.join(self.directory, "watermark.part"), "w") as fh:
+            fh.write("%d" % self.watermark)
+        os.rename(os.path.join(self.directory, "watermark.part"), os.path.join(self.directory, "watermark"))
+
+    def refresh(self):
+        """
+        Catch up with the lease log and finalize passed minutes
+        """
+        leases.store.refresh()
+        with leases.store.lock:
+            with self.lock:
+                if not self.loaded:
+                    self.load()
+                self.advance(int(time()))
+
+    def concurrency(self, resolution, since=None, until=None, gateway=None):
+        """
+        Return peak and mean amount of clients online per gateway
+        """
+        self.refresh()
+        with self.lock:
+            return [dict(start=datetime.utcfromtimestamp(start), gateway=bucket_gateway, peak=peak, mean=mean)
+                for start, bucket_gateway, peak, mean in self.buckets[resolution]
+                if (since is None or start >= since) and (until is None or start < until)
+                    and (gateway is None or bucket_gateway == gateway)]
+
+    def timeline(self, common_name, since=None, until=None):
+        """
+        Return sessions of the client, session is considered over once
+        client hasn't reported for offline timeout seconds
+        """
+        self.refresh()
+        now = time()
+        with self.lock:
+            return [dict(
+                gateway = gateway,
+                start = datetime.utcfromtimestamp(start),
+                end = datetime.utcfromtimestamp(end),
+                duration = end - start,
+                online = end + self.offline > now)
+                for gateway, start, end in self.sessions.get(common_name, ())
+                if (since is None or end >= since) and (until is None or start < until)]
+
+    def run(self, interval=60):
+        while True:
+            sleep(interval - time() % interval + 1) # Shortly after minute has passed
+            try:
+                self.refresh()
+                with self.lock:
+                    self.write(int(time()))
+            except Exception as e:
+                click.echo("Failed to write lease history: %s" % e)
+
+    def start(self):
+        """
+        Write history in a background thread,
+        only one process should write history
+        """
+        self.writer = True
+        worker = Thread(target=self.run)
+        worker.daemon = True
+        worker.start()
+
+    def stop(self):
+        """
+        Write finalized minutes before process exits
+        """
+        if self.writer:
+            self.refresh()
+            with self.lock:
+                self.write(int(time()))
+
+history = LeaseHistory(config.HISTORY_DIR, config.HISTORY_RETENTION, config.LEASE_OFFLINE_TIMEOUT)
+leases.store.listeners.append(history.record)
+
+concurrency = history.concurrency
+timeline = history.timeline
+start = history.start
+stop = history.stop
@@ -0,0 +1,239 @@
+
+import click
+import fcntl
+import os
+from certidude import config
+from collections import namedtuple, OrderedDict
+from datetime import datetime
+from threading import Event, RLock, Thread
+from time import sleep
+from xattr import getxattr
+
+Lease = namedtuple("Lease", ("common_name", "inner_address", "outer_address", "last_seen", "gateway"))
+
+class LeaseStore(object):
+    """
+    Leases reported by gateways, kept in memory and persisted in an
+    append-only log in the meta directory. Updates are written behind in
+    batches by a background thread of the server, processes without the
+    thread write them right away. Other processes pick up the records by
+    reading the log from where they left off, the log is compacted to
+    one record per client once it has grown large enough
+    """
+    def __init__(self, path, interval=1.0, threshold=1048576):
+        self.path = path
+        self.interval = interval
+        self.threshold = threshold
+        self.by_common_name = {}
+        self.by_inner_address = {}
+        self.pending = OrderedDict()
+        self.inode = None
+        self.offset = 0
+        self.migrated = False
+        self.running = False
+        self.wakeup = Event()
+        self.lock = RLock()
+        self.listeners = [] # Called with every record read from the log
+
+    def apply(self, lease):
+        """
+        Update lookup tables, records are applied in the order of last seen
+        timestamp regardless of which process wrote them first
+        """
+        prev = self.by_common_name.get(lease.common_name)
+        if prev:
+            if prev.last_seen > lease.last_seen:
+                return
+            if self.by_inner_address.get(prev.inner_address) == prev.common_name:
+                del self.by_inner_address[prev.inner_address]
+        self.by_common_name[lease.common_name] = lease
+        self.by_inner_address[lease.inner_address] = lease.common_name
+
+    def dump(self, lease):
+        """
+        Serialize lease as log record, raise ValueError if
+        any of the fields would break the record
+        """
+        fields = (lease.common_name.encode("utf-8"), lease.inner_address.encode("ascii"),
+            lease.outer_address.encode("ascii"), lease.last_seen.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            (lease.gateway or "-").encode("ascii"))
+        for field in fields:
+            if not field or len(field.split()) != 1 or field.strip() != field:
+                raise ValueError("Malformed lease field %s" % repr(field))
+        return "%s %s %s %s %s\n" % fields
+
+    def dumps(self, leases):
+        """
+        Serialize leases, malformed ones are dropped so they wouldn't
+        block writing the rest of them
+        """
+        lines = []
+        for lease in leases:
+            try:
+                lines.append(self.dump(lease))
+            except ValueError as e:
+                click.echo("Dropping lease of %s: %s" % (repr(lease.common_name), e))
+        return "".join(lines)
+
+    def open(self, operation):
+        """
+        Open and lock the log, retry if it was compacted meanwhile
+        """
+        while True:
+            fh = open(self.path, "a+")
+            fcntl.flock(fh.fileno(), operation)
+            if os.fstat(fh.fileno()).st_ino == os.stat(self.path).st_ino:
+                return fh
+            fh.close()
+
+    def read(self, fh):
+        s = os.fstat(fh.fileno())
+        if s.st_ino != self.inode: # Compacted by another process, records are applied again
+            self.inode = s.st_ino
+            self.offset = 0
+        fh.seek(self.offset)
+        buf = fh.read()
+        buf = buf[:buf.rfind("\n") + 1] # Skip incomplete line
+        self.offset += len(buf)
+        for line in buf.splitlines():
+            common_name, inner_address, outer_address, last_seen, gateway = line.split(" ")
+            lease = Lease(common_name.decode("utf-8"), inner_address.decode("ascii"),
+                outer_address.decode("ascii"), datetime.strptime(last_seen, "%Y-%m-%dT%H:%M:%S.%fZ"),
+                None if gateway == "-" else gateway.decode("ascii"))
+            self.apply(lease)
+            for listener in self.listeners:
+                listener(lease)
+
+    def migrate(self):
+        """
+        Import leases stored as extended attributes by earlier versions
+        """
+        self.migrated = True
+        if not os.path.exists(config.SIGNED_DIR):
+            return
+        leases = []
+        for filename in os.listdir(config.SIGNED_DIR):
+            if not filename.endswith(".pem"):
+                continue
+            path = os.path.join(config.SIGNED_DIR, filename)
+            try:
+                leases.append(Lease(filename[:-4].decode("utf-8"),
+                    getxattr(path, "user.lease.inner_address").decode("ascii"),
+                    getxattr(path, "user.lease.outer_address").decode("ascii"),
+                    datetime.strptime(getxattr(path, "user.lease.last_seen"), "%Y-%m-%dT%H:%M:%S.%fZ"),
+                    None))
+            except IOError: # No such attribute(s)
+                continue
+        with self.lock:
+            with self.open(fcntl.LOCK_EX) as fh:
+                if not os.fstat(fh.fileno()).st_size: # Not migrated by another process
+                    fh.write(self.dumps(leases))
+                    fh.flush()
+                self.read(fh)
+
+    def refresh(self):
+        try:
+            s = os.stat(self.path)
+        except OSError: # No leases recorded yet
+            if not self.migrated:
+                self.migrate()
+            return
+        self.migrated = True
+        with self.lock:
+            if (s.st_ino, s.st_size) == (self.inode, self.offset):
+                return
+            with self.open(fcntl.LOCK_SH) as fh:
+                self.read(fh)
+
+    def compact(self):
+        with open(self.path + ".part", "w") as fh:
+            fh.write(self.dumps(self.by_common_name.values()))
+        os.rename(self.path + ".part", self.path)
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            buf = self.dumps(self.pending.values())
+            self.pending.clear()
+            with self.open(fcntl.LOCK_EX) as fh:
+                self.read(fh)
+                fh.write(buf)
+                fh.flush()
+                self.read(fh)
+                if self.offset > self.threshold and self.offset > 256 * len(self.by_common_name):
+                    self.compact()
+
+    def update(self, leases):
+        """
+        Record leases, they're visible to this process right away and
+        to others once written to the log
+        """
+        self.refresh()
+        with self.lock:
+            for lease in leases:
+                try:
+                    self.dump(lease)
+                except ValueError as e: # Would break the log for every process
+                    click.echo("Dropping lease of %s: %s" % (repr(lease.common_name), e))
+                    continue
+                self.apply(lease)
+                self.pending.pop(lease.common_name, None)
+                self.pending[lease.common_name] = lease
+        if self.running:
+            self.wakeup.set()
+        else:
+            self.flush()
+
+    def get(self, common_name):
+        self.refresh()
+        return self.by_common_name.get(common_name)
+
+    def snapshot(self):
+        """
+        Return leases by common name for looking up many of them at once
+        """
+        self.refresh()
+        with self.lock:
+            return dict(self.by_common_name)
+
+    def find(self, inner_address):
+        """
+        Look up lease by the address assigned to the client by gateway
+        """
+        self.refresh()
+        common_name = self.by_inner_address.get(unicode(inner_address))
+        if common_name:
+            return self.by_common_name.get(common_name)
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            sleep(self.interval) # Let updates pile up meanwhile
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                click.echo("Failed to write leases: %s" % e)
+
+    def start(self):
+        self.running = True
+        worker = Thread(target=self.run)
+        worker.daemon = True
+        worker.start()
+
+    def stop(self):
+        """
+        Write pending leases and subsequent ones right away
+        """
+        self.running = False
+        self.flush()
+
+store = LeaseStore(os.path.join(config.META_DIR, "leases"), config.LEASE_FLUSH_INTERVAL)
+
+get = store.get
+find = store.find
+snapshot = store.snapshot
+update = store.update
+start = store.start
+stop = store.stop
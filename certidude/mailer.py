@@ -2,6 +2,7 @@
 import click
 import os
 import smtplib
+from certidude import outbox
 from certidude.user import User
 from markdown import markdown
 from jinja2 import Environment, PackageLoader
@@ -44,6 +45,11 @@ def send(template, to=None, include_admins=True, attachments=(), **context):
         msg.attach(part)
 
     if config.MAILER_ADDRESS:
-        click.echo("Sending to: %s" % msg["to"])
-        conn = smtplib.SMTP("localhost")
-        conn.sendmail(config.MAILER_ADDRESS, [u.mail for u in recipients], msg.as_string())
+        click.echo("Queueing mail to: %s" % msg["to"])
+        outbox.mail(config.MAILER_ADDRESS, [u.mail for u in recipients], msg.as_string())
+
+def deliver(sender, recipients, message):
+    click.echo("Sending to: %s" % ", ".join(recipients))
+    conn = smtplib.SMTP("localhost", timeout=30)
+    conn.sendmail(sender, recipients, message)
+    conn.quit()
@@ -0,0 +1,167 @@
+
+import click
+import fcntl
+import itertools
+import json
+import os
+from base64 import b64decode, b64encode
+from collections import deque
+from certidude import config
+from threading import Event, Thread
+from time import time
+
+class Outbox(object):
+    """
+    Spool directory of pending side effects such as e-mails, push
+    notifications and long-poll publishes. Jobs are delivered by a background
+    thread of the server with retries and exponential backoff, processes
+    without the thread deliver jobs right away and leave failed ones
+    for the server to retry. Jobs may limit the amount of attempts,
+    eg. push events are attempted once as they'd be stale by the retry
+    """
+    def __init__(self, directory, attempts=12, max_backoff=3600, clock=time):
+        self.directory = directory
+        self.attempts = attempts
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.pending = deque() # Jobs which need not to survive restart
+        self.wakeup = Event()
+        self.running = False
+        self.counter = itertools.count()
+
+    def deliver(self, job):
+        if job["type"] == "mail":
+            from certidude import mailer
+            mailer.deliver(job["sender"], job["recipients"], b64decode(job["message"]))
+        elif job["type"] == "http":
+            from certidude import push
+            push.deliver(job["method"], job["url"], b64decode(job["data"]), job["headers"])
+        else:
+            raise ValueError("Unknown job type %s" % repr(job["type"]))
+
+    def enqueue(self, job, durable=True):
+        if not durable:
+            if self.running:
+                self.pending.append(job)
+                self.wakeup.set()
+            else:
+                self.attempt(job)
+            return
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, "%017.6f-%d-%d.json" % (
+            self.clock(), os.getpid(), next(self.counter)))
+        with open(path + ".part", "w") as fh:
+            json.dump(job, fh)
+        os.rename(path + ".part", path)
+
+        if self.running:
+            self.wakeup.set()
+        else:
+            self.process(path)
+
+    def attempt(self, job):
+        try:
+            self.deliver(job)
+        except Exception as e:
+            click.echo("Failed to deliver %s job: %s" % (job["type"], e))
+            return False
+        return True
+
+    def process(self, path):
+        """
+        Attempt to deliver spooled job, the job file is locked
+        so other processes would skip it meanwhile
+        """
+        try:
+            fh = open(path)
+        except IOError: # Delivered by another process
+            return
+        with fh:
+            try:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError: # Being delivered by another process
+                return
+            if not os.fstat(fh.fileno()).st_nlink: # Delivered while we were waiting
+                return
+            job = json.load(fh)
+            if job.get("retry", 0) > self.clock():
+                return
+            if self.attempt(job):
+                os.unlink(path)
+                return
+            job["attempts"] = job.get("attempts", 0) + 1
+            if job["attempts"] >= job.get("max_attempts", self.attempts):
+                click.echo("Giving up on %s after %d attempts" % (path, job["attempts"]))
+                os.unlink(path)
+                return
+            job["retry"] = self.clock() + min(2 ** job["attempts"], self.max_backoff)
+            with open(path + ".part", "w") as part:
+                json.dump(job, part)
+            os.rename(path + ".part", path)
+
+    def drain(self):
+        while self.pending:
+            self.attempt(self.pending.popleft())
+        if not os.path.exists(self.directory):
+            return
+        for filename in sorted(os.listdir(self.directory)):
+            if filename.endswith(".json"):
+                self.process(os.path.join(self.directory, filename))
+
+    def run(self, spool=True):
+        while True:
+            self.wakeup.wait(1) # Poll spool for jobs from other processes
+            self.wakeup.clear()
+            try:
+                if spool:
+                    self.drain()
+                else:
+                    while self.pending:
+                        self.attempt(self.pending.popleft())
+            except Exception as e:
+                click.echo("Failed to process outbox: %s" % e)
+
+    def start(self, spool=True):
+        """
+        Start delivering jobs in a background thread,
+        only one process should drain the spool directory
+        """
+        self.running = True
+        worker = Thread(target=self.run, args=(spool,))
+        worker.daemon = True
+        worker.start()
+
+    def stop(self):
+        """
+        Deliver queued and subsequent jobs right away, eg. while shutting down
+        """
+        self.running = False
+        while self.pending:
+            self.attempt(self.pending.popleft())
+
+    def mail(self, sender, recipients, message):
+        self.enqueue(dict(type="mail", sender=sender, recipients=recipients,
+            message=b64encode(message)))
+
+    def request(self, method, url, data="", headers={}, durable=True, attempts=None):
+        job = dict(type="http", method=method, url=url,
+            data=b64encode(data), headers=headers)
+        if attempts:
+            job["max_attempts"] = attempts
+        self.enqueue(job, durable)
+
+outbox = Outbox(config.OUTBOX_DIR)
+mailbox = Outbox(os.path.join(config.OUTBOX_DIR, "mail")) # Stalled relay won't hold up HTTP jobs
+
+mail = mailbox.mail
+request = outbox.request
+
+def start(spool=True):
+    outbox.start(spool)
+    mailbox.start(spool)
+
+def stop():
+    outbox.stop()
+    mailbox.stop()
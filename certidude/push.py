@@ -2,38 +2,219 @@
 import click
 import json
 import logging
+import os
 import requests
 from datetime import datetime
-from certidude import config
+from certidude import config, outbox
+from collections import OrderedDict
+from threading import Event, Lock, Thread
+from time import time
 
 
-def publish(event_type, event_data=''):
+class PushSession(object):
     """
-    Publish event on nchan EventSource publisher
+    Keep-alive connections to push server shared by threads of the process.
+    After consecutive connection failures requests fail right away until
+    cooldown has passed, then a single request is let through to probe
+    the push server so callers wouldn't pile up waiting for timeouts
+    """
+    def __init__(self, timeout=(3, 10), pool_size=16, threshold=5, cooldown=30, clock=time):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.failures = 0
+        self.opened = 0
+        self.probing = False
+        self.pid = None
+        self.session = None
+        self.lock = Lock()
+
+    def connect(self):
+        """
+        Set up connection pool for the current process
+        """
+        session = requests.Session()
+        session.mount("http://", requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_size))
+        session.mount("https://", requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_size))
+        return session
+
+    def request(self, method, url, **kwargs):
+        with self.lock:
+            probe = self.failures >= self.threshold
+            if probe and (self.probing or self.clock() < self.opened + self.cooldown):
+                raise EnvironmentError("Push server unreachable, %d consecutive connection errors" % self.failures)
+            if probe:
+                self.probing = True
+            if self.pid != os.getpid(): # Don't share sockets with forked processes
+                self.session = self.connect()
+                self.pid = os.getpid()
+            session = self.session
+        try:
+            response = session.request(method, url, timeout=self.timeout, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            with self.lock:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self.opened = self.clock()
+            raise
+        else:
+            with self.lock:
+                self.failures = 0
+        finally:
+            if probe:
+                with self.lock:
+                    self.probing = False
+        return response
+
+session = PushSession()
+
+
+# Flush windows in seconds per event type, events not listed here
+# are buffered for 'batch window' seconds as configured
+FLUSH_POLICIES = {
+    "request-submitted": 0,
+    "request-signed": 0,
+    "certificate-revoked": 0,
+    "server-started": 0,
+    "server-stopped": 0
+}
+
+def coalesce(spans):
+    """
+    Merge generation spans of mutations, gaps are signalled
+    by span without beginning
+    """
+    if not spans:
+        return None
+    spans = sorted(spans)
+    for (_, previous), (since, _) in zip(spans, spans[1:]):
+        if since != previous:
+            return None, spans[-1][1]
+    return spans[0][0], spans[-1][1]
+
+
+class EventAggregator(object):
+    """
+    Buffer events of the same type for a short while, identical events
+    are published once and the rest are published as one event
+    carrying list of common names and generations of the mutations
+    """
+    def __init__(self, window, policies):
+        self.window = window
+        self.policies = policies
+        self.batches = {}
+        self.deadlines = {}
+        self.spans = {}
+        self.running = False
+        self.lock = Lock()
+        self.wakeup = Event()
+
+    def buffered(self, event_type):
+        return self.running and self.policies.get(event_type, self.window) > 0
+
+    def add(self, event_type, event_data, span=None):
+        with self.lock:
+            batch = self.batches.get(event_type)
+            if batch is None:
+                batch = self.batches[event_type] = OrderedDict()
+                self.deadlines[event_type] = time() + self.policies.get(event_type, self.window)
+                self.spans[event_type] = []
+                self.wakeup.set()
+            batch[event_data] = True
+            if span:
+                self.spans[event_type].append(span)
+
+    def flush(self, force=False):
+        now = time()
+        with self.lock:
+            due = [event_type for event_type, deadline in self.deadlines.items()
+                if force or deadline <= now]
+            batches = [(event_type, list(self.batches.pop(event_type)),
+                coalesce(self.spans.pop(event_type))) for event_type in due]
+            for event_type in due:
+                del self.deadlines[event_type]
+        for event_type, items, span in batches:
+            _publish(event_type, items[0] if len(items) == 1 else items, span)
+
+    def run(self):
+        while True:
+            with self.lock:
+                timeout = min(self.deadlines.values()) - time() if self.deadlines else None
+            if timeout is None or timeout > 0:
+                self.wakeup.wait(timeout)
+                self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                click.echo("Failed to publish buffered events: %s" % e)
+
+    def start(self):
+        self.running = True
+        worker = Thread(target=self.run)
+        worker.daemon = True
+        worker.start()
+
+    def stop(self):
+        """
+        Publish buffered events and subsequent ones right away
+        """
+        self.running = False
+        self.flush(force=True)
+
+aggregator = EventAggregator(config.PUSH_BATCH_WINDOW, FLUSH_POLICIES)
+
+
+def publish(event_type, event_data='', durable=True, generation=None):
+    """
+    Publish event on nchan EventSource publisher. Events of mutations carry
+    the generation preceding and the generation of the last mutation, one
+    generation is bumped per common name. Other events carry no generation.
+    Common names are buffered by the aggregator while server is running
     """
     assert event_type, "No event type specified"
 
-    if not isinstance(event_data, basestring):
-        from certidude.decorators import MyEncoder
-        event_data = json.dumps(event_data, cls=MyEncoder)
+    span = None
+    if generation is not None:
+        span = generation - (len(event_data) if isinstance(event_data, list) else 1), generation
+    if isinstance(event_data, basestring) and aggregator.buffered(event_type):
+        aggregator.add(event_type, event_data, span)
+    else:
+        _publish(event_type, event_data, span, durable)
+
+
+def _publish(event_type, event_data, span=None, durable=True):
+    from certidude.decorators import MyEncoder
+    payload = dict(data=event_data)
+    if span:
+        payload["since"], payload["generation"] = span
+    event_data = json.dumps(payload, cls=MyEncoder)
 
     url = config.EVENT_SOURCE_PUBLISH % config.EVENT_SOURCE_TOKEN
     click.echo("Publishing %s event '%s' on %s" % (event_type, event_data, url))
+    outbox.request("POST", url, event_data,
+        headers={"X-EventSource-Event": event_type, "User-Agent": "Certidude API"},
+        durable=durable, attempts=1) # Web interface catches up via change feed
 
-    try:
-        notification = requests.post(
-            url,
-            data=event_data,
-            headers={"X-EventSource-Event": event_type, "User-Agent": "Certidude API"})
-        if notification.status_code == requests.codes.created:
-            pass # Sent to client
-        elif notification.status_code == requests.codes.accepted:
-            pass # Buffered in nchan
-        else:
-            click.echo("Failed to submit event to push server, server responded %d" % (
-                notification.status_code))
-    except requests.exceptions.ConnectionError:
-        click.echo("Failed to submit event to push server, connection error")
+
+def deliver(method, url, data, headers):
+    """
+    Submit request to push server, connection errors and server errors
+    are raised so the outbox would retry
+    """
+    notification = session.request(method, url, data=data, headers=headers)
+    if notification.status_code == requests.codes.created:
+        pass # Sent to client
+    elif notification.status_code == requests.codes.accepted:
+        pass # Buffered in nchan
+    elif notification.status_code >= 500:
+        raise EnvironmentError("Push server responded %d" % notification.status_code)
+    elif notification.status_code >= 300:
+        click.echo("Failed to submit %s to push server, server responded %d" % (
+            url, notification.status_code))
 
 
 class EventSourceLogHandler(logging.Handler):
@@ -44,5 +225,5 @@ class EventSourceLogHandler(logging.Handler):
         publish("log-entry", dict(
             created = datetime.utcfromtimestamp(record.created),
             message = record.msg % record.args,
-            severity = record.levelname.lower()))
+            severity = record.levelname.lower()), durable=False)
 
@@ -0,0 +1,100 @@
+
+import logging
+import os
+import signal
+from Queue import Queue
+from threading import Thread
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+logger = logging.getLogger(__name__)
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """
+    WSGI server handing accepted connections over to a fixed pool of
+    worker threads. Once all threads are busy connections queue up
+    in the listen backlog of the kernel
+    """
+    def __init__(self, server_address, threads=8, backlog=128):
+        self.request_queue_size = backlog
+        self.threads = threads
+        self.queue = Queue(threads)
+        self.served = 0
+        WSGIServer.__init__(self, server_address, WSGIRequestHandler)
+
+    def process_request(self, request, client_address):
+        self.served += 1
+        self.queue.put((request, client_address))
+
+    def work(self):
+        while True:
+            request, client_address = self.queue.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                self.queue.task_done()
+
+    def serve(self, max_requests=0):
+        """
+        Serve until specified amount of connections has been accepted,
+        threads are started here so the server could be forked beforehand
+        """
+        for j in range(self.threads):
+            worker = Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+        while not max_requests or self.served < max_requests:
+            self.handle_request()
+        self.queue.join() # Finish requests in progress
+
+
+def prefork(server, workers, max_requests=0, initializer=None, finalizer=None):
+    """
+    Fork worker processes sharing the listening socket of the server,
+    worker processes exiting after serving max_requests are replaced.
+    Initializer is called with worker index in the forked process,
+    finalizer before the worker process exits or is terminated
+    """
+    children = {}
+    previous_handler = signal.getsignal(signal.SIGTERM)
+
+    def terminate(*args):
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        if callable(previous_handler):
+            previous_handler(*args)
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    def finalize(*args):
+        try:
+            if finalizer:
+                finalizer()
+        except Exception:
+            logger.exception(u"Worker process %d failed to finalize", os.getpid())
+            os._exit(1)
+        os._exit(0)
+
+    while True:
+        for index in set(range(workers)) - set(children.values()):
+            pid = os.fork()
+            if not pid:
+                signal.signal(signal.SIGTERM, finalize)
+                try:
+                    if initializer:
+                        initializer(index)
+                    server.serve(max_requests)
+                except Exception:
+                    logger.exception(u"Worker process %d failed", os.getpid())
+                    os._exit(1)
+                finalize()
+            children[pid] = index
+        pid, status = os.wait()
+        children.pop(pid, None)
+        if status:
+            logger.warning(u"Worker process %d exited with status %d, replacing", pid, status)
+        else:
+            logger.debug(u"Worker process %d served %d requests, replacing", pid, max_requests)
@@ -74,8 +74,79 @@ function onTagFilterChanged() {
     console.info("New key is:", key);
 }
 
+function unwrap(session, handler, batch) {
+    // Events of mutations carry generations they span, buffered
+    // events carry list of common names which is handed over as-is to
+    // batch handlers. Authority generation is advanced
+    // only by the event following it, gaps are caught up with change feed
+    return function(e) {
+        var payload = JSON.parse(e.data);
+        if (payload.generation) {
+            session.latest = Math.max(session.latest || 0, payload.generation);
+            if (payload.generation <= session.authority.generation) {
+                return; // Already applied
+            }
+            if (session.resuming || payload.since !== session.authority.generation) {
+                console.info("Missed changes before generation", payload.generation);
+                return resume(session);
+            }
+            session.authority.generation = payload.generation;
+        }
+        if (batch || !(payload.data instanceof Array)) {
+            return handler({ data: payload.data, generation: payload.generation });
+        }
+        $.each(payload.data, function(index, data) {
+            handler({ data: data, generation: payload.generation });
+        });
+    }
+}
+
+function resume(session) {
+    // Catch up with changes missed while event stream was disconnected
+    // or events were received out of order
+    if (session.resuming) {
+        return;
+    }
+    session.resuming = true;
+    $.ajax({
+        method: "GET",
+        url: session.authority.collections.changes + "?since=" + session.authority.generation,
+        dataType: "json",
+        success: function(feed, status, xhr) {
+            if (feed.reset) {
+                location.reload();
+                return;
+            }
+            console.info("Applying", feed.changes.length, "changes up to generation", feed.generation);
+            session.authority.generation = Math.max(session.authority.generation, feed.generation);
+            $.each(feed.changes, function(index, change) {
+                var slug = normalizeCommonName(change.common_name);
+                $("#request-" + slug).remove();
+                $("#certificate-" + slug).remove();
+                if (change.request) {
+                    $("#pending_requests").prepend(
+                        nunjucks.render('views/request.html', { request: change.request }));
+                }
+                if (change.certificate) {
+                    $("#signed_certificates").prepend(
+                        nunjucks.render('views/signed.html', { certificate: change.certificate }));
+                }
+            });
+            $("time").timeago();
+            session.resuming = false;
+            if (session.latest > session.authority.generation) {
+                resume(session); // Events received meanwhile
+            }
+        },
+        error: function(response) {
+            session.resuming = false;
+            console.info("Failed to retrieve changes:", response);
+        }
+    });
+}
+
 function onLogEntry (e) {
-    var entry = JSON.parse(e.data);
+    var entry = e.data;
     if ($("#log_level_" + entry.severity).prop("checked")) {
         console.info("Received log entry:", entry);
         $("#log_entries").prepend(nunjucks.render("views/logentry.html", {
@@ -134,6 +205,36 @@ function onLeaseUpdate(e) {
     });
 }
 
+function onLeaseTransition(state) {
+    // Transitions carry all the clients that changed state,
+    // lease details are already on the page so nothing is fetched
+    return function(e) {
+        console.log("Leases went " + state + ":", e.data.length);
+        var common_names = {};
+        $.each(e.data, function(index, common_name) {
+            common_names[common_name] = true;
+        });
+        $("#signed_certificates > li").each(function() {
+            if (!common_names[$(this).attr("data-cn")]) {
+                return;
+            }
+            var $status = $(".status", this);
+            var $lease = $("span[data-state]", $status);
+            if (!$lease.length) {
+                return;
+            }
+            $status.html(nunjucks.render('views/status.html', {
+                certificate: {
+                    lease: {
+                        state: state,
+                        last_seen: $lease.attr("data-last-seen"),
+                        inner_address: $lease.attr("data-inner-address"),
+                        outer_address: $lease.attr("data-outer-address") }}}));
+            $("time", $status).timeago();
+        });
+    };
+}
+
 function onRequestSigned(e) {
     console.log("Request signed:", e.data);
     var slug = normalizeCommonName(e.data);
@@ -211,6 +312,91 @@ function onServerStopped() {
 
 }
 
+var COLLECTIONS = {
+    requests: { container: "#pending_requests", template: "views/request.html", name: "request" },
+    signed: { container: "#signed_certificates", template: "views/signed.html", name: "certificate", sort: "-common_name" },
+    revoked: { container: "#revoked_certificates", template: "views/revoked.html", name: "certificate" }
+};
+
+function collectionURL(session, collection, query) {
+    var params = [];
+    if (COLLECTIONS[collection].sort) {
+        params.push("sort=" + COLLECTIONS[collection].sort);
+    }
+    if (query) {
+        params.push("q=" + encodeURIComponent(query));
+    }
+    return session.authority.collections[collection] + (params.length ? "?" + params.join("&") : "");
+}
+
+function fetchCollections(session, callback) {
+    // Only first page of each collection is rendered,
+    // following ones are loaded on scroll
+    if (!session.authority) {
+        return callback(session);
+    }
+    session.authority.next = {};
+    var collections = Object.keys(COLLECTIONS);
+    var fetchFirst = function(index) {
+        if (index == collections.length) {
+            return callback(session);
+        }
+        var collection = collections[index];
+        $.ajax({
+            method: "GET",
+            url: collectionURL(session, collection),
+            dataType: "json",
+            success: function(page, status, xhr) {
+                session.authority[collection] = page.items;
+                session.authority.next[collection] = page.next;
+                fetchFirst(index + 1);
+            },
+            error: function(response) {
+                console.info("Failed to retrieve collection:", collection, response);
+            }
+        });
+    }
+    fetchFirst(0);
+}
+
+function loadPage(session, collection, url, replace) {
+    // Render page of the collection, replacing or appending to entries shown
+    var options = COLLECTIONS[collection];
+    if (!url || (options.loading && !replace)) {
+        return;
+    }
+    var serial = options.serial = (options.serial || 0) + 1;
+    options.loading = true;
+    $.ajax({
+        method: "GET",
+        url: url,
+        dataType: "json",
+        success: function(page, status, xhr) {
+            if (serial != options.serial) {
+                return; // Superseded by search
+            }
+            session.authority.next[collection] = page.next;
+            if (replace) {
+                $(options.container + " .filterable").remove();
+            }
+            $.each(page.items, function(index, item) {
+                var context = {};
+                context[options.name] = item;
+                $(options.container).append(nunjucks.render(options.template, context));
+            });
+            $(options.container + " time").timeago();
+        },
+        error: function(response) {
+            console.info("Failed to retrieve collection:", url, response);
+        },
+        complete: function() {
+            if (serial == options.serial) {
+                options.loading = false;
+            }
+        }
+    });
+}
+
 $(document).ready(function() {
     console.info("Loading CA, to debug: curl " + window.location.href + " --negotiate -u : -H 'Accept: application/json'");
     $.ajax({
@@ -225,7 +411,7 @@ $(document).ready(function() {
             }
             $("#container").html(nunjucks.render('views/error.html', { message: msg }));
         },
-        success: function(session, status, xhr) {
+        success: function(session, status, xhr) { fetchCollections(session, function(session) {
             $("#login").hide();
 
             /**
@@ -251,16 +437,28 @@ $(document).ready(function() {
                     console.log("Received server-sent event:", event);
                 }
 
-                source.addEventListener("log-entry", onLogEntry);
-                source.addEventListener("lease-update", onLeaseUpdate);
-                source.addEventListener("request-deleted", onRequestDeleted);
-                source.addEventListener("request-submitted", onRequestSubmitted);
-                source.addEventListener("request-signed", onRequestSigned);
-                source.addEventListener("certificate-revoked", onCertificateRevoked);
-                source.addEventListener("tag-update", onTagUpdated);
-                source.addEventListener("attribute-update", onAttributeUpdated);
-                source.addEventListener("server-started", onServerStarted);
-                source.addEventListener("server-stopped", onServerStopped);
+                var connected = false;
+                source.onopen = function(event) {
+                    if (connected) {
+                        console.info("Reconnected to event source, resuming from generation", session.authority.generation);
+                        resume(session);
+                    }
+                    connected = true;
+                }
+
+                source.addEventListener("log-entry", unwrap(session, onLogEntry));
+                source.addEventListener("lease-update", unwrap(session, onLeaseUpdate));
+                source.addEventListener("lease-online", unwrap(session, onLeaseTransition("online"), true));
+                source.addEventListener("lease-offline", unwrap(session, onLeaseTransition("offline"), true));
+                source.addEventListener("lease-dead", unwrap(session, onLeaseTransition("dead"), true));
+                source.addEventListener("request-deleted", unwrap(session, onRequestDeleted));
+                source.addEventListener("request-submitted", unwrap(session, onRequestSubmitted));
+                source.addEventListener("request-signed", unwrap(session, onRequestSigned));
+                source.addEventListener("certificate-revoked", unwrap(session, onCertificateRevoked));
+                source.addEventListener("tag-update", unwrap(session, onTagUpdated));
+                source.addEventListener("attribute-update", unwrap(session, onAttributeUpdated));
+                source.addEventListener("server-started", unwrap(session, onServerStarted));
+                source.addEventListener("server-stopped", unwrap(session, onServerStopped));
 
                 console.info("Swtiching to requests section");
                 $("section").hide();
@@ -276,17 +474,25 @@ $(document).ready(function() {
             });
 
             /**
-             * Set up search bar
+             * Load following page of the collection shown once scrolled near the bottom
+             */
+            $(window).scroll(function() {
+                if (!session.authority || $(window).scrollTop() + $(window).height() < $(document).height() - 200) {
+                    return;
+                }
+                $.each(COLLECTIONS, function(collection, options) {
+                    if ($(options.container).is(":visible")) {
+                        loadPage(session, collection, session.authority.next[collection]);
+                    }
+                });
+            });
+
+            /**
+             * Set up search bar, signed certificates are searched on server
               */
             $(window).on("search", function() {
                 var q = $("#search").val();
-                $(".filterable").each(function(i, e) {
-                    if ($(e).attr("data-cn").toLowerCase().indexOf(q) >= 0) {
-                        $(e).show();
-                    } else {
-                        $(e).hide();
-                    }
-                });
+                loadPage(session, "signed", collectionURL(session, "signed", q), true);
             });
 
             /**
@@ -352,6 +558,6 @@ $(document).ready(function() {
                     }
                 });
             }
-        }
+        })}
     });
 });
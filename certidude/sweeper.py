@@ -0,0 +1,151 @@
+
+import calendar
+import click
+import heapq
+from certidude import config, leases, push
+from threading import Lock, Thread
+from time import sleep, time
+
+STATES = "online", "offline", "dead"
+
+class LeaseSweeper(object):
+    """
+    Online, offline and dead state of the clients derived from lease
+    records. Deadlines of the next transition are kept in a priority queue
+    so only clients that are due are looked at, counters are kept up to
+    date along the way. Every server process follows the lease log,
+    only one of them publishes state transitions
+    """
+    def __init__(self, offline, dead, interval=1.0):
+        self.offline = offline
+        self.dead = dead
+        self.interval = interval
+        self.seen = {} # common name -> last report as seconds since epoch
+        self.states = {} # common name -> state
+        self.counters = dict([(state, 0) for state in STATES])
+        self.deadlines = [] # (deadline, common name, last report)
+        self.transitions = dict([(state, []) for state in STATES])
+        self.running = False
+        self.loaded = False
+        self.lock = Lock()
+
+    def state(self, timestamp, now):
+        if now - timestamp >= self.dead:
+            return "dead"
+        if now - timestamp >= self.offline:
+            return "offline"
+        return "online"
+
+    def schedule(self, common_name, timestamp, state):
+        if state == "online":
+            heapq.heappush(self.deadlines, (timestamp + self.offline, common_name, timestamp))
+        elif state == "offline":
+            heapq.heappush(self.deadlines, (timestamp + self.dead, common_name, timestamp))
+
+    def transition(self, common_name, state):
+        prev = self.states.get(common_name)
+        if prev == state:
+            return
+        if prev:
+            self.counters[prev] -= 1
+        self.counters[state] += 1
+        self.states[common_name] = state
+        if self.running:
+            self.transitions[state].append(common_name)
+
+    def load(self):
+        """
+        Replay current leases, called with lease store lock held
+        """
+        self.loaded = True
+        for lease in leases.store.by_common_name.values():
+            self.apply(lease)
+        self.transitions = dict([(state, []) for state in STATES]) # Not transitions as such
+
+    def record(self, lease):
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            else:
+                self.apply(lease)
+
+    def apply(self, lease):
+        timestamp = calendar.timegm(lease.last_seen.utctimetuple())
+        if timestamp <= self.seen.get(lease.common_name, 0): # Already accounted for
+            return
+        self.seen[lease.common_name] = timestamp
+        state = self.state(timestamp, time())
+        self.transition(lease.common_name, state)
+        self.schedule(lease.common_name, timestamp, state)
+
+        # Reports pile up deadlines that are superseded, rebuild queue once in a while
+        if len(self.deadlines) > 2 * len(self.seen) + 1024:
+            self.deadlines = []
+            for common_name, timestamp in self.seen.items():
+                self.schedule(common_name, timestamp, self.states[common_name])
+
+    def sweep(self, now):
+        """
+        Move clients whose deadline has passed to the next state
+        """
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, common_name, timestamp = heapq.heappop(self.deadlines)
+            if self.seen.get(common_name) != timestamp: # Client has reported since
+                continue
+            state = self.state(timestamp, now)
+            self.transition(common_name, state)
+            self.schedule(common_name, timestamp, state)
+
+    def refresh(self):
+        """
+        Catch up with the lease log and apply passed deadlines
+        """
+        leases.store.refresh()
+        with leases.store.lock:
+            with self.lock:
+                if not self.loaded:
+                    self.load()
+                self.sweep(time())
+
+    def counts(self):
+        """
+        Return amount of clients per state
+        """
+        self.refresh()
+        with self.lock:
+            return dict(self.counters)
+
+    def get(self, common_name):
+        self.refresh()
+        return self.states.get(common_name)
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.refresh()
+                with self.lock:
+                    transitions = self.transitions
+                    self.transitions = dict([(state, []) for state in STATES])
+                for state in STATES:
+                    if transitions[state]: # One event per state carrying all the clients
+                        push.publish("lease-%s" % state, transitions[state])
+            except Exception as e:
+                click.echo("Failed to sweep leases: %s" % e)
+
+    def start(self):
+        """
+        Publish state transitions in a background thread,
+        only one process should publish them
+        """
+        self.running = True
+        worker = Thread(target=self.run)
+        worker.daemon = True
+        worker.start()
+
+sweeper = LeaseSweeper(config.LEASE_OFFLINE_TIMEOUT, config.LEASE_DEAD_TIMEOUT)
+leases.store.listeners.append(sweeper.record)
+
+counts = sweeper.counts
+get = sweeper.get
+start = sweeper.start
@@ -0,0 +1,204 @@
+
+import os
+from certidude import authority, changelog, config, push
+from certidude.changelog import ChangeLog
+from collections import defaultdict
+from threading import RLock
+from xattr import getxattr, removexattr, setxattr
+
+# Tag changes are logged separately so other changes wouldn't push them out
+changes = ChangeLog(os.path.join(config.META_DIR, "tags"))
+
+def parse(tag):
+    """
+    Split tag into key and value, tags without key are of type other
+    """
+    if "=" in tag:
+        return tuple(tag.split("=", 1))
+    return "other", tag
+
+def get_tags(path):
+    try:
+        return [tag for tag in getxattr(path, "user.xdg.tags").decode("utf-8").split(",") if tag]
+    except IOError: # No user.xdg.tags attribute
+        return []
+
+
+class TagIndex(object):
+    """
+    Common names of signed certificates by tag. Index is built from
+    extended attributes of the signed certificates, tag changes made by other
+    processes are picked up by following the tag change log and certificates
+    signed meanwhile by comparing serial numbers. Index is rebuilt
+    only if the tag change log has been compacted meanwhile
+    """
+    def __init__(self):
+        self.by_tag = defaultdict(set) # (key, value) -> common names
+        self.by_key = defaultdict(set) # key -> common names
+        self.by_common_name = {} # common name -> tags
+        self.serials = {} # common name -> serial number of indexed certificate
+        self.generation = None # Tag change log generation index reflects
+        self.inventory = None # Inventory generation index reflects
+        self.lock = RLock()
+
+    def update(self, common_name, tags=None):
+        """
+        Reindex certificate, tags are read from the certificate
+        unless specified
+        """
+        with self.lock:
+            self.serials.pop(common_name, None)
+            for tag in self.by_common_name.pop(common_name, ()):
+                key, value = parse(tag)
+                self.by_tag[(key, value)].discard(common_name)
+                if not self.by_tag[(key, value)]:
+                    del self.by_tag[(key, value)]
+                self.by_key[key].discard(common_name)
+                if not self.by_key[key]:
+                    del self.by_key[key]
+            entry = authority.signed_inventory.get(common_name)
+            if not entry:
+                return
+            if tags is None:
+                tags = get_tags(entry.path)
+            self.serials[common_name] = entry.serial_number
+            self.by_common_name[common_name] = tags
+            for tag in tags:
+                key, value = parse(tag)
+                self.by_tag[(key, value)].add(common_name)
+                self.by_key[key].add(common_name)
+
+    def rebuild(self):
+        with self.lock:
+            self.generation = changes.current()
+            self.inventory = authority.signed_inventory.generation
+            self.by_tag.clear()
+            self.by_key.clear()
+            self.by_common_name.clear()
+            self.serials.clear()
+            for entry in authority.signed_inventory:
+                self.update(entry.common_name, get_tags(entry.path))
+
+    def refresh(self):
+        with self.lock:
+            records = changes.since(self.generation) if self.generation is not None else None
+            if records is None:
+                self.rebuild()
+                return
+            for generation, event_type, common_name in records:
+                self.generation = generation
+                self.update(common_name)
+
+            # Certificates signed, revoked or expired meanwhile
+            authority.signed_inventory.refresh()
+            if authority.signed_inventory.generation != self.inventory:
+                self.inventory = authority.signed_inventory.generation
+                present = dict([(entry.common_name, entry.serial_number)
+                    for entry in authority.signed_inventory])
+                for common_name in set(self.by_common_name) - set(present):
+                    self.update(common_name)
+                for common_name, serial_number in present.items():
+                    if self.serials.get(common_name) != serial_number:
+                        self.update(common_name)
+
+    def query(self, all_of=(), any_of=()):
+        """
+        Return common names and tags of certificates having all of the tags
+        in the first list and at least one of the tags in the second one,
+        value * matches any value of the key
+        """
+        def lookup(tag):
+            key, value = parse(tag)
+            return self.by_key.get(key, set()) if value == "*" else self.by_tag.get((key, value), set())
+
+        self.refresh()
+        with self.lock:
+            if all_of:
+                matches = set.intersection(*[lookup(tag) for tag in all_of])
+            else:
+                matches = set(self.by_common_name)
+            if any_of:
+                matches &= set.union(*[lookup(tag) for tag in any_of])
+            return [(common_name, self.by_common_name[common_name]) for common_name in sorted(matches)]
+
+    def get(self, common_name):
+        self.refresh()
+        return self.by_common_name.get(common_name, [])
+
+index = TagIndex()
+
+rebuild = index.rebuild
+query = index.query
+
+
+def select(common_names=(), all_of=(), any_of=(), substring=None):
+    """
+    Return common names given explicitly and those of the certificates
+    matching the tags and common name substring, if any of these is given
+    """
+    selected = set(common_names)
+    if all_of or any_of or substring:
+        selected.update([common_name for common_name, _ in query(all_of, any_of)
+            if not substring or substring in common_name])
+    return sorted(selected)
+
+@authority.serialized
+def update(common_names, add=(), remove=(), replace=(), rename={}):
+    """
+    Replace values of the keys, rename, remove and add tags of the certificates.
+    Tags of each certificate are written at once while holding the authority
+    lock, one event is published for all of the changed certificates.
+    Value * removes all the tags of the key, returns status per certificate
+    """
+    for tag in tuple(add) + tuple(remove) + tuple(replace) + tuple(rename.values()):
+        if not tag or "," in tag:
+            raise ValueError("Invalid tag %s" % repr(tag))
+
+    # Tags are kept in order, renamed tags and replacing values take
+    # the place of the original ones, added ones are appended
+    dropped = set([parse(tag)[0] for tag in remove if parse(tag)[1] == "*"])
+    substitutes = defaultdict(list)
+    for tag in replace:
+        key, value = parse(tag)
+        dropped.add(key)
+        if value != "*":
+            substitutes[key].append(tag)
+
+    results, changed = [], []
+    for common_name in common_names:
+        try:
+            path, buf, cert = authority.get_signed(common_name)
+        except (EnvironmentError, ValueError): # Not signed or invalid common name
+            results.append((common_name, "not found"))
+            continue
+        current = get_tags(path)
+        tags, placed = [], set()
+        for tag in current:
+            key, value = parse(tag)
+            if key in dropped:
+                if key not in placed:
+                    placed.add(key)
+                    tags.extend([j for j in substitutes.get(key, ()) if j not in tags])
+            elif tag in rename:
+                if rename[tag] not in tags:
+                    tags.append(rename[tag])
+            elif tag not in remove and tag not in tags:
+                tags.append(tag)
+        tags.extend([tag for tag in tuple(replace) + tuple(rename.values()) + tuple(add)
+            if parse(tag)[1] != "*" and tag not in tags])
+        if tags == current:
+            results.append((common_name, "unchanged"))
+            continue
+        if tags:
+            setxattr(path, "user.xdg.tags", ",".join(tags).encode("utf-8"))
+        else:
+            removexattr(path, "user.xdg.tags")
+        index.update(common_name, list(tags))
+        results.append((common_name, "updated"))
+        changed.append(common_name)
+
+    if changed:
+        changes.bump_many("tag-update", changed)
+        push.publish("tag-update", changed[0] if len(changed) == 1 else changed,
+            generation=changelog.bump_many("tag-update", changed))
+    return results
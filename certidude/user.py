@@ -4,6 +4,9 @@ import grp
 import os
 import pwd
 from certidude import const, config
+from collections import OrderedDict
+from threading import BoundedSemaphore, Lock
+from time import time
 
 class User(object):
     def __init__(self, username, mail, given_name="", surname=""):
@@ -66,25 +69,108 @@ class PosixUserManager(object):
             yield user
 
 
-class DirectoryConnection(object):
-    def __enter__(self):
-        import ldap
-        import ldap.sasl
+class DirectoryConnectionPool(object):
+    """
+    Bounded pool of LDAP connections bound using Kerberos credential cache
+    of the computer account. Connections are checked after idling,
+    dropped when credential cache is renewed and not shared with
+    forked processes
+    """
+    def __init__(self, size=4, max_idle=60):
+        self.size = size
+        self.max_idle = max_idle
+        self.idle = []
+        self.semaphore = BoundedSemaphore(size)
+        self.lock = Lock()
 
+    def credentials(self):
         # TODO: Implement simple bind
-        if not os.path.exists(config.LDAP_GSSAPI_CRED_CACHE):
+        try:
+            s = os.stat(config.LDAP_GSSAPI_CRED_CACHE)
+        except OSError:
             raise ValueError("Ticket cache at %s not initialized, unable to "
                 "authenticate with computer account against LDAP server!" % config.LDAP_GSSAPI_CRED_CACHE)
+        return os.getpid(), s.st_ino, s.st_mtime
+
+    def connect(self):
+        import ldap
+        import ldap.sasl
+
         os.environ["KRB5CCNAME"] = config.LDAP_GSSAPI_CRED_CACHE
-        self.conn = ldap.initialize(config.LDAP_ACCOUNTS_URI)
-        self.conn.set_option(ldap.OPT_REFERRALS, 0)
+        conn = ldap.initialize(config.LDAP_ACCOUNTS_URI)
+        conn.set_option(ldap.OPT_REFERRALS, 0)
         click.echo("Connecing to %s using Kerberos ticket cache from %s" %
             (config.LDAP_ACCOUNTS_URI, config.LDAP_GSSAPI_CRED_CACHE))
-        self.conn.sasl_interactive_bind_s('', ldap.sasl.gssapi())
-        return self.conn
+        conn.sasl_interactive_bind_s('', ldap.sasl.gssapi())
+        return conn
+
+    def alive(self, conn):
+        import ldap
+        try:
+            conn.whoami_s()
+        except ldap.LDAPError:
+            return False
+        return True
+
+    def close(self, conn):
+        import ldap
+        try:
+            conn.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def acquire(self):
+        self.semaphore.acquire()
+        try:
+            credentials = self.credentials()
+            while True:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    conn, conn_credentials, released = self.idle.pop()
+                if conn_credentials != credentials:
+                    if conn_credentials[0] == credentials[0]:
+                        self.close(conn) # Credential cache was renewed
+                    continue
+                if time() - released < self.max_idle or self.alive(conn):
+                    return conn, credentials
+                self.close(conn)
+            return self.connect(), credentials
+        except:
+            self.semaphore.release()
+            raise
+
+    def release(self, conn, credentials, broken=False):
+        if broken:
+            self.close(conn)
+        else:
+            with self.lock:
+                self.idle.append((conn, credentials, time()))
+        self.semaphore.release()
+
+
+class DirectoryConnection(object):
+    """
+    Pooled LDAP connection, searches are retried once
+    with a new connection if LDAP server has gone away
+    """
+    def __enter__(self):
+        self.conn, self.credentials = pool.acquire()
+        return self
+
+    def search_s(self, *args):
+        import ldap
+        try:
+            return self.conn.search_s(*args)
+        except ldap.SERVER_DOWN:
+            pool.close(self.conn)
+            self.conn = pool.connect()
+            return self.conn.search_s(*args)
 
     def __exit__(self, type, value, traceback):
-        self.conn.unbind_s()
+        import ldap
+        pool.release(self.conn, self.credentials,
+            broken=type is not None and issubclass(type, ldap.LDAPError))
 
 
 class ActiveDirectoryUserManager(object):
@@ -156,10 +242,88 @@ class ActiveDirectoryUserManager(object):
                 return True
             return False
 
+
+class CachedUserManager(object):
+    """
+    Thread-safe cache of user manager lookups with time to live and
+    least recently used eviction. Failed lookups are cached as well
+    """
+    def __init__(self, backend, lifetime=300, size=1024):
+        self.backend = backend
+        self.lifetime = lifetime
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key, func, *args):
+        now = time()
+        with self.lock:
+            try:
+                expires, result, exception = self.entries.pop(key)
+            except KeyError:
+                pass
+            else:
+                if now < expires:
+                    self.hits += 1
+                    self.entries[key] = expires, result, exception
+                    if exception:
+                        raise exception
+                    return result
+            self.misses += 1
+
+        # Query backend without holding the lock
+        result, exception = None, None
+        try:
+            result = func(*args)
+        except (KeyError, User.DoesNotExist) as e:
+            exception = e
+
+        with self.lock:
+            self.entries[key] = now + self.lifetime, result, exception
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        if exception:
+            raise exception
+        return result
+
+    def get(self, username):
+        return self.lookup(("get", username), self.backend.get, username)
+
+    def filter_admins(self):
+        return self.lookup(("filter_admins",), lambda: tuple(self.backend.filter_admins()))
+
+    def all(self):
+        return self.lookup(("all",), lambda: tuple(self.backend.all()))
+
+    def is_admin(self, user):
+        return self.lookup(("is_admin", user.name), self.backend.is_admin, user)
+
+    def invalidate(self, username=None):
+        """
+        Drop cached entries of the user or everything if no username is specified
+        """
+        with self.lock:
+            if username is None:
+                self.entries.clear()
+                return
+            for key in list(self.entries):
+                if key[0] in ("filter_admins", "all") or key[1:] == (username,):
+                    del self.entries[key]
+
+    def stats(self):
+        return dict(size=len(self.entries), hits=self.hits, misses=self.misses)
+
+
+pool = DirectoryConnectionPool(config.LDAP_POOL_SIZE)
+
 if config.ACCOUNTS_BACKEND == "ldap":
-    User.objects = ActiveDirectoryUserManager()
+    User.objects = CachedUserManager(ActiveDirectoryUserManager(),
+        config.ACCOUNTS_CACHE_LIFETIME, config.ACCOUNTS_CACHE_SIZE)
 elif config.ACCOUNTS_BACKEND == "posix":
-    User.objects = PosixUserManager()
+    User.objects = CachedUserManager(PosixUserManager(),
+        config.ACCOUNTS_CACHE_LIFETIME, config.ACCOUNTS_CACHE_SIZE)
 else:
     raise NotImplementedError("Authorization backend %s not supported" % repr(config.AUTHORIZATION_BACKEND))
 
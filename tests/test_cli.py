@@ -6,6 +6,7 @@ import pytest
 import shutil
 import sys
 import os
+import json
 
 UA_FEDORA_FIREFOX = "Mozilla/5.0 (X11; Fedora; Linux x86_64) " \
     "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/57.0.2987.133 Safari/537.36"
@@ -14,8 +15,9 @@ smtp=None
 inbox=[]
 
 class DummySMTP(object):
-    def __init__(self,address):
+    def __init__(self,address,timeout=None):
         self.address=address
+        self.timeout=timeout
 
     def login(self,username,password):
         self.username=username
@@ -233,10 +235,20 @@ def test_cli_setup_authority():
     os.setgid(0) # Restore GID
     os.umask(0022)
 
+    # Enable session cookies in the test configuration
+    import codecs
+    from configparser import RawConfigParser
+    cp = RawConfigParser()
+    cp.readfp(codecs.open("/etc/certidude/server.conf", "r", "utf8"))
+    cp.set("authentication", "session lifetime", u"900")
+    with codecs.open("/etc/certidude/server.conf", "w", "utf8") as fh:
+        cp.write(fh)
+
     # Make sure nginx is running
     assert not result.exception, result.output
     assert os.getuid() == 0 and os.getgid() == 0, "Serve dropped permissions incorrectly!"
     assert os.system("nginx -t") == 0, "invalid nginx configuration"
+    assert "#    allow 0.0.0.0/0;" in open("/etc/nginx/sites-available/certidude.conf").read() # Mirrors crl subnets
     os.system("service nginx restart")
     assert os.path.exists("/run/nginx.pid"), "nginx wasn't started up properly"
 
@@ -299,8 +311,20 @@ def test_cli_setup_authority():
     assert "admin;adminbot;;;adminbot@example.lan" in result.output
     # TODO: assert nothing else is in the list
 
+    # User lookups are cached
+    from certidude.user import User
+    assert User.objects.get("userbot") == User.objects.get("userbot")
+    assert User.objects.stats()["hits"] > 0
+    with pytest.raises(KeyError):
+        User.objects.get("nonexistent")
+    with pytest.raises(KeyError):
+        User.objects.get("nonexistent")
+
     # Check that we can retrieve empty CRL
-    assert authority.export_crl(), "Failed to export CRL"
+    empty_crl = authority.export_crl()
+    assert empty_crl, "Failed to export CRL"
+    assert authority.export_crl() == empty_crl, "Revocation list was signed again needlessly"
+    assert os.path.exists("/var/lib/certidude/ca.example.lan/meta/crl.der")
     r = requests.get("http://ca.example.lan/api/revoked/")
     assert r.status_code == 200, r.text
 
@@ -452,8 +476,31 @@ def test_cli_setup_authority():
         headers={"content-type":"application/pkcs10"})
     assert r.status_code == 202 # server CN, request stored
     assert "Stored request " in inbox.pop(), inbox
+
+    # Signing requests are processed concurrently by worker threads
+    from threading import Thread
+    responses = {}
+    def submit(cn):
+        responses[cn] = requests.post("http://ca.example.lan/api/request/",
+            params={"autosign": 1}, data=generate_csr(cn=cn),
+            headers={"Content-Type": "application/pkcs10"})
+    submitters = [Thread(target=submit, args=(cn,)) for cn in (u"concurrent1", u"concurrent2")]
+    for submitter in submitters:
+        submitter.start()
+    for submitter in submitters:
+        submitter.join()
+    for cn, r in responses.items():
+        assert r.status_code == 200, r.text # autosign successful
+        assert authority.signed_inventory.get(cn), cn
     assert not inbox
 
+    # Test certificate inventory
+    entry = authority.signed_inventory.get("test")
+    assert entry, "Signed certificate missing from inventory"
+    assert authority.signed_inventory.find(entry.serial_number) == entry
+    assert not entry.server
+    assert "test2.example.lan" not in authority.list_server_names()
+
     # Test signed certificate API call
     r = client().simulate_get("/api/signed/nonexistant/")
     assert r.status_code == 404, r.text
@@ -461,10 +508,23 @@ def test_cli_setup_authority():
     r = client().simulate_get("/api/signed/test/")
     assert r.status_code == 200, r.text
     assert r.headers.get('content-type') == "application/x-pem-file"
-
+    etag = r.headers.get("etag")
+    assert etag, r.headers
+    lookups = authority.parsed_cache.hits + authority.parsed_cache.misses
+    r = client().simulate_get("/api/signed/test/", headers={"If-None-Match":etag})
+    assert r.status_code == 304, r.text
+    assert not r.text
+    assert authority.parsed_cache.hits + authority.parsed_cache.misses == lookups, "Responder was run for 304"
+    r = client().simulate_get("/api/signed/test/", headers={"If-Modified-Since":r.headers.get("last-modified")})
+    assert r.status_code == 304, r.text
+    r = client().simulate_get("/api/signed/test/", headers={"If-None-Match":etag, "Accept":"application/json"})
+    assert r.status_code == 200, r.text # Different representation
+
+    hits = authority.parsed_cache.hits
     r = client().simulate_get("/api/signed/test/", headers={"Accept":"application/json"})
     assert r.status_code == 200, r.text
     assert r.headers.get('content-type') == "application/json"
+    assert authority.parsed_cache.hits > hits, "Parsed certificate was not served from cache"
 
     r = client().simulate_get("/api/signed/test/", headers={"Accept":"text/plain"})
     assert r.status_code == 415, r.text
@@ -488,6 +548,17 @@ def test_cli_setup_authority():
         headers={"Accept":"application/x-pem-file"})
     assert r.status_code == 303, r.text
 
+    # Test delta revocation list API call
+    r = client().simulate_get("/api/revoked/delta/")
+    assert r.status_code == 200, r.text
+    assert r.headers.get('content-type') == "application/x-pkcs7-crl"
+
+    r = client().simulate_get("/api/revoked/delta/",
+        headers={"Accept":"application/x-pem-file"})
+    assert r.status_code == 200, r.text
+    assert r.headers.get('content-type') == "application/x-pem-file"
+    assert authority.delta_revocation_list.delta_of == authority.revocation_list.number
+
     # Test attribute fetching API call
     r = client().simulate_get("/api/signed/test/attr/")
     assert r.status_code == 401, r.text
@@ -537,8 +608,48 @@ def test_cli_setup_authority():
     assert r.status_code == 200, r.text
     r = client().simulate_get("/api/signed/test/tag/", headers={"Authorization":admintoken})
     assert r.status_code == 200, r.text
-    assert r.text == '[{"value": "Tartu", "key": "location", "id": "location=Tartu"}, {"value": "else", "key": "other", "id": "else"}]', r.text
+    assert r.text == '[{"value": "else", "key": "other", "id": "else"}, {"value": "Tartu", "key": "location", "id": "location=Tartu"}]', r.text # Edited in place
 
+    # Test tag search
+    r = client().simulate_get("/api/tag/", query_string="all=location=Tartu", headers={"Authorization":usertoken})
+    assert r.status_code == 403, r.text
+    r = client().simulate_get("/api/tag/", query_string="all=location=Tartu&all=else", headers={"Authorization":admintoken})
+    assert r.status_code == 200, r.text
+    assert [j["common_name"] for j in r.json["items"]] == ["test"], r.text
+    r = client().simulate_get("/api/tag/", query_string="all=location=Tallinn", headers={"Authorization":admintoken})
+    assert r.json["items"] == [], r.text
+    r = client().simulate_get("/api/tag/", query_string="any=location=Tallinn&any=location=*", headers={"Authorization":admintoken})
+    assert [j["common_name"] for j in r.json["items"]] == ["test"], r.text
+    r = client().simulate_get("/api/tag/", query_string="cursor=xyz", headers={"Authorization":admintoken})
+    assert r.status_code == 400, r.text
+
+    # Test bulk tagging
+    r = client().simulate_post("/api/tag/bulk/",
+        body=json.dumps(dict(common_names=["test", "nonexistant"], add=["bulk=yes"])),
+        headers={"content-type": "application/json", "Authorization":usertoken})
+    assert r.status_code == 403, r.text
+    r = client().simulate_post("/api/tag/bulk/",
+        body=json.dumps(dict(common_names=["test", "nonexistant"], add=["bulk=yes"])),
+        headers={"content-type": "application/json", "Authorization":admintoken})
+    assert r.status_code == 200, r.text
+    assert r.json["tags"] == [dict(common_name="nonexistant", status="not found"),
+        dict(common_name="test", status="updated")], r.text
+    r = client().simulate_post("/api/tag/bulk/",
+        body=json.dumps(dict(all=["bulk=yes"], add=["a,b"])),
+        headers={"content-type": "application/json", "Authorization":admintoken})
+    assert r.status_code == 400, r.text # comma in tag
+    result = runner.invoke(cli, ["tag", "--all", "bulk=*", "--remove", "bulk=*"])
+    assert not result.exception, result.output
+    assert "test: updated" in result.output, result.output
+    r = client().simulate_get("/api/signed/test/tag/", headers={"Authorization":admintoken})
+    assert [j["id"] for j in r.json] == ["else", "location=Tartu"], r.text # Order kept
+    from certidude import tags as tagging
+    assert tagging.update(["test"], replace=["location=Tallinn"]) == [("test", "updated")]
+    r = client().simulate_get("/api/signed/test/tag/", headers={"Authorization":admintoken})
+    assert [j["id"] for j in r.json] == ["else", "location=Tallinn"], r.text # Replaced in place
+    assert tagging.update(["test"], replace=["location=Tartu"]) == [("test", "updated")]
+    r = client().simulate_get("/api/tag/", query_string="all=bulk=*", headers={"Authorization":admintoken})
+    assert r.json["items"] == [], r.text
 
 
     # Test scripting
@@ -589,6 +700,10 @@ def test_cli_setup_authority():
     r = client().simulate_get("/api/signed/test/lease/", headers={"Authorization":admintoken})
     assert r.status_code == 200, r.text
     assert r.headers.get('content-type') == "application/json; charset=UTF-8"
+    assert r.json["state"] == "online", r.text
+    r = client().simulate_get("/api/lease/state/", headers={"Authorization":admintoken})
+    assert r.status_code == 200, r.text
+    assert r.json["online"] >= 1, r.text
 
     # Tags can be deleted only by admin
     r = client().simulate_delete("/api/signed/test/tag/else/")
@@ -619,12 +734,90 @@ def test_cli_setup_authority():
         query_string = "client=test&inner_address=127.0.0.1&outer_address=8.8.8.8&serial=0",
         headers={"Authorization":admintoken})
     assert r.status_code == 403, r.text # invalid serial number supplied
+    r = client().simulate_post("/api/lease/",
+        query_string = "client=test&inner_address=1.2.3.4%0Afake&outer_address=8.8.8.8",
+        headers={"Authorization":admintoken})
+    assert r.status_code == 400, r.text # malformed address would break lease log
     r = client().simulate_post("/api/lease/",
         query_string = "client=test&inner_address=1.2.3.4&outer_address=8.8.8.8",
         headers={"Authorization":admintoken})
     assert r.status_code == 200, r.text # lease update ok
 
+    # Test bulk lease update
+    r = client().simulate_post("/api/lease/bulk/",
+        body=json.dumps([dict(client="test", inner_address="1.2.3.5", outer_address="8.8.8.8")]),
+        headers={"content-type": "application/json", "X-Forwarded-For": "8.8.8.8"})
+    assert r.status_code == 403, r.text # not submitted from lease subnets
+    r = client().simulate_post("/api/lease/bulk/",
+        body=json.dumps([
+            dict(client="test", inner_address="1.2.3.5", outer_address="8.8.8.8"),
+            dict(client="test", inner_address="1.2.3.5", outer_address="8.8.8.8", serial=0),
+            dict(client="nonexistant", inner_address="1.2.3.6", outer_address="8.8.8.8"),
+            dict(client="test", inner_address="bogus", outer_address="8.8.8.8")]),
+        headers={"content-type": "application/json"})
+    assert r.status_code == 200, r.text
+    assert [j["status"] for j in r.json] == ["updated", "invalid serial", "not found", "malformed"], r.text
+    from certidude import leases
+    assert leases.get("test").inner_address == "1.2.3.5"
+    assert leases.find("1.2.3.5").common_name == "test"
+    assert not leases.find("1.2.3.4") # Replaced by new address
+    assert "test 1.2.3.5 8.8.8.8 " in open("/var/lib/certidude/ca.example.lan/meta/leases").read()
+    r = client().simulate_post("/api/lease/bulk/",
+        body="client=test&inner_address=1.2.3.4&outer_address=8.8.8.8&client=nonexistant",
+        headers={"content-type": "application/x-www-form-urlencoded"})
+    assert r.status_code == 400, r.text # arrays differ in length
+    r = client().simulate_post("/api/lease/bulk/",
+        body="client=test&inner_address=1.2.3.4&outer_address=8.8.8.8",
+        headers={"content-type": "application/x-www-form-urlencoded"})
+    assert r.status_code == 200, r.text
+    assert r.json == [dict(client="test", status="updated")], r.text
+
+    # Test event aggregation
+    from certidude import push
+    published = []
+    _publish = push._publish
+    push._publish = lambda event_type, event_data, span=None, durable=True: \
+        published.append((event_type, event_data, span))
+    try:
+        aggregator = push.EventAggregator(60, push.FLUSH_POLICIES)
+        aggregator.running = True
+        assert not aggregator.buffered("request-signed") # Flushed right away
+        assert aggregator.buffered("lease-update")
+        aggregator.add("lease-update", "test")
+        aggregator.add("lease-update", "test")
+        aggregator.flush()
+        assert not published # Window not elapsed yet
+        aggregator.flush(force=True)
+        assert published == [("lease-update", "test", None)], published # Duplicates published once
+        del published[:]
+        aggregator.add("tag-update", "test", (6, 7))
+        aggregator.add("tag-update", "other", (5, 6))
+        aggregator.add("tag-update", "test", (7, 8))
+        aggregator.add("attribute-update", "test", (3, 4))
+        aggregator.add("attribute-update", "test", (8, 9))
+        aggregator.stop()
+        assert sorted(published) == [
+            ("attribute-update", "test", (None, 9)), # Mutations 5 to 8 not covered
+            ("tag-update", ["test", "other"], (5, 8))], published # Batched into list
+        assert not aggregator.buffered("tag-update") # Published right away once stopped
+    finally:
+        push._publish = _publish
+
+    # Test lease history
+    r = client().simulate_get("/api/signed/test/history/")
+    assert r.status_code == 401, r.text
+    r = client().simulate_get("/api/signed/test/history/", headers={"Authorization":admintoken})
+    assert r.status_code == 200, r.text
+    assert r.json[-1]["online"], r.text
+    r = client().simulate_get("/api/signed/nonexistant/history/", headers={"Authorization":admintoken})
+    assert r.status_code == 404, r.text
+    r = client().simulate_get("/api/lease/history/", query_string="resolution=minute", headers={"Authorization":admintoken})
+    assert r.status_code == 200, r.text
+    r = client().simulate_get("/api/lease/history/", query_string="resolution=week", headers={"Authorization":admintoken})
+    assert r.status_code == 400, r.text
+
     # Test revocation
+    base_number = authority.revocation_list.number
     r = client().simulate_delete("/api/signed/test/")
     assert r.status_code == 401, r.text
     r = client().simulate_delete("/api/signed/test/",
@@ -634,6 +827,13 @@ def test_cli_setup_authority():
         headers={"Authorization":admintoken})
     assert r.status_code == 200, r.text
     assert "Revoked " in inbox.pop(), inbox
+    assert not authority.signed_inventory.get("test")
+    assert authority.revoked_inventory.find(entry.serial_number)
+    assert authority.export_crl() == empty_crl, "Complete revocation list was signed again on revocation"
+    assert authority.revocation_list.number == base_number
+    authority.export_delta_crl()
+    assert entry.serial_number in authority.delta_revocation_list.serials, "Delta revocation list not updated"
+    assert authority.delta_revocation_list.delta_of == base_number
 
 
     # Log can be read only by admin
@@ -673,6 +873,105 @@ def test_cli_setup_authority():
     if ev_url.startswith("/"): # Expand URL
         ev_url = "http://ca.example.lan" + ev_url
     assert ev_url.startswith("http://ca.example.lan/ev/sub/")
+    assert "signed" not in r.json.get("authority"), r.text # Moved to collections
+    assert "no-store" not in r.headers.get("cache-control"), r.headers
+    assert not r.headers.get("pragma"), r.headers
+    assert not r.headers.get("expires"), r.headers
+    r = client().simulate_get("/api/", headers={"Authorization":admintoken, "If-None-Match":r.headers.get("etag")})
+    assert r.status_code == 304, r.text
+
+    # Test session cookie
+    assert config.SESSION_LIFETIME == 900
+    r = client().simulate_get("/api/", headers={"Authorization":admintoken})
+    assert r.status_code == 200, r.text
+    attributes = [j.strip() for j in r.headers.get("set-cookie", "").split(";")]
+    assert "HttpOnly" in attributes and "Secure" in attributes, attributes
+    assert "SameSite=Strict" in attributes, attributes
+    assert "Max-Age=900" in attributes and "Path=/api/" in attributes, attributes
+    cookie = attributes[0]
+    assert cookie.startswith("certidude_session="), r.headers
+    r = client().simulate_get("/api/", headers={"Cookie":cookie})
+    assert r.status_code == 200, r.text # resumed without authorization header
+    assert r.json["user"]["name"] == "adminbot", r.text
+    payload, signature = cookie.split("=", 1)[1].rsplit(".", 1)
+    r = client().simulate_get("/api/", headers={"Cookie":"certidude_session=%s.%s" % (payload, "0" * 64)})
+    assert r.status_code == 401, r.text # tampered signature
+    from base64 import b64encode
+    from time import time
+    def forge(username, admin, expires):
+        payload = b64encode("%s:%d:%d" % (username, admin, expires))
+        return "certidude_session=%s.%s" % (payload, auth.sign_session(payload))
+    r = client().simulate_get("/api/", headers={"Cookie":forge("adminbot", 1, time() - 1)})
+    assert r.status_code == 401, r.text # expired
+    r = client().simulate_get("/api/", headers={"Cookie":forge("nonexistent", 1, time() + 60)})
+    assert r.status_code == 401, r.text # removed user falls back to backends
+    r = client().simulate_get("/api/session/signed/", headers={"Cookie":forge("adminbot", 0, time() + 60)})
+    assert r.status_code == 403, r.text # admin flag is taken from the cookie
+    assert user.User.objects.get("adminbot").is_admin() # Cached user is left untouched
+
+    # Test paginated collections
+    r = client().simulate_get("/api/session/signed/", headers={"Authorization":usertoken})
+    assert r.status_code == 403, r.text
+    r = client().simulate_get("/api/session/signed/", query_string="sort=serial",
+        headers={"Authorization":admintoken})
+    assert r.status_code == 400, r.text
+    r = client().simulate_get("/api/session/signed/", query_string="limit=1",
+        headers={"Authorization":admintoken})
+    assert r.status_code == 200, r.text
+    assert len(r.json["items"]) == 1, r.text
+    assert r.json["next"], r.text
+    first = r.json["items"][0]["common_name"]
+    path, query = r.json["next"].split("?", 1)
+    r = client().simulate_get(path, query_string=query, headers={"Authorization":admintoken})
+    assert r.status_code == 200, r.text
+    assert r.json["items"][0]["common_name"] > first, r.text
+    r = client().simulate_get("/api/session/signed/", query_string="q=test&sort=-expires",
+        headers={"Authorization":admintoken})
+    assert r.status_code == 200, r.text
+    assert "test" in [j["common_name"] for j in r.json["items"]], r.text
+    r = client().simulate_get("/api/session/request/", headers={"Authorization":admintoken})
+    assert r.status_code == 200, r.text
+    assert r.json["next"] is None, r.text
+    r = client().simulate_get("/api/session/revoked/", headers={"Authorization":admintoken})
+    revoked = len(r.json["items"])
+    r = client().simulate_get("/api/session/revoked/", query_string="limit=1", headers={"Authorization":admintoken})
+    paged = len(r.json["items"])
+    while r.json["next"]: # Revoked certificates sharing common name are not skipped
+        path, query = r.json["next"].split("?", 1)
+        r = client().simulate_get(path, query_string=query, headers={"Authorization":admintoken})
+        paged += len(r.json["items"])
+    assert paged == revoked, r.text
+    r = client().simulate_get("/api/session/signed/", query_string="sort=-common_name&limit=1",
+        headers={"Authorization":admintoken})
+    names = [j["common_name"] for j in r.json["items"]]
+    while r.json["next"]: # Descending order is sought from the end of the index
+        path, query = r.json["next"].split("?", 1)
+        r = client().simulate_get(path, query_string=query, headers={"Authorization":admintoken})
+        names += [j["common_name"] for j in r.json["items"]]
+    assert names == sorted([entry.common_name for entry in authority.signed_inventory], reverse=True), names
+    r = client().simulate_get("/api/session/signed/", query_string="sort=-last_seen",
+        headers={"Authorization":admintoken})
+    assert r.status_code == 200, r.text
+    assert len(r.json["items"]) == len(names), r.text
+
+    # Test change feed
+    r = client().simulate_get("/api/", headers={"Authorization":admintoken})
+    generation = r.json["authority"]["generation"]
+    assert generation > 0, r.text
+    r = client().simulate_get("/api/session/changes/", query_string="since=%d" % generation,
+        headers={"Authorization":admintoken})
+    assert r.status_code == 200, r.text
+    assert r.json["changes"] == [], r.text
+    assert r.json["generation"] == generation, r.text
+    r = client().simulate_get("/api/session/changes/", query_string="since=0",
+        headers={"Authorization":admintoken})
+    assert r.status_code == 200, r.text
+    changes = dict([(j["common_name"], j) for j in r.json["changes"]])
+    assert changes["test"]["certificate"], r.text
+    assert not changes["test"]["request"], r.text
+    r = client().simulate_get("/api/session/changes/", query_string="since=%d" % (generation + 1),
+        headers={"Authorization":admintoken})
+    assert r.json["reset"], r.text
 
 
     #######################
@@ -1199,6 +1498,43 @@ def test_cli_setup_authority():
         buf = fh.read()
         assert ": revoked" in buf, buf
 
+    # Requests without nonce are answered with pre-signed responses
+    assert os.system("openssl ocsp -no_nonce -issuer /var/lib/certidude/ca.example.lan/ca_crt.pem -cert /var/lib/certidude/ca.example.lan/signed/roadwarrior2.pem -text -url http://ca.example.lan/api/ocsp/ -out /tmp/ocsp4.log") == 0
+    assert os.system("openssl ocsp -no_nonce -issuer /var/lib/certidude/ca.example.lan/ca_crt.pem -cert /var/lib/certidude/ca.example.lan/signed/roadwarrior2.pem -text -url http://ca.example.lan/api/ocsp/ -out /tmp/ocsp5.log") == 0
+    with open("/tmp/ocsp4.log") as fh:
+        buf = fh.read()
+        assert ": good" in buf, buf
+        assert "Next Update" in buf, buf
+    with open("/tmp/ocsp5.log") as fh:
+        assert buf == fh.read(), "pre-signed response was not reused"
+
+    # Pre-signed responses to GET requests carry caching headers
+    assert os.system("openssl ocsp -no_nonce -issuer /var/lib/certidude/ca.example.lan/ca_crt.pem -cert /var/lib/certidude/ca.example.lan/signed/roadwarrior2.pem -reqout /tmp/ocsp.req") == 0
+    from base64 import b64encode
+    with open("/tmp/ocsp.req", "rb") as fh:
+        url = "http://ca.example.lan/api/ocsp/" + b64encode(fh.read())
+    r = requests.get(url)
+    assert r.status_code == 200, r.text
+    assert r.headers.get("content-type") == "application/ocsp-response"
+    assert "max-age=" in r.headers.get("cache-control")
+    assert r.headers.get("expires")
+    assert r.headers.get("last-modified")
+    r2 = requests.get(url, headers={"If-None-Match": r.headers.get("etag")})
+    assert r2.status_code == 304, r2.text
+
+    # Pre-signed responses are exported only under request path computed for the serial
+    store = authority.OCSPResponseStore(3600, "/tmp/ocsp-export")
+    serial = authority.signed_inventory.get("roadwarrior2").serial_number
+    der, this_update, next_update = store.get(serial)
+    path = os.path.join("/tmp/ocsp-export", authority.ocsp_request_path(serial))
+    assert open(path, "rb").read() == der
+    store.get(0xdeadbeef) # Unknown serial is not exported
+    exported = [os.path.join(root, filename) for root, _, filenames in os.walk("/tmp/ocsp-export") for filename in filenames]
+    assert exported == [path], exported
+    store.invalidate(serial)
+    assert not os.path.exists(path)
+    shutil.rmtree("/tmp/ocsp-export")
+
 
     #####################
     ### Kerberos auth ###
@@ -1303,6 +1639,18 @@ def test_cli_setup_authority():
     assert not result.exception, result.output
     result = runner.invoke(cli, ['cron'])
     assert not result.exception, result.output
+    result = runner.invoke(cli, ['publish-static'])
+    assert result.exception, result.output # Static export not configured
+    result = runner.invoke(cli, ['verify', '--fix'])
+    assert not result.exception, result.output
+    result = runner.invoke(cli, ['verify'])
+    assert not result.exception, result.output
+    assert "computed" not in result.output, result.output # Nothing to fix
+    from xattr import getxattr
+    for filename in os.listdir("/var/lib/certidude/ca.example.lan/revoked/"):
+        if filename.endswith(".pem"):
+            assert getxattr(os.path.join("/var/lib/certidude/ca.example.lan/revoked/", filename),
+                "user.revocation.time") # Not to be confused with inode change time
 
     # Shut down server
     assert os.path.exists("/proc/%d" % server_pid)
@@ -1319,5 +1667,417 @@ def test_cli_setup_authority():
 
     clean_server()
 
+SEQUENCING_SCRIPT = """
+var fs = require("fs"), vm = require("vm");
+var requests = [], received = [];
+var $ = function() { return { ready: function() {}, remove: function() {}, prepend: function() {}, timeago: function() {} }; };
+$.timeago = { settings: {} };
+$.ajax = function(options) { requests.push(options); };
+$.each = function(items, callback) { for (var j = 0; j < items.length; j++) { callback(j, items[j]); } };
+var sandbox = { $: $, jQuery: $, document: {}, console: { info: function() {}, log: function() {} } };
+vm.runInNewContext(fs.readFileSync(process.argv[1], "utf8"), sandbox);
+var session = { authority: { generation: 5, collections: { changes: "/api/session/changes/" } } };
+var listener = sandbox.unwrap(session, function(e) { received.push(e.data); });
+var send = function(payload) { listener({ data: JSON.stringify(payload) }); };
+var states = [];
+var snapshot = function() { states.push([session.authority.generation, requests.length]); };
+send({ since: 5, generation: 6, data: "a" }); snapshot(); // In sequence
+send({ data: "lease" }); snapshot(); // Not a mutation
+send({ since: 7, generation: 8, data: "c" }); snapshot(); // Mutation 7 missed
+send({ since: 6, generation: 7, data: "b" }); snapshot(); // Late while resuming
+requests[0].success({ reset: false, generation: 7, changes: [] }); snapshot(); // Feed lagging behind
+requests[1].success({ reset: false, generation: 8, changes: [] }); snapshot();
+send({ since: 6, generation: 7, data: "b" }); snapshot(); // Duplicate
+send({ since: 8, generation: 10, data: ["d", "e"] }); snapshot(); // Batch
+send({ since: null, generation: 12, data: ["f", "g"] }); snapshot(); // Batch with gap
+console.log(JSON.stringify({ received: received, states: states,
+    urls: requests.map(function(j) { return j.url; }) }));
+"""
+
+def test_event_sequencing():
+    # Mutation events received out of order must not advance generation past missed ones
+    import distutils.spawn
+    import subprocess
+    node = distutils.spawn.find_executable("node") or distutils.spawn.find_executable("nodejs")
+    if not node:
+        pytest.skip("Node.js not available")
+    path = os.path.join(os.path.dirname(__file__), "..", "certidude", "static", "js", "certidude.js")
+    result = json.loads(subprocess.check_output([node, "-e", SEQUENCING_SCRIPT, path]))
+    assert result["received"] == ["a", "lease", "d", "e"], result
+    assert result["states"] == [[6, 0], [6, 0], [6, 1], [6, 1], [7, 2], [8, 2], [8, 2], [10, 2], [10, 3]], result
+    assert result["urls"] == ["/api/session/changes/?since=6", "/api/session/changes/?since=7",
+        "/api/session/changes/?since=10"], result
+
+def test_thread_pool_server():
+    # Slow request must not hold up others, server stops after max requests
+    import urllib2
+    from threading import Event, Thread
+    from certidude.server import ThreadPoolWSGIServer
+    entered, release = Event(), Event()
+    def app(environ, start_response):
+        if environ["PATH_INFO"] == "/slow":
+            entered.set()
+            release.wait(10)
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [environ["PATH_INFO"]]
+    httpd = ThreadPoolWSGIServer(("127.0.0.1", 0), threads=2)
+    httpd.set_app(app)
+    url = "http://127.0.0.1:%d" % httpd.server_port
+    opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+    server = Thread(target=httpd.serve, args=(2,))
+    server.daemon = True
+    server.start()
+    responses = []
+    slow = Thread(target=lambda: responses.append(opener.open(url + "/slow", timeout=10).read()))
+    slow.start()
+    assert entered.wait(10)
+    assert opener.open(url + "/fast", timeout=10).read() == "/fast"
+    release.set()
+    slow.join()
+    server.join(10)
+    httpd.server_close()
+    assert not server.is_alive(), "Server did not stop after serving max requests"
+    assert responses == ["/slow"], responses
+
+def test_prefork_recycling():
+    # Worker process is replaced once it has served max requests
+    import signal
+    import urllib2
+    from certidude.server import ThreadPoolWSGIServer, prefork
+    def app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [str(os.getpid())]
+    httpd = ThreadPoolWSGIServer(("127.0.0.1", 0), threads=1)
+    httpd.set_app(app)
+    url = "http://127.0.0.1:%d" % httpd.server_port
+    master_pid = os.fork()
+    if not master_pid:
+        try:
+            prefork(httpd, 1, 1)
+        finally:
+            os._exit(1)
+    httpd.server_close()
+    opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+    try:
+        pids = [opener.open(url, timeout=10).read() for j in range(3)]
+    finally:
+        os.kill(master_pid, signal.SIGTERM)
+        os.waitpid(master_pid, 0)
+    assert len(set(pids)) == 3, pids
+    assert str(master_pid) not in pids, pids
+
+def test_outbox_retry(tmpdir):
+    # Failed jobs are retried with exponential backoff until attempts run out
+    from certidude.outbox import Outbox
+    now = [1000.0]
+    failing = [True]
+    delivered = []
+    def deliver(job):
+        if failing[0]:
+            raise EnvironmentError("Connection refused")
+        delivered.append(job["url"])
+    outbox = Outbox(str(tmpdir), attempts=3, max_backoff=3, clock=lambda: now[0])
+    outbox.deliver = deliver
+    spooled = lambda: [json.load(open(str(tmpdir.join(j)))) for j in sorted(os.listdir(str(tmpdir)))]
+
+    outbox.request("POST", "http://push/crl")
+    assert [(j["attempts"], j["retry"]) for j in spooled()] == [(1, 1002.0)]
+    now[0] = 1001.0
+    outbox.drain() # Not due yet
+    assert [(j["attempts"], j["retry"]) for j in spooled()] == [(1, 1002.0)]
+    now[0] = 1002.0
+    outbox.drain()
+    assert [(j["attempts"], j["retry"]) for j in spooled()] == [(2, 1005.0)] # Backoff capped
+    now[0] = 1005.0
+    outbox.drain()
+    assert spooled() == [], "Job was not given up on"
+
+    outbox.request("POST", "http://push/cert")
+    failing[0] = False
+    now[0] = 1007.0
+    outbox.drain()
+    assert spooled() == []
+    assert delivered == ["http://push/cert"]
+
+def test_outbox_push_events(tmpdir):
+    # Push events are attempted once, stale events would arrive out of order
+    from base64 import b64decode
+    from certidude import push
+    from certidude.outbox import Outbox
+    attempted = []
+    def deliver(job):
+        attempted.append(json.loads(b64decode(job["data"]))["data"])
+        raise EnvironmentError("Connection refused")
+    outbox = Outbox(str(tmpdir), clock=lambda: 1000.0)
+    outbox.deliver = deliver
+    previous, push.outbox = push.outbox, outbox
+    try:
+        push._publish("lease-update", "test")
+        push._publish("tag-update", "test", (5, 6), durable=False)
+    finally:
+        push.outbox = previous
+    assert attempted == ["test", "test"]
+    assert os.listdir(str(tmpdir)) == [], "Push event was left for retry"
+
+class StubTransport(object):
+    def __init__(self):
+        self.requests = 0
+        self.failing = False
+        self.callback = None
+
+    def request(self, method, url, **kwargs):
+        import requests
+        self.requests += 1
+        if self.callback:
+            self.callback()
+        if self.failing:
+            raise requests.exceptions.ConnectionError("Connection refused")
+        return "response"
+
+def stub_push_session(**kwargs):
+    from certidude.push import PushSession
+    class StubPushSession(PushSession):
+        def connect(self):
+            self.transports.append(StubTransport())
+            return self.transports[-1]
+    session = StubPushSession(**kwargs)
+    session.transports = []
+    return session
+
+def test_push_circuit_breaker():
+    # Requests fail fast while open, single probe is let through once half-open
+    import requests
+    now = [1000.0]
+    session = stub_push_session(threshold=2, cooldown=30, clock=lambda: now[0])
+    assert session.request("POST", "http://push/") == "response"
+    transport, = session.transports
+    transport.failing = True
+    for j in range(2):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            session.request("POST", "http://push/")
+    with pytest.raises(EnvironmentError): # Open
+        session.request("POST", "http://push/")
+    assert transport.requests == 3
+
+    now[0] = 1030.0 # Half-open, failed probe opens circuit again
+    with pytest.raises(requests.exceptions.ConnectionError):
+        session.request("POST", "http://push/")
+    assert transport.requests == 4
+    with pytest.raises(EnvironmentError):
+        session.request("POST", "http://push/")
+    assert transport.requests == 4
+
+    now[0] = 1060.0 # Half-open, others fail fast while probe is in progress
+    transport.failing = False
+    def concurrent():
+        transport.callback = None
+        with pytest.raises(EnvironmentError):
+            session.request("POST", "http://push/")
+    transport.callback = concurrent
+    assert session.request("POST", "http://push/") == "response"
+    assert transport.requests == 5
+    assert session.failures == 0 # Reset
+
+    assert session.request("POST", "http://push/") == "response" # Closed
+    assert transport.requests == 6
+
+def test_push_session_fork():
+    # Forked process must not share keep-alive connections with the parent
+    session = stub_push_session()
+    session.request("POST", "http://push/")
+    read_fd, write_fd = os.pipe()
+    child_pid = os.fork()
+    if not child_pid:
+        try:
+            session.request("POST", "http://push/")
+            os.write(write_fd, "%d" % len(session.transports))
+        finally:
+            os._exit(0)
+    os.waitpid(child_pid, 0)
+    assert os.read(read_fd, 16) == "2", "Session was not rebuilt in forked process"
+    session.request("POST", "http://push/")
+    assert len(session.transports) == 1
+    assert session.transports[0].requests == 2
+
+def fake_ldap(monkeypatch, tmpdir):
+    # Fake python-ldap module and credential cache for connection pool tests
+    import types
+    from certidude import config, user
+    ldap = types.ModuleType("ldap")
+    ldap.sasl = types.ModuleType("ldap.sasl")
+    ldap.sasl.gssapi = lambda: None
+    ldap.OPT_REFERRALS = 8
+    class LDAPError(Exception):
+        pass
+    class SERVER_DOWN(LDAPError):
+        pass
+    ldap.LDAPError, ldap.SERVER_DOWN = LDAPError, SERVER_DOWN
+    ldap.connections = []
+    class Connection(object):
+        def __init__(self, uri):
+            self.alive = True
+            self.unbound = False
+            self.checks = 0
+            ldap.connections.append(self)
+        def set_option(self, option, value):
+            pass
+        def sasl_interactive_bind_s(self, who, auth):
+            pass
+        def whoami_s(self):
+            self.checks += 1
+            if not self.alive:
+                raise SERVER_DOWN("Can't contact LDAP server")
+            return "u:CA$"
+        def unbind_s(self):
+            self.unbound = True
+        def search_s(self, *args):
+            if not self.alive:
+                raise SERVER_DOWN("Can't contact LDAP server")
+            return [("CN=userbot", {})]
+    ldap.initialize = Connection
+    monkeypatch.setitem(sys.modules, "ldap", ldap)
+    monkeypatch.setitem(sys.modules, "ldap.sasl", ldap.sasl)
+    cache = tmpdir.join("krb5cc")
+    cache.write("")
+    monkeypatch.setattr(config, "LDAP_GSSAPI_CRED_CACHE", str(cache))
+    now = [1000.0]
+    monkeypatch.setattr(user, "time", lambda: now[0])
+    return ldap, now
+
+def test_directory_connection_pool(monkeypatch, tmpdir):
+    # Pool is bounded, idle connections are checked and not shared with other processes
+    from threading import Thread
+    from certidude.user import DirectoryConnectionPool
+    ldap, now = fake_ldap(monkeypatch, tmpdir)
+    pool = DirectoryConnectionPool(size=2, max_idle=60)
+    first, credentials = pool.acquire()
+    second, _ = pool.acquire()
+    acquired = []
+    waiter = Thread(target=lambda: acquired.append(pool.acquire()))
+    waiter.daemon = True
+    waiter.start()
+    waiter.join(0.2)
+    assert not acquired, "Pool allowed more connections than its size"
+    pool.release(second, credentials)
+    waiter.join(5)
+    assert acquired and acquired[0][0] is second, acquired
+    assert len(ldap.connections) == 2
+    pool.release(first, credentials)
+    pool.release(second, credentials)
+
+    now[0] = 1030.0 # Recently released connection is not checked
+    conn, credentials = pool.acquire()
+    assert conn is second and conn.checks == 0
+    pool.release(conn, credentials)
+
+    now[0] = 1100.0 # Connection idling for longer is checked, dead one replaced
+    second.alive = False
+    conn, credentials = pool.acquire()
+    assert second.checks == 1 and second.unbound
+    assert conn is first and first.checks == 1
+    pool.release(conn, credentials)
+
+    # Connection inherited from another process is dropped without unbinding
+    pid, ino, mtime = credentials
+    pool.idle = [(first, (pid + 1, ino, mtime), now[0])]
+    conn, credentials = pool.acquire()
+    assert conn is ldap.connections[-1] and len(ldap.connections) == 3
+    assert not first.unbound
+    pool.release(conn, credentials)
+
+    # Connection bound using previous credential cache is unbound
+    pool.idle = [(conn, (pid, ino, mtime - 1), now[0])]
+    replacement, credentials = pool.acquire()
+    assert conn.unbound and len(ldap.connections) == 4
+    pool.release(replacement, credentials, broken=True)
+    assert replacement.unbound and not pool.idle
+
+def test_directory_connection_retry(monkeypatch, tmpdir):
+    # Search is retried once with new connection if LDAP server has gone away
+    from certidude import user
+    ldap, now = fake_ldap(monkeypatch, tmpdir)
+    monkeypatch.setattr(user, "pool", user.DirectoryConnectionPool(size=1))
+    with user.DirectoryConnection() as conn:
+        stale = conn.conn
+        stale.alive = False
+        assert conn.search_s("DC=example,DC=lan", 2, "(cn=userbot)") == [("CN=userbot", {})]
+        assert stale.unbound and conn.conn is not stale
+    assert [j[0] for j in user.pool.idle] == [ldap.connections[-1]]
+
+    with pytest.raises(ldap.SERVER_DOWN):
+        with user.DirectoryConnection() as conn:
+            ldap.initialize = lambda uri: stale # Server still down on reconnect
+            conn.conn.alive = False
+            conn.search_s("DC=example,DC=lan", 2, "(cn=userbot)")
+    assert not user.pool.idle, "Broken connection was returned to pool"
+
+def test_acceptor_credentials(monkeypatch, tmpdir):
+    # Acceptor credentials are cached per process until keytab changes
+    import types
+    from certidude import auth, config
+    loaded = []
+    class Credentials(object):
+        def __init__(self, usage, name):
+            loaded.append(name)
+    gssapi = types.ModuleType("gssapi")
+    gssapi.creds = types.ModuleType("gssapi.creds")
+    gssapi.creds.Credentials = Credentials
+    gssapi.names = types.ModuleType("gssapi.names")
+    gssapi.names.Name = lambda name: name
+    monkeypatch.setattr(auth, "gssapi", gssapi)
+    keytab = str(tmpdir.join("krb5.keytab"))
+    with open(keytab, "w") as fh:
+        fh.write("kvno1")
+    monkeypatch.setattr(config, "KERBEROS_KEYTAB", "FILE:" + keytab)
+
+    acceptor = auth.AcceptorCredentials()
+    creds = acceptor.get()
+    assert acceptor.get() is creds
+    assert len(loaded) == 1
+
+    # Keytab rotated by moving new one in place
+    with open(keytab + ".part", "w") as fh:
+        fh.write("kvno2")
+    os.rename(keytab + ".part", keytab)
+    creds = acceptor.get()
+    assert len(loaded) == 2
+
+    # Keytab rewritten in place with modification time preserved
+    st = os.stat(keytab)
+    sleep(0.05)
+    with open(keytab, "w") as fh:
+        fh.write("kvno3")
+    os.utime(keytab, (st.st_atime, st.st_mtime))
+    creds = acceptor.get()
+    assert len(loaded) == 3
+
+    # Previous credentials are used while keytab is being replaced
+    os.unlink(keytab)
+    assert acceptor.get() is creds
+    assert len(loaded) == 3
+    with open(keytab, "w") as fh:
+        fh.write("kvno3")
+
+    # Credentials are loaded again after accepting failed
+    creds = acceptor.get()
+    count = len(loaded)
+    acceptor.invalidate()
+    assert acceptor.get() is not creds
+    assert len(loaded) == count + 1
+
+    # Forked process loads credentials of its own
+    creds = acceptor.get()
+    loaded_before = len(loaded)
+    read_fd, write_fd = os.pipe()
+    child_pid = os.fork()
+    if not child_pid:
+        try:
+            os.write(write_fd, "%d" % (acceptor.get() is not creds and len(loaded) - loaded_before))
+        finally:
+            os._exit(0)
+    os.waitpid(child_pid, 0)
+    assert os.read(read_fd, 16) == "1"
+    assert acceptor.get() is creds
+
 if __name__ == "__main__":
     test_cli_setup_authority()